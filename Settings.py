@@ -1,8 +1,14 @@
+import os
+
 # See link to for options that can be put in this list
 # https://gitlab.com/cvejarano-oss/cmapy/-/blob/master/docs/colorize_all_examples.md
 COLORMAP_LIST = ['jet','tab20b','gist_ncar','Set1','prism','tab20b_r','brg_r','bwr','seismic','coolwarm','PiYG_r','tab10','tab20','gnuplot2','brg']
 DEFAULT_COLORMAP_INDEX = 0
 
+# Colormap lookup tables are built once and stored in this file, so later starts don't need to load matplotlib
+# Set to None to build them in memory on first use instead
+COLORMAP_CACHE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'colormap_cache.npz')
+
 # 0 - Nearest
 # 1 - Inter Linear
 # 2 - Inter Area
@@ -10,7 +16,45 @@ DEFAULT_COLORMAP_INDEX = 0
 # 4 - Inter Lanczos4
 # 5 - Pure Scipy       - nice but slow - 3 fps
 # 6 - Scipy/CV2 Mixed' - nice and fast - 4 fps
-DEFAULT_INTERPOLATION_INDEX = 6
+# 7 - Fast Scipy       - same image as 5, spline precomputed as matrix products (see benchmark.py)
+# 8 - Fast Scipy/CV2 Mixed - same image as 6, spline precomputed as matrix products
+DEFAULT_INTERPOLATION_INDEX = 8  # Same image as 6 without importing scipy, which is slow to load
+
+# How temperatures are mapped to colors
+# 'auto'   - stretch every frame between its own min and max (default), the palette flickers with the scene
+# 'smooth' - follow the frame min/max with exponential smoothing and a small dead band
+# 'locked' - fixed TEMP_RANGE_LOCKED range, CONTROL_TEMP_RANGE_LOCK locks/unlocks the current range at runtime
+TEMP_RANGE_MODE = 'auto'
+TEMP_RANGE_SMOOTHING = 0.2  # Fraction of the way to the new min/max moved per frame
+TEMP_RANGE_HYSTERESIS = 0.3  # Degrees C the min/max must change before the range follows
+TEMP_RANGE_MIN_SPAN = 2.0  # Degrees C, uniform scenes are shown over at least this range
+TEMP_RANGE_LOCKED = None  # (min, max) in C, e.g. (20.0, 40.0)
+
+# Filter used when filtering is on (CONTROL_FILTER_ENABLE_DISABLE), cycled with CONTROL_FILTER_MODE
+# 'temporal_iir' - running average over frames, smoothest, moving objects leave a short trail
+# 'temporal_median' - median of the last FILTER_HISTORY frames, removes single frame noise spikes
+# 'bilateral' - edge preserving smoothing of each frame on the 24x32 sensor grid
+# 'screen_bilateral' - bilateral filter on the upscaled image, very slow at full screen resolution
+FILTER_MODE = 'bilateral'
+FILTER_HISTORY = 5  # Frames kept for the temporal median
+FILTER_IIR_ALPHA = 0.3  # Weight of the newest frame in the running average
+FILTER_BILATERAL_SIGMA = 1.0  # Degrees C, bigger temperature steps are kept as edges
+
+# Render at this fraction of the screen resolution and let the fullscreen window stretch the image to the screen
+# 1.0 renders every screen pixel, 0.5 touches a quarter of the pixels per frame
+RENDER_SCALE = 1.0
+
+# Per stage frame timings (I2C read, normalize, interpolate, colorize, filter, text, imshow)
+# Number of frames kept for the p50/p95/p99 figures shown with the info overlay
+PROFILE_WINDOW = 256
+# Periodically write the timings to this file, .csv or .json. None disables the dump
+PROFILE_DUMP_FILE = None
+PROFILE_DUMP_INTERVAL = 10  # seconds
+
+# Seconds between updates of the numbers in the info overlay (temperatures, FPS, timings)
+HUD_REFRESH_INTERVAL = 0.5
+# Mark the hottest pixel with a crosshair and the coldest with a circle, toggled with CONTROL_TEMP_MARKERS
+SHOW_TEMP_MARKERS = False
 
 # Keyboard controll
 CONTROL_COLORMAP_NEXT = "d"
@@ -18,7 +62,43 @@ CONTROL_COLORMAP_PREV = "a"
 CONTROL_INTERPOLATION_NEXT = "w"
 CONTROL_INTERPOLATION_PREV = "s"
 CONTROL_FILTER_ENABLE_DISABLE = "f"
+CONTROL_FILTER_MODE = "g"
 CONTROL_DISPLAY_INFO = "i"
+CONTROL_TEMP_MARKERS = "m"
+CONTROL_TEMP_RANGE_LOCK = "l"
+CONTROL_RECORD = "r"
+
+# Raw temperature recordings (started/stopped with CONTROL_RECORD) are saved here
+RECORDING_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'recordings')
+
+# Read the sensor on a separate capture thread so the slow I2C transfer overlaps with image processing
+THREADED_CAPTURE = True
+# Number of raw frames buffered between the capture thread and the display, stale frames are dropped
+FRAME_RING_SIZE = 4
+# Step the sensor refresh rate between REFRESH_RATE_MIN and REFRESH_RATE_MAX (same values as CAM_REFRESH_RATE below)
+# to the fastest one that runs without I2C errors, starting at CAM_REFRESH_RATE
+ADAPTIVE_REFRESH_RATE = True
+REFRESH_RATE_MIN = 1
+# Never above CAM_REFRESH_RATE by default, 5 (16 Hz) is too much for most wiring (see CAM_REFRESH_RATE below).
+# Equal to CAM_REFRESH_RATE the controller only steps down on errors and back up again, it never probes faster.
+# 'python3 benchmark.py refresh' shows how it behaves against a simulated unstable sensor
+REFRESH_RATE_MAX = 4
+# Seconds the display loop waits for a late sensor frame before checking the keyboard again
+FRAME_WAIT_TIMEOUT = 0.02
+# Triggered temperature alarms (pithermalcam.alarms) save the image and raw temperatures here, None disables the snapshots
+ALARM_SNAPSHOT_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'alarms')
+
+# Keep a rolling temperature history here: full frames for HISTORY_FRAMES_RETENTION seconds, per-second and
+# per-minute min/max/mean grids (and region of interest stats) for longer. None disables the history
+HISTORY_FOLDER = None
+HISTORY_FRAMES_RETENTION = 600
+HISTORY_SECONDS_RETENTION = 6*3600
+HISTORY_MINUTES_RETENTION = 90*86400
+HISTORY_MAX_MB = 512  # The oldest data, finest first, is deleted to stay below this
+
+# Render on this many worker processes instead of the display process, 0 renders in place
+# 3-4 on a quad core Pi keeps the slow scipy interpolation modes up with the sensor, at one render time of extra latency
+RENDER_PROCESSES = 0
 
 # !!! DO NOT CHANGE FOLLOWING SETTINGS !!!
 
@@ -0,0 +1,278 @@
+"""Temperature alarm rules evaluated on every raw 24x32 frame.
+
+Rules are compiled into arrays (a stack of region masks, levels and debounce counts) and then
+checked together. One comparison of the frame against every level counts the hot pixels of
+all threshold rules ("any pixel above X", "hotspot of at least K pixels"), and one matrix
+product gives the region means behind the rate of rise rules. A rule triggers once its
+condition held for `frames` consecutive frames, and clears once it stayed below the
+hysteresis level for `clear_frames` frames, so a value hovering at the threshold doesn't flap.
+
+Events go to a background thread that logs them and runs the callbacks, so a slow handler
+never delays a frame. When its queue is full, events are dropped and counted. Snapshots of
+the image are copied by the caller and written by a SnapshotWriter, as in pi_therm_cam.
+"""
+import datetime as dt
+import logging
+import os
+import queue
+import threading
+import time
+import numpy as np
+from snapshot_writer import SnapshotWriter
+
+logger = logging.getLogger(__name__)
+
+ROWS, COLS = 24, 32
+
+RULE_PIXEL_ABOVE = 'pixel_above'  # Any pixel of the region above threshold
+RULE_HOTSPOT_AREA = 'hotspot_area'  # At least `pixels` pixels of the region above threshold
+RULE_MEAN_RISE = 'mean_rise'  # Region mean rising faster than rate C/s over the last `window` seconds
+RULE_KINDS = (RULE_PIXEL_ABOVE, RULE_HOTSPOT_AREA, RULE_MEAN_RISE)
+
+
+class AlarmEngine:
+    """Threshold, hotspot area and rate of rise rules with debounce and hysteresis, evaluated in one pass per frame."""
+
+    def __init__(self, shape:tuple = (ROWS, COLS), history:int = 64, queue_size:int = 64, snapshot_folder:str = None):
+        self.shape = shape
+        self.snapshot_folder = snapshot_folder  # Triggered alarms save the image and raw temperatures here if set
+        self._rules = []  # Rule dicts in evaluation order
+        self._callbacks = []
+        self._compiled = None
+        self._history = history
+        self._snapshot_writer = None
+        self._events = queue.Queue(queue_size)
+        self._thread = threading.Thread(target=self._run, name='alarm-events', daemon=True)
+        self._thread.start()
+        self.evaluations = 0
+        self.events_emitted = 0
+        self.events_dropped = 0
+        self._eval_ns = 0
+        self._eval_max_ns = 0
+
+    @property
+    def rules(self):
+        return [rule['name'] for rule in self._rules]
+
+    @property
+    def active(self):
+        """Names of the rules currently in the triggered state."""
+        if self._compiled is None:
+            return []
+        return [rule['name'] for rule, on in zip(self._rules, self._compiled['triggered']) if on]
+
+    def _region(self, region):
+        if region is None:
+            return np.ones(self.shape[0]*self.shape[1], dtype=bool)
+        region = np.asarray(region, dtype=bool)
+        if region.shape != self.shape:
+            raise ValueError(f"Region mask must have the sensor shape {self.shape}, got {region.shape}")
+        return region.reshape(-1)
+
+    def _add(self, name:str, kind:str, region, level:float, hysteresis:float, pixels:int, window:float,
+             frames:int, clear_frames:int):
+        if frames < 1 or clear_frames < 1:
+            raise ValueError("frames and clear_frames must be at least 1")
+        self.remove(name)
+        self._rules.append({'name': name, 'kind': kind, 'mask': self._region(region), 'level': float(level),
+                            'clear_level': float(level - hysteresis), 'pixels': int(pixels), 'window': float(window),
+                            'frames': int(frames), 'clear_frames': int(clear_frames)})
+        self._compiled = None
+
+    def add_pixel_above(self, name:str, threshold:float, frames:int = 1, region=None, hysteresis:float = 1.0,
+                        clear_frames:int = 1):
+        """Any pixel of region (a (24,32) bool mask, the whole frame by default) above threshold C for frames frames."""
+        self._add(name, RULE_PIXEL_ABOVE, region, threshold, hysteresis, 1, 0.0, frames, clear_frames)
+
+    def add_hotspot_area(self, name:str, threshold:float, pixels:int, frames:int = 1, region=None, hysteresis:float = 1.0,
+                         clear_frames:int = 1):
+        """At least pixels sensor pixels of region above threshold C for frames frames."""
+        self._add(name, RULE_HOTSPOT_AREA, region, threshold, hysteresis, max(1, pixels), 0.0, frames, clear_frames)
+
+    def add_mean_rise(self, name:str, rate:float, window:float = 2.0, frames:int = 1, region=None, hysteresis:float = None,
+                      clear_frames:int = 1):
+        """Mean of region rising faster than rate C/s, measured over the last window seconds. Clears below rate - hysteresis,
+        half the rate by default."""
+        self._add(name, RULE_MEAN_RISE, region, rate, rate/2 if hysteresis is None else hysteresis, 1, window,
+                  frames, clear_frames)
+
+    def remove(self, name:str):
+        if any(rule['name'] == name for rule in self._rules):
+            self._rules = [rule for rule in self._rules if rule['name'] != name]
+            self._compiled = None
+
+    def on_event(self, callback):
+        """Call callback(event) on the event thread for every triggered/cleared event."""
+        self._callbacks.append(callback)
+
+    def _compile(self):
+        rules = self._rules
+        threshold = np.array([i for i, rule in enumerate(rules) if rule['kind'] != RULE_MEAN_RISE], dtype=np.intp)
+        rise = np.array([i for i, rule in enumerate(rules) if rule['kind'] == RULE_MEAN_RISE], dtype=np.intp)
+        masks = np.stack([rule['mask'] for rule in rules]) if rules else np.zeros((0, self.shape[0]*self.shape[1]), bool)
+        column = lambda key, dtype: np.array([rule[key] for rule in rules], dtype=dtype)
+        levels = column('level', np.float64)
+        clear_levels = column('clear_level', np.float64)
+        self._compiled = {
+            'threshold': threshold,
+            'rise': rise,
+            # Every threshold rule twice, at its trigger level and at its clear level, to count both in one comparison
+            'masks2': np.concatenate([masks[threshold], masks[threshold]]),
+            # float32 halves the comparison, far finer than the sensor's noise anyway
+            'levels2': np.concatenate([levels[threshold], clear_levels[threshold]]).astype(np.float32)[:, None],
+            'frame32': np.zeros(self.shape[0]*self.shape[1], np.float32),
+            'hot': np.zeros((2*len(threshold), self.shape[0]*self.shape[1]), bool),
+            'pixels': column('pixels', np.int64)[threshold],
+            'rise_masks': masks[rise].astype(np.float64),
+            'rise_inverse_counts': 1/np.maximum(masks[rise].sum(axis=1), 1),
+            'rates': levels[rise],
+            'clear_rates': clear_levels[rise],
+            'windows': column('window', np.float64)[rise][:, None],
+            'rise_columns': np.arange(len(rise)),
+            'frames': column('frames', np.int64),
+            'clear_frames': column('clear_frames', np.int64),
+            'on_count': np.zeros(len(rules), np.int64),
+            'off_count': np.zeros(len(rules), np.int64),
+            'triggered': np.zeros(len(rules), bool),
+            'on': np.zeros(len(rules), bool),
+            'still_on': np.zeros(len(rules), bool),
+            'means': np.zeros((self._history, len(rise))),  # Ring of region means for the rise rules
+            'stamps': np.full(self._history, -np.inf),
+            'next': 0,
+        }
+
+    def evaluate(self, frame, timestamp:float = None, image=None):
+        """Check every rule against frame (768 temperatures in C, NaN pixels never count as hot).
+
+        Returns the list of events of this frame, each {'rule', 'kind', 'state': 'triggered'/'cleared', 'timestamp',
+        'value', 'frame'} with value the hottest pixel, the hot pixel count or the rise rate in C/s. Triggered events
+        save a snapshot of image (if given) and frame when snapshot_folder is set.
+        """
+        if not self._rules:
+            return []
+        t0 = time.perf_counter_ns()
+        if self._compiled is None:
+            self._compile()
+        c = self._compiled
+        timestamp = time.monotonic() if timestamp is None else timestamp
+        frame = np.asarray(frame).reshape(-1)
+        on, still_on = c['on'], c['still_on']
+        threshold, rise = c['threshold'], c['rise']
+        slopes = None
+        if len(threshold):
+            hot = c['hot']
+            np.copyto(c['frame32'], frame)
+            np.greater(c['frame32'], c['levels2'], out=hot)
+            np.logical_and(hot, c['masks2'], out=hot)
+            counts = hot.view(np.uint8).sum(axis=1, dtype=np.int32)
+            n = len(threshold)
+            on[threshold] = counts[:n] >= c['pixels']
+            still_on[threshold] = counts[n:] >= c['pixels']
+        if len(rise):
+            valid = ~np.isnan(frame)
+            if valid.all():
+                means = (c['rise_masks'] @ frame)*c['rise_inverse_counts']
+            else:
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    means = (c['rise_masks'] @ np.where(valid, frame, 0))/(c['rise_masks'] @ valid)
+            index = c['next']
+            c['means'][index] = means
+            c['stamps'][index] = timestamp
+            c['next'] = (index + 1) % self._history
+            # Oldest sample inside each rule's window, rates need at least half a window of history
+            ages = timestamp - c['stamps']
+            inside = ages[None, :] <= c['windows']
+            oldest = np.argmax(np.where(inside, ages[None, :], -1.0), axis=1)
+            span = ages[oldest]
+            enough = span >= c['windows'][:, 0]/2
+            slopes = (means - c['means'][oldest, c['rise_columns']])/np.maximum(span, 1e-9)
+            on[rise] = enough & (slopes > c['rates'])
+            still_on[rise] = enough & (slopes > c['clear_rates'])
+        # Debounce and hysteresis for every rule at once
+        c['on_count'] = np.where(on, c['on_count'] + 1, 0)
+        c['off_count'] = np.where(still_on, 0, c['off_count'] + 1)
+        triggered = c['triggered']
+        fire = ~triggered & (c['on_count'] >= c['frames'])
+        clear = triggered & (c['off_count'] >= c['clear_frames'])
+        events = []
+        if fire.any() or clear.any():
+            triggered ^= fire | clear
+            events = self._emit(np.flatnonzero(fire | clear), fire, frame, timestamp, image, slopes)
+        self.evaluations += 1
+        elapsed = time.perf_counter_ns() - t0
+        self._eval_ns += elapsed
+        self._eval_max_ns = max(self._eval_max_ns, elapsed)
+        return events
+
+    def _emit(self, indexes, fire, frame, timestamp:float, image, slopes):
+        rise = list(self._compiled['rise'])
+        events = []
+        saved_frame = frame.reshape(self.shape).copy()  # The caller's buffer is reused by the next frame
+        for i in indexes:
+            rule = self._rules[i]
+            if rule['kind'] == RULE_MEAN_RISE:
+                value = float(slopes[rise.index(i)])
+            elif rule['kind'] == RULE_HOTSPOT_AREA:
+                value = int(np.count_nonzero(rule['mask'] & (frame > rule['level'])))
+            else:
+                value = float(np.nanmax(np.where(rule['mask'], frame, -np.inf)))
+            event = {'rule': rule['name'], 'kind': rule['kind'], 'state': 'triggered' if fire[i] else 'cleared',
+                     'timestamp': timestamp, 'value': value, 'frame': saved_frame}
+            if fire[i] and self.snapshot_folder is not None:
+                self._snapshot(event, image)
+            try:
+                self._events.put_nowait(event)
+                self.events_emitted += 1
+            except queue.Full:
+                self.events_dropped += 1
+            events.append(event)
+        return events
+
+    def _snapshot(self, event:dict, image):
+        os.makedirs(self.snapshot_folder, exist_ok=True)
+        stamp = dt.datetime.now().strftime('%Y-%m-%d_%H-%M-%S-%f')[:-3]  # A rule can trigger again within a second
+        stem = os.path.join(self.snapshot_folder, f"alarm_{event['rule']}_{stamp}")
+        event['snapshot'] = stem
+        if image is None:
+            event['save_raw'] = True  # No image to save, the event thread writes the temperatures alone
+            return
+        if self._snapshot_writer is None:
+            self._snapshot_writer = SnapshotWriter(formats=('png',), save_raw=True)
+        self._snapshot_writer.submit(stem, image, event['frame'])
+
+    def _run(self):
+        while True:
+            event = self._events.get()
+            if event is None:
+                self._events.task_done()
+                break
+            try:
+                logger.warning("Alarm %s %s (%s) value %s", event['rule'], event['state'], event['kind'], event['value'])
+                if event.pop('save_raw', False):
+                    np.save(event['snapshot'] + '.npy', event['frame'])
+                for callback in self._callbacks:
+                    callback(event)
+            except Exception:
+                logger.exception("Alarm event handler failed for %s", event['rule'])
+            self._events.task_done()
+
+    def get_stats(self):
+        stats = {'alarm_rules': len(self._rules), 'alarms_active': self.active, 'alarm_evaluations': self.evaluations,
+                 'alarm_events': self.events_emitted, 'alarm_events_dropped': self.events_dropped,
+                 'alarm_eval_mean_us': self._eval_ns/self.evaluations/1e3 if self.evaluations else 0.0,
+                 'alarm_eval_max_us': self._eval_max_ns/1e3}
+        if self._snapshot_writer is not None:
+            stats.update(self._snapshot_writer.get_stats())
+        return stats
+
+    def flush(self):
+        """Block until every queued event was handled and every snapshot written."""
+        self._events.join()
+        if self._snapshot_writer is not None:
+            self._snapshot_writer.flush()
+
+    def close(self):
+        self._events.put(None)
+        self._thread.join()
+        if self._snapshot_writer is not None:
+            self._snapshot_writer.close()
@@ -0,0 +1,355 @@
+#!/usr/bin/python3
+"""Benchmarks for the thermal camera processing path. Runs without camera hardware.
+
+    python3 benchmark.py                       # micro benchmarks and the full pipeline sweep
+    python3 benchmark.py pipeline --modes 3 8 --resolutions 1920x1080 --no-filter
+"""
+import argparse
+import time
+import tracemalloc
+import numpy as np
+from fast_zoom import SeparableZoom
+
+
+def _fps(func, frames:int):
+    func()  # Warm up caches and lazily built state
+    t0 = time.perf_counter()
+    for _ in range(frames):
+        func()
+    return frames/(time.perf_counter() - t0)
+
+
+def bench_upscale(frames:int = 50):
+    """Compare scipy's ndimage.zoom with the precomputed separable bicubic zoom used by modes 7 and 8."""
+    from scipy import ndimage
+    rng = np.random.default_rng(0)
+    image = (rng.random((24,32))*255).astype(np.uint8)
+    print("Upscale 24x32 uint8 (modes 5/6 vs 7/8)")
+    for factor in (10, 25):
+        engine = SeparableZoom(factor)
+        output = np.zeros(engine.output_shape, dtype=np.uint8)
+        scipy_fps = _fps(lambda: ndimage.zoom(image, factor, output=output), frames)
+        fast_fps = _fps(lambda: engine.zoom(image, output=output), frames)
+        error = np.abs(ndimage.zoom(image, factor).astype(np.int16) - engine.zoom(image)).max()
+        print(f"  x{factor:<3} scipy {scipy_fps:8.1f} fps   separable {fast_fps:8.1f} fps   "
+              f"speedup {fast_fps/scipy_fps:5.1f}x   max abs diff {error}")
+
+
+def bench_render_scale(frames:int = 50, screensize:tuple = (1920,1080)):
+    """Cost of the final upscale to the screen at different RENDER_SCALE values, and cv2.remap for comparison."""
+    import cv2
+    rng = np.random.default_rng(0)
+    colored = (rng.random((24,32,3))*255).astype(np.uint8)
+    print(f"Colorized 24x32 to {screensize[0]}x{screensize[1]} screen")
+    for interpolation, name in ((cv2.INTER_LINEAR, 'linear'), (cv2.INTER_CUBIC, 'cubic')):
+        for scale in (1.0, 0.5, 0.25):
+            size = (int(screensize[0]*scale), int(screensize[1]*scale))
+            image = np.zeros((size[1],size[0],3), dtype=np.uint8)
+            resize_fps = _fps(lambda: cv2.resize(colored, size, dst=image, interpolation=interpolation), frames)
+            # Same geometry as cv2.resize expressed as precomputed remap maps
+            xs = ((np.arange(size[0]) + 0.5)*32/size[0] - 0.5).astype(np.float32)
+            ys = ((np.arange(size[1]) + 0.5)*24/size[1] - 0.5).astype(np.float32)
+            map1, map2 = cv2.convertMaps(np.tile(xs, (size[1],1)), np.tile(ys[:,None], (1,size[0])), cv2.CV_16SC2)
+            remap_fps = _fps(lambda: cv2.remap(colored, map1, map2, interpolation, dst=image,
+                                               borderMode=cv2.BORDER_REPLICATE), frames)
+            print(f"  {name:<6} scale {scale:<4} resize {resize_fps:8.1f} fps   remap {remap_fps:8.1f} fps   "
+                  f"{image.nbytes/1e6:5.2f} MB written per frame")
+
+
+def _make_camera(screensize:tuple, seed:int = 0):
+    """Build the kiosk camera class on a simulated sensor."""
+    import Settings
+    import denfilm_pi_thermal_cam
+    from frame_sources import SyntheticSource
+    Settings.DISPLAY_INFO_BY_DEFAULT = True  # Include the text overlay in the measured path
+    return denfilm_pi_thermal_cam.pithermalcam(frame_source=SyntheticSource(seed=seed, nan_rate=0.001), output_size=screensize)
+
+
+def _allocated_bytes_per_frame(camera, frames:int):
+    """Average peak of Python/numpy heap allocations made while rendering one frame."""
+    tracemalloc.start()
+    total = 0
+    for _ in range(frames):
+        base = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        camera.update_image_frame()
+        total += tracemalloc.get_traced_memory()[1] - base
+    tracemalloc.stop()
+    return total/frames
+
+
+def bench_pipeline(modes=None, colormaps=None, filters=(False, True), resolutions=((1920,1080),),
+                   frames:int = 10, csv_path:str = None):
+    """Sweep interpolation mode x colormap x filter x output resolution through update_image_frame()."""
+    rows = []
+    for screensize in resolutions:
+        camera = _make_camera(screensize)
+        for mode in (range(len(camera._interpolation_list)) if modes is None else modes):
+            for colormap in (range(len(camera._colormap_list)) if colormaps is None else colormaps):
+                for filter_image in filters:
+                    camera._interpolation_index = mode
+                    camera._colormap_index = colormap
+                    camera.filter_image = filter_image
+                    reallocations = camera._buffers.allocations
+                    fps = _fps(camera.update_image_frame, frames)
+                    alloc = _allocated_bytes_per_frame(camera, min(frames, 5))
+                    reallocations = camera._buffers.allocations - reallocations
+                    row = (f"{screensize[0]}x{screensize[1]}", camera._interpolation_list_name[mode],
+                           camera._colormap_list[colormap], filter_image, fps, alloc/1024, reallocations)
+                    rows.append(row)
+                    print("  {:<10} {:<22} {:<10} filter={!s:<5} {:8.1f} fps  {:8.1f} KB alloc/frame  "
+                          "{} buffer reallocs".format(*row))
+    if csv_path is not None:
+        with open(csv_path, 'w') as f:
+            f.write("resolution,interpolation,colormap,filter,fps,alloc_kb_per_frame,buffer_reallocations\n")
+            for row in rows:
+                f.write(",".join(str(v) for v in row) + "\n")
+    return rows
+
+
+def bench_filters(screensize:tuple = (1920,1080), modes=(3, 8), frames:int = 10):
+    """Full pipeline fps with each filter mode, the sensor resolution filters against the old screen bilateral."""
+    from sensor_filters import FILTER_MODES
+    camera = _make_camera(screensize)
+    print(f"Filter modes at {screensize[0]}x{screensize[1]}")
+    for mode in modes:
+        camera._interpolation_index = mode
+        camera.filter_image = False
+        baseline = _fps(camera.update_image_frame, frames)
+        print(f"  {camera._interpolation_list_name[mode]:<22} {'off':<17} {baseline:8.1f} fps")
+        camera.filter_image = True
+        for filter_mode in FILTER_MODES:
+            camera.filter_mode = filter_mode
+            fps = _fps(camera.update_image_frame, frames)
+            print(f"  {camera._interpolation_list_name[mode]:<22} {filter_mode:<17} {fps:8.1f} fps")
+
+
+def bench_multicam(cameras=(1, 2, 4), frames:int = 20, tile_size:tuple = (640,480), mode:int = 8):
+    """Frames rendered per second by N simulated sensors, with one render thread and with one per sensor."""
+    import os
+    import Settings
+    from frame_sources import SyntheticSource
+    from multi_camera import MultiCamera
+    Settings.DISPLAY_INFO_BY_DEFAULT = True
+    print(f"Multi camera, {tile_size[0]}x{tile_size[1]} tiles, {os.cpu_count()} cores")
+    for count in cameras:
+        for workers in sorted({1, count}):
+            multi = MultiCamera.from_sources([SyntheticSource(seed=i) for i in range(count)], tile_size, workers)
+            for camera in multi.cameras:
+                camera._interpolation_index = mode
+            fps = _fps(multi.update, frames)
+            multi.close()
+            print(f"  {count} sensors  {workers} workers  {fps:8.1f} composites/s  {fps*count:8.1f} camera frames/s")
+
+
+def _next_rendered_frame(camera):
+    """Pull and render until a new image comes out, waiting on the render processes if they are in use."""
+    rendered = camera._frames_rendered
+    while camera._frames_rendered == rendered:
+        camera.update_image_frame()
+        if camera._renderer is not None and camera._frames_rendered == rendered:
+            camera._renderer.poll(0.005)
+
+
+def bench_processes(screensize:tuple = (1920,1080), modes=(5, 8), processes=(0, 2, 4), frames:int = 20):
+    """Frames rendered per second in the display process (0) and on pools of render processes."""
+    import os
+    camera = _make_camera(screensize)
+    print(f"Render processes at {screensize[0]}x{screensize[1]}, {os.cpu_count()} cores")
+    for mode in modes:
+        camera._interpolation_index = mode
+        for count in processes:
+            if count:
+                camera.start_render_processes(count)
+            for _ in range(2*count + 1):
+                _next_rendered_frame(camera)  # Every worker imports scipy and builds its zoom matrices on its first frame
+            t0 = time.perf_counter()
+            for _ in range(frames):
+                _next_rendered_frame(camera)
+            fps = frames/(time.perf_counter() - t0)
+            stats = camera.get_pipeline_stats()
+            camera.stop_render_processes()
+            print(f"  {camera._interpolation_list_name[mode]:<22} {count} processes {fps:8.1f} fps"
+                  + (f"   {stats['render_late']} late" if count else ""))
+
+
+def bench_refresh(reads:int = 20000, unstable=(None, 4, 3), start_rate:int = 4, max_rate:int = 5):
+    """Where the adaptive refresh rate settles on a simulated sensor that fails above a given rate, on its simulated clock."""
+    import logging
+    from frame_sources import SyntheticSource, refresh_hz
+    from refresh_controller import RefreshRateController
+    logging.getLogger('refresh_controller').setLevel(logging.WARNING)  # Every step is logged
+    frame = np.zeros(24*32)
+    print(f"Adaptive refresh rate, {reads} reads starting at {refresh_hz(start_rate):g} Hz, max {refresh_hz(max_rate):g} Hz")
+    for unstable_above in unstable:
+        source = SyntheticSource(refresh_rate=start_rate, unstable_above=unstable_above)
+        controller = RefreshRateController(source, max_rate=max_rate, clock=source.clock)
+        reads_at = {}
+        probes = []  # Simulated times the controller stepped up
+        rate = source.refresh_rate
+        for _ in range(reads):
+            if source.refresh_rate > rate:
+                probes.append(source.sim_time)
+            rate = source.refresh_rate
+            reads_at[rate] = reads_at.get(rate, 0) + 1
+            try:
+                source.getFrame(frame)
+            except (ValueError, OSError, RuntimeError) as e:
+                source.sim_time += controller.frame_failed(e)  # The reader sleeps that long
+                continue
+            controller.frame_ok()
+        stats = controller.get_stats()
+        gaps = np.diff(probes)/60
+        reprobes = f"re-probes every {gaps[0]:.1f} to {gaps[-1]:.1f} min" if len(gaps) else "no re-probes"
+        share = '  '.join(f"{refresh_hz(rate):g} Hz {count/reads:4.0%}" for rate, count in sorted(reads_at.items()))
+        print(f"  unstable above {'-' if unstable_above is None else f'{refresh_hz(unstable_above):g} Hz':<6} "
+              f"settles at {stats['refresh_hz']:g} Hz   {stats['steps_up']} up / {stats['steps_down']} down "
+              f"in {source.sim_time/60:.0f} min, {reprobes}   errors {stats['retry_errors']}   reads: {share}")
+
+
+def bench_alarms(rules=(0, 12, 48), frames:int = 500):
+    """Cost per frame of evaluating the alarm rules, a third each of pixel above, hotspot area and rate of rise rules."""
+    import logging
+    from alarm_rules import AlarmEngine
+    from frame_sources import SyntheticSource
+    logging.getLogger('alarm_rules').setLevel(logging.ERROR)  # Every event is logged as a warning
+    source = SyntheticSource()
+    stream = np.zeros((frames, 24*32))
+    for frame in stream:
+        source.getFrame(frame)
+    print("Alarm rules per raw frame")
+    for count in rules:
+        engine = AlarmEngine()
+        rng = np.random.default_rng(0)
+        for i in range(count):
+            region = rng.random((24,32)) < 0.3
+            if i % 3 == 0:
+                engine.add_pixel_above(f'pixel{i}', 30 + i % 10, frames=3, region=region)
+            elif i % 3 == 1:
+                engine.add_hotspot_area(f'area{i}', 28 + i % 10, pixels=20, frames=3, region=region)
+            else:
+                engine.add_mean_rise(f'rise{i}', 0.5, window=1.0, region=region)
+        t0 = time.perf_counter()
+        for i, frame in enumerate(stream):
+            engine.evaluate(frame, i*0.125)
+        elapsed = time.perf_counter() - t0
+        stats = engine.get_stats()
+        engine.close()
+        print(f"  {count:3d} rules  {elapsed/frames*1e6:8.1f} us/frame   max {stats['alarm_eval_max_us']:8.1f} us   "
+              f"{stats['alarm_events']} events")
+
+
+def bench_history(frames:int = 4000, fps:float = 8.0):
+    """Cost of ThermalHistory.write() on the capture thread, and the disk used per tier, over a simulated stream."""
+    import shutil
+    import tempfile
+    from frame_sources import SyntheticSource
+    from roi_analytics import RoiAnalyzer
+    from thermal_history import ThermalHistory
+    folder = tempfile.mkdtemp(prefix='history_')
+    rois = RoiAnalyzer((640, 480))
+    rois.add_rect('left', 0, 0, 320, 480)
+    rois.add_spot('center', 320, 240)
+    history = ThermalHistory(folder, rois)
+    source = SyntheticSource()
+    frame = np.zeros(24*32)
+    t0 = time.time() - frames/fps  # Recent enough that retention keeps everything
+    elapsed = 0.0
+    for i in range(frames):
+        source.getFrame(frame)
+        t = time.perf_counter()
+        history.write(frame, t0 + i/fps)
+        elapsed += time.perf_counter() - t
+        if i % 128 == 127:
+            history.flush()  # The stream runs far faster than real time here, let the writer thread catch up
+    history.close()
+    stats = history.get_stats()
+    t = time.perf_counter()
+    result = history.query(t0, t0 + frames/fps, tier='seconds', columns=('max',))
+    query_ms = (time.perf_counter() - t)*1000
+    shutil.rmtree(folder)
+    print(f"History, {frames} frames at {fps:g} fps ({frames/fps/60:.1f} min)")
+    print(f"  write {elapsed/frames*1e6:8.1f} us/frame   rows dropped {stats['history_rows_dropped']}")
+    for tier in ('frames', 'seconds', 'minutes'):
+        print(f"  {tier:<8} {stats[f'history_{tier}_chunks']:4d} chunks {stats[f'history_{tier}_bytes']/1e3:9.1f} kB")
+    print(f"  query of every second's max grid {query_ms:6.1f} ms for {len(result['timestamp'])} rows")
+
+
+def bench_mjpeg(clients:int = 4, frames:int = 40):
+    """Loopback MJPEG stream from a simulated sensor: encodes per frame vs frames delivered to all clients."""
+    import http.client
+    import threading
+    from frame_sources import SyntheticSource
+    from pi_therm_cam import pithermalcam
+    camera = pithermalcam(frame_source=SyntheticSource(), threaded_capture=False)
+    server = camera.start_server(port=0, host='127.0.0.1')
+    received = [0]*clients
+
+    def client(index):
+        connection = http.client.HTTPConnection('127.0.0.1', server.port, timeout=10)
+        connection.request('GET', '/stream.mjpg')
+        response = connection.getresponse()
+        while received[index] < frames:
+            line = response.readline()
+            if line.startswith(b'Content-Length:'):
+                response.readline()
+                response.read(int(line.split(b':')[1]))
+                received[index] += 1
+        connection.close()
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    while server.broadcaster.clients < clients:
+        time.sleep(0.01)
+    t0 = time.perf_counter()
+    while any(thread.is_alive() for thread in threads):
+        camera.update_image_frame()
+        time.sleep(0.005)
+    elapsed = time.perf_counter() - t0
+    stats = server.broadcaster.get_stats()
+    camera.stop_server()
+    print(f"MJPEG loopback, {clients} clients")
+    print(f"  {stats['stream_frames_encoded']} frames encoded, {stats['stream_frames_sent']} sent, "
+          f"{min(received)/elapsed:.1f} fps per client")
+
+
+def _resolution(text:str):
+    width, height = text.lower().split('x')
+    return int(width), int(height)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('suites', nargs='*', default=['upscale', 'render_scale', 'pipeline'],
+                        help="upscale, render_scale, pipeline, filters, multicam, processes, refresh, alarms, history and/or mjpeg")
+    parser.add_argument('--modes', type=int, nargs='+', help="interpolation indexes to sweep (default all)")
+    parser.add_argument('--colormaps', type=int, nargs='+', help="colormap indexes to sweep (default all)")
+    parser.add_argument('--no-filter', action='store_true', help="skip the filtered runs of the pipeline sweep")
+    parser.add_argument('--resolutions', type=_resolution, nargs='+', default=[(800,600), (1920,1080)])
+    parser.add_argument('--frames', type=int, default=10)
+    parser.add_argument('--csv', help="also write the pipeline sweep to this CSV file")
+    args = parser.parse_args()
+
+    if 'upscale' in args.suites:
+        bench_upscale()
+    if 'render_scale' in args.suites:
+        bench_render_scale()
+    if 'pipeline' in args.suites:
+        print("Full pipeline on a simulated sensor")
+        bench_pipeline(args.modes, args.colormaps, (False,) if args.no_filter else (False, True),
+                       args.resolutions, args.frames, args.csv)
+    if 'filters' in args.suites:
+        bench_filters(args.resolutions[-1], args.modes or (3, 8), args.frames)
+    if 'multicam' in args.suites:
+        bench_multicam(frames=args.frames)
+    if 'processes' in args.suites:
+        bench_processes(args.resolutions[-1], args.modes or (5, 8), frames=args.frames)
+    if 'refresh' in args.suites:
+        bench_refresh()
+    if 'alarms' in args.suites:
+        bench_alarms()
+    if 'history' in args.suites:
+        bench_history()
+    if 'mjpeg' in args.suites:
+        bench_mjpeg()
@@ -0,0 +1,69 @@
+"""Precomputed colormap lookup tables.
+
+cmapy.cmap() builds a 256 entry LUT from matplotlib on every call. The cache builds each LUT
+once, keeps it as a contiguous uint8 array ready for cv2.applyColorMap and can persist the
+tables so later boots never import matplotlib at all.
+"""
+import logging
+import os
+import numpy as np
+import cv2
+
+logger = logging.getLogger(__name__)
+
+
+class ColormapCache:
+    """Colormap LUTs for a fixed list of cmapy colormap names, built lazily or loaded from disk."""
+
+    def __init__(self, names, cache_file:str = None):
+        self.names = list(names)
+        self.cache_file = cache_file
+        self._luts = [None]*len(self.names)
+        if cache_file is not None:
+            self._load()
+
+    def _load(self):
+        """Load previously built LUTs, ignoring the file if it was written for another colormap list."""
+        if not os.path.isfile(self.cache_file):
+            return
+        try:
+            with np.load(self.cache_file) as data:
+                if list(data['names']) != self.names:
+                    return
+                luts = data['luts']
+        except (OSError, ValueError, KeyError):
+            logger.warning("Colormap cache %s unreadable, rebuilding it", self.cache_file)
+            return
+        self._luts = [np.ascontiguousarray(lut) for lut in luts]
+
+    def save(self):
+        """Build any missing LUTs and write all of them to the cache file."""
+        if self.cache_file is None:
+            return
+        self.warm()
+        try:
+            np.savez(self.cache_file, names=np.array(self.names), luts=np.stack(self._luts))
+        except OSError:
+            logger.warning("Could not write colormap cache %s", self.cache_file)
+
+    @property
+    def complete(self):
+        return all(lut is not None for lut in self._luts)
+
+    def warm(self):
+        """Build every LUT now instead of on first use."""
+        for index in range(len(self.names)):
+            self.lut(index)
+
+    def lut(self, index:int):
+        """Return the (256,1,3) uint8 BGR LUT for the colormap at index."""
+        lut = self._luts[index]
+        if lut is None:
+            import cmapy  # Pulls in matplotlib, so only imported when a LUT really has to be built
+            lut = np.ascontiguousarray(cmapy.cmap(self.names[index]), dtype=np.uint8)
+            self._luts[index] = lut
+        return lut
+
+    def colorize(self, image, index:int, dst=None):
+        """Apply the colormap at index to a uint8 grayscale image."""
+        return cv2.applyColorMap(image, self.lut(index), dst=dst)
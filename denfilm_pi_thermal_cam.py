@@ -1,18 +1,34 @@
-import time,board,busio, traceback
+import time, traceback, os, threading
+_started = time.monotonic()  # Time to first frame is measured from here
 import numpy as np
-import adafruit_mlx90640
 import datetime as dt
 import cv2
-import cmapy
-from screeninfo import get_monitors
-from scipy import ndimage
-import pyautogui
 import Settings
+from frame_pipeline import FrameRing, CaptureThread
+from colormap_cache import ColormapCache
+from frame_buffers import FrameBufferPool
+from fast_zoom import SeparableZoom
+from stage_profiler import StageProfiler
+from frame_sources import MLX90640Source, SyntheticSource, refresh_hz
+from refresh_controller import RefreshRateController
+from temperature_range import TemperatureNormalizer
+from thermal_recording import RecordingWriter
+from hud_overlay import HudOverlay
+from roi_analytics import RoiAnalyzer
+from alarm_rules import AlarmEngine
+from sensor_filters import SensorFilter, FILTER_MODES, SENSOR_FILTER_MODES, FILTER_SCREEN_BILATERAL
+
+def get_screen_size():
+    """(width, height) of monitor MONITOR_INDEX. Needs a display, cameras given an output_size never call it"""
+    from screeninfo import get_monitors
+    monitor = get_monitors()[Settings.MONITOR_INDEX]
+    return monitor.width, monitor.height
 
 class pithermalcam:
     _colormap_list = Settings.COLORMAP_LIST
-    _interpolation_list = [cv2.INTER_NEAREST,cv2.INTER_LINEAR,cv2.INTER_AREA,cv2.INTER_CUBIC,cv2.INTER_LANCZOS4,5,6]
-    _interpolation_list_name = ['Nearest','Inter Linear','Inter Area','Inter Cubic','Inter Lanczos4','Pure Scipy','Scipy/CV2 Mixed']
+    _interpolation_list = [cv2.INTER_NEAREST,cv2.INTER_LINEAR,cv2.INTER_AREA,cv2.INTER_CUBIC,cv2.INTER_LANCZOS4,5,6,7,8]
+    _interpolation_list_name = ['Nearest','Inter Linear','Inter Area','Inter Cubic','Inter Lanczos4','Pure Scipy','Scipy/CV2 Mixed','Fast Scipy','Fast Scipy/CV2 Mixed']
+    _render_stages = frozenset(('raw','colormap','interpolation','filter','overlay'))
     _current_frame_processed=False  # Tracks if the current processed image matches the current raw image
     i2c=None
     mlx=None
@@ -20,97 +36,438 @@ class pithermalcam:
     _temp_max=None
     _raw_image=None
     _image=None
+    _base_image=None  # Processed image before the text overlay, kept so overlay changes don't reprocess it
+    _dirty=None
+    _rendered_settings=None
+    _window_created=False
     _displaying_onscreen=False
     _exit_requested=False
+    _frame_ring=None
+    _capture_thread=None
+    _colormap_cache=None
+    _buffers=None
+    _zoom_engines=None
+    _normalizer=None
+    _profiler=None
+    _recorder=None
+    _refresh_controller=None
+    _hud=None
+    _sensor_filter=None
+    _raw_frame_valid=False
+    _raw_timestamp=None  # time.monotonic() capture time of the newest valid raw frame
+    _rois=None
+    _alarms=None
+    _history=None
+    _renderer=None  # ProcessRenderer while rendering on worker processes
+    _frames_rendered=0
+    _yielded_timestamp=None  # Capture time of the last frame frames() yielded
+    time_to_first_frame=None
 
-    def __init__(self, filter_image:bool = False, image_width:int=1200, image_height:int=900):
+    def __init__(self, filter_image:bool = False, image_width:int=1200, image_height:int=900, frame_source=None,
+                 output_size:tuple=None, name:str=None):
+        self._dirty = set(self._render_stages)  # Render stages whose inputs changed since they last ran
+        self._rendered_settings = {}
         self.filter_image=filter_image
+        self.filter_mode=Settings.FILTER_MODE
+        self.frame_source=frame_source
+        self.output_size=output_size  # (width, height) of the displayed image, looked up from the screen if not given
+        self.name=name  # Tells several cameras apart in window titles and recording file names
+        self.window_name='Thermal Image' if name is None else f'Thermal Image {name}'
         self.image_width=image_width
         self.image_height=image_height
+        self.after_first_frame=[]  # Callables run on the warm up thread once the first frame is on screen
 
         self._colormap_index = Settings.DEFAULT_COLORMAP_INDEX
         self._interpolation_index = Settings.DEFAULT_INTERPOLATION_INDEX
+        self._buffers = FrameBufferPool()
+        self._zoom_engines = {}
+        self._normalizer = TemperatureNormalizer(Settings.TEMP_RANGE_MODE, Settings.TEMP_RANGE_SMOOTHING, Settings.TEMP_RANGE_HYSTERESIS,
+                                                 Settings.TEMP_RANGE_MIN_SPAN, Settings.TEMP_RANGE_LOCKED)
+        self._profiler = StageProfiler(window=Settings.PROFILE_WINDOW)
+        self._hud = HudOverlay(Settings.HUD_REFRESH_INTERVAL)
+        self._sensor_filter = SensorFilter(Settings.FILTER_MODE if Settings.FILTER_MODE in SENSOR_FILTER_MODES else SENSOR_FILTER_MODES[0],
+                                           Settings.FILTER_HISTORY, Settings.FILTER_IIR_ALPHA, Settings.FILTER_BILATERAL_SIGMA)
+        self._colormap_cache = ColormapCache(self._colormap_list, Settings.COLORMAP_CACHE_FILE)  # Missing LUTs are built after the first frame
         self._setup_therm_cam()
-        self._t0 = time.time()
+        if Settings.HISTORY_FOLDER is not None:
+            self.start_history()
         self.update_image_frame()
+        if Settings.RENDER_PROCESSES > 0:
+            self.start_render_processes(Settings.RENDER_PROCESSES)  # After the first frame, which is rendered here
 
     def __del__(self):
         print("ThermalCam Object deleted.")
 
     """Initialize the thermal camera"""
     def _setup_therm_cam(self):
-        # Setup camera
-        self.i2c = busio.I2C(board.SCL, board.SDA, frequency=Settings.I2C_FREQUENCY)  # setup I2C
-        self.mlx = adafruit_mlx90640.MLX90640(self.i2c)  # begin MLX90640 with I2C comm
-        self.mlx.refresh_rate = Settings.CAM_REFRESH_RATE  # set refresh rate
-        time.sleep(0.1)
+        # Setup camera, or use the given frame source (simulated or replayed sensor)
+        if self.frame_source is None:
+            self.frame_source = MLX90640Source(frequency=Settings.I2C_FREQUENCY, refresh_rate=Settings.CAM_REFRESH_RATE)
+        self.i2c = getattr(self.frame_source, 'i2c', None)
+        self.mlx = self.frame_source
+        if Settings.ADAPTIVE_REFRESH_RATE and isinstance(self.mlx, (MLX90640Source, SyntheticSource)):  # Not for replays
+            self._refresh_controller = RefreshRateController(self.mlx, Settings.REFRESH_RATE_MIN, Settings.REFRESH_RATE_MAX)
     
-    """Get mean temp of entire field of view. Return both temp C and temp F."""
+    """Start reading the sensor on a background thread into a ring buffer of raw frames"""
+    def start_capture(self):
+        if self._capture_thread is not None:
+            return
+        self._frame_ring = FrameRing(Settings.FRAME_RING_SIZE)
+        self._capture_thread = CaptureThread(self.mlx, self._frame_ring)
+        self._capture_thread.recorder = self._recorder
+        self._capture_thread.controller = self._refresh_controller
+        self._capture_thread.history = self._history
+        self._capture_thread.start()
+
+    """Stop the background capture thread, the sensor is read on demand again afterwards"""
+    def stop_capture(self):
+        if self._capture_thread is None:
+            return
+        self._capture_thread.stop()
+        self._capture_thread = None
+        self._frame_ring = None
+
+    """Render on a pool of worker processes from now on, the display process only reads, normalizes and shows frames.
+    Frames then appear one render time after their sensor read, but several render at once on a multi core Pi"""
+    def start_render_processes(self, processes:int):
+        if self._renderer is not None:
+            return
+        from process_renderer import ProcessRenderer
+        size = self._output_size()
+        self._renderer = ProcessRenderer(processes, (size[1], size[0], 3))
+
+    """Stop the render processes and render in this process again"""
+    def stop_render_processes(self):
+        renderer = self._renderer
+        if renderer is None:
+            return
+        self._renderer = None
+        renderer.close()
+        self._dirty.add('raw')  # The last frame handed to the workers may never have come back
+
+    """Start appending every raw sensor frame to a recording file, named by date in RECORDING_FOLDER by default"""
+    def start_recording(self, path:str = None):
+        if self._recorder is not None:
+            return self._recorder.path
+        if path is None:
+            os.makedirs(Settings.RECORDING_FOLDER, exist_ok=True)
+            prefix = 'rec_' if self.name is None else f'rec_{self.name}_'
+            path = os.path.join(Settings.RECORDING_FOLDER, prefix + dt.datetime.now().strftime('%Y-%m-%d_%H-%M-%S') + '.mlxr')
+        self._recorder = RecordingWriter(path, getattr(self.mlx, 'refresh_rate', Settings.CAM_REFRESH_RATE))
+        if self._capture_thread is not None:
+            self._capture_thread.recorder = self._recorder
+        print('Recording to', path)
+        return path
+
+    """Stop recording and flush the remaining frames to disk"""
+    def stop_recording(self):
+        recorder = self._recorder
+        if recorder is None:
+            return
+        self._recorder = None
+        if self._capture_thread is not None:
+            self._capture_thread.recorder = None
+        recorder.close()
+        print(f'Recording stopped: {recorder.frames_written} frames saved, {recorder.frames_dropped} dropped')
+
+    """Start keeping the temperature history of every raw frame in folder, HISTORY_FOLDER (per camera name) by default.
+    Query it with history.query(start, end)"""
+    def start_history(self, folder:str = None):
+        if self._history is not None:
+            return self._history
+        if folder is None:
+            folder = Settings.HISTORY_FOLDER if self.name is None else os.path.join(Settings.HISTORY_FOLDER, self.name)
+        from thermal_history import ThermalHistory
+        self._history = ThermalHistory(folder, self.rois, Settings.HISTORY_FRAMES_RETENTION, Settings.HISTORY_SECONDS_RETENTION,
+                                       Settings.HISTORY_MINUTES_RETENTION, Settings.HISTORY_MAX_MB*2**20)
+        if self._capture_thread is not None:
+            self._capture_thread.history = self._history
+        return self._history
+
+    """Store the partial chunks of the history and stop feeding it"""
+    def stop_history(self):
+        history = self._history
+        if history is None:
+            return
+        self._history = None
+        if self._capture_thread is not None:
+            self._capture_thread.history = None
+        history.close()
+
+    """The ThermalHistory started by start_history(), None if there is none"""
+    @property
+    def history(self):
+        return self._history
+
+    """Return capture/render stage counters: sensor fps, queue depth, dropped frames and errors"""
+    def get_pipeline_stats(self):
+        stats = {'threaded': self._capture_thread is not None, 'frames_rendered': self._frames_rendered,
+                 'time_to_first_frame': self.time_to_first_frame}
+        if self._capture_thread is not None:
+            stats.update(self._capture_thread.get_stats())
+        if self._refresh_controller is not None:
+            stats['refresh_controller'] = self._refresh_controller.get_stats()
+        if self._renderer is not None:
+            stats.update(self._renderer.get_stats())
+        if self._alarms is not None:
+            stats.update(self._alarms.get_stats())
+        if self._history is not None:
+            stats.update(self._history.get_stats())
+        return stats
+
+    """Return per stage p50/p95/p99 latencies in ms, the FPS and the dropped/errored frame counters"""
+    def get_profile_stats(self):
+        return self._profiler.get_stats()
+
+    """Get mean temp of entire field of view in C, from the newest raw frame the display already pulled"""
     def get_mean_temp(self):
-        frame = np.zeros((24*32,))  # setup array for storing all 768 temperatures
-        while True:
-            try:
-                self.mlx.getFrame(frame)  # read MLX temperatures into frame var
+        for _ in range(3):
+            if self._raw_timestamp is not None:
                 break
-            except ValueError:
-                continue  # if error, just read again
+            self._pull_raw_image(Settings.FRAME_WAIT_TIMEOUT)  # No good frame pulled yet, give the sensor a few tries
+        else:
+            return float('nan')
+        return float(np.nanmean(self._buffers.get('temps', (24*32,), np.float64)))
+
+    """Regions of interest in screen coordinates, evaluated by get_roi_stats(), e.g. rois.add_rect('door', 100, 50, 300, 400)"""
+    @property
+    def rois(self):
+        if self._rois is None:
+            self._rois = RoiAnalyzer(self._display_size())
+        return self._rois
 
-        return np.mean(frame)
+    """Min/max/mean/percentile temperatures of every region of interest on the newest raw frame, with its capture time.
+    Reads no sensor data, so it can be polled every frame."""
+    def get_roi_stats(self):
+        if self._raw_timestamp is None:
+            return self.rois.analyze(np.full(24*32, np.nan))
+        return self.rois.analyze(self._buffers.get('temps', (24*32,), np.float64), self._raw_timestamp)
     
+    """Temperature alarm rules checked on every raw frame, e.g. alarms.add_pixel_above('overheat', 80, frames=3,
+    region=rois.mask('motor')). Events are logged, passed to alarms.on_event() callbacks and snapshotted in the background"""
+    @property
+    def alarms(self):
+        if self._alarms is None:
+            self._alarms = AlarmEngine(snapshot_folder=Settings.ALARM_SNAPSHOT_FOLDER)
+        return self._alarms
+
     """Get one pull of the raw image data, converting temp units if necessary"""
-    def _pull_raw_image(self):
+    def _pull_raw_image(self, timeout:float = 0.0):
         # Get image
-        self._raw_image = np.zeros((24*32,))
+        frame = self._buffers.get('raw', (24*32,), np.float64)
+        t = self._profiler.now()
         try:
-            self.mlx.getFrame(self._raw_image)  # read mlx90640
-            self._temp_min = np.min(self._raw_image)
-            self._temp_max = np.max(self._raw_image)
-            self._raw_image=self._temps_to_rescaled_uints(self._raw_image,self._temp_min,self._temp_max)
-            self._current_frame_processed=False  # Note that the newly updated raw frame has not been processed
-        except ValueError:
+            capture = self._capture_thread
+            if capture is not None:
+                got_frame = self._frame_ring.read_latest(frame, timeout)
+                # The failed reads happen on the capture thread, also count them while the sensor keeps failing
+                self._profiler.error_frames = capture.value_errors + capture.io_errors + capture.retry_errors
+                if not got_frame:
+                    capture.raise_if_failed()  # A sensor error the capture thread couldn't recover from
+                    return  # No new sensor frame since the last pull, keep rendering the current one
+                self._profiler.dropped_frames = self._frame_ring.frames_dropped
+                timestamp = self._frame_ring.read_timestamp
+            else:
+                self.mlx.getFrame(frame)  # read mlx90640
+                timestamp = time.monotonic()
+                if self._refresh_controller is not None:
+                    self._refresh_controller.frame_ok()
+                if self._recorder is not None:
+                    self._recorder.write(frame)
+                if self._history is not None:
+                    self._history.write(frame)
+            self._profiler.lap('i2c_read', t)
+            # Untouched copy for the analytics, normalizing replaces NaN pixels in frame
+            temps = self._buffers.get('temps', (24*32,), np.float64)
+            np.copyto(temps, frame)
+            self._raw_timestamp = timestamp
+            if self._alarms is not None and self._alarms.rules:
+                t = self._profiler.now()
+                self._alarms.evaluate(temps, timestamp, self._image)  # Snapshots show the last rendered image
+                self._profiler.lap('alarms', t)
+            self._sensor_filter.push(frame)  # Keep the filter history current even while filtering is off
+            self._raw_frame_valid = True
+            self._normalize_raw_image()
+        except ValueError as e:
             print("Math error; continuing...")
-            self._raw_image = np.zeros((24*32,))  # If something went wrong, make sure the raw image has numbers
-        except OSError:
+            self._profiler.error_frames += 1
+            self._raw_frame_valid = False
+            self._raw_image = self._blank_raw_image()  # If something went wrong, make sure the raw image has numbers
+            self._report_read_error(e)
+        except OSError as e:
             print("IO Error; continuing...")
-            self._raw_image = np.zeros((24*32,))  # If something went wrong, make sure the raw image has numbers
+            self._profiler.error_frames += 1
+            self._raw_frame_valid = False
+            self._raw_image = self._blank_raw_image()  # If something went wrong, make sure the raw image has numbers
+            self._report_read_error(e)
+        self._dirty.add('raw')
+        self._current_frame_processed=False  # Note that the newly updated raw frame has not been processed
+
+    """Tell the refresh rate controller about a failed direct sensor read and back off as long as it asks to"""
+    def _report_read_error(self, error):
+        if self._refresh_controller is not None and self._capture_thread is None:
+            time.sleep(self._refresh_controller.frame_failed(error))
+
+    """Filter the raw temperatures at sensor resolution if enabled, then rescale them to the 8 bit raw image"""
+    def _normalize_raw_image(self):
+        frame = self._buffers.get('raw', (24*32,), np.float64)
+        t = self._profiler.now()
+        if self.filter_image and self.filter_mode in SENSOR_FILTER_MODES:
+            self._sensor_filter.mode = self.filter_mode
+            filtered = self._buffers.get('filtered_raw', (24*32,), np.float64)
+            if self._sensor_filter.apply(filtered):
+                frame = filtered
+            t = self._profiler.lap('filter', t)
+        self._raw_image=self._temps_to_rescaled_uints(frame)
+        self._temp_min = self._normalizer.frame_min
+        self._temp_max = self._normalizer.frame_max
+        self._profiler.lap('normalize', t)
+
+    """Reset the rescaled raw image buffer to zeros"""
+    def _blank_raw_image(self):
+        norm = self._buffers.get('norm', (24,32), np.uint8)
+        norm.fill(0)
+        return norm
     
-    """Process the raw temp data to a colored image. Filter if necessary"""
-    def _process_raw_image(self):
-        # Image processing
+    """Process the raw temp data to a colored image. Filter if necessary. Only the stages in dirty are re-run, all by default"""
+    def _process_raw_image(self, dirty=None):
+        # Image processing, every stage writes into a preallocated buffer that is kept for the next render
         # Can't apply colormap before ndimage, so reversed in first two options, even though it seems slower
-        if self._interpolation_index==5:  # Scale via scipy only - slowest but seems higher quality
-            self._image = ndimage.zoom(self._raw_image,25)  # interpolate with scipy
-            self._image = cv2.applyColorMap(self._image, cmapy.cmap(self._colormap_list[self._colormap_index]))
-            self._image = cv2.resize(self._image, (screensize[0],screensize[1]), interpolation=cv2.INTER_CUBIC)
-        elif self._interpolation_index==6:  # Scale partially via scipy and partially via cv2 - mix of speed and quality
-            self._image = ndimage.zoom(self._raw_image,10)  # interpolate with scipy
-            self._image = cv2.applyColorMap(self._image, cmapy.cmap(self._colormap_list[self._colormap_index]))
-            self._image = cv2.resize(self._image, (screensize[0],screensize[1]), interpolation=cv2.INTER_CUBIC)
-        else:
-            self._image = cv2.applyColorMap(self._raw_image, cmapy.cmap(self._colormap_list[self._colormap_index]))
-            self._image = cv2.resize(self._image, (screensize[0],screensize[1]), interpolation=self._interpolation_list[self._interpolation_index])
+        dirty = self._render_stages if dirty is None else dirty
+        self._hud.restore()  # The cached stage outputs must not contain the previous overlay
+        size = self._output_size()
+        image = self._buffers.get('image', (size[1],size[0],3), np.uint8)
+        profiler = self._profiler
+        t = profiler.now()
+        if self._interpolation_index in (5,6,7,8):
+            # 5 - Scale via scipy only - slowest but seems higher quality
+            # 6 - Scale partially via scipy and partially via cv2 - mix of speed and quality
+            # 7, 8 - Same as 5 and 6 with the scipy spline replaced by two precomputed matrix products
+            factor = 25 if self._interpolation_index in (5,7) else 10
+            zoomed = self._buffers.get('zoom', (24*factor,32*factor), np.uint8)
+            if 'raw' in dirty or 'interpolation' in dirty:
+                if self._interpolation_index in (7,8):
+                    self._get_zoom_engine(factor).zoom(self._raw_image, output=zoomed)
+                else:
+                    from scipy import ndimage  # Only modes 5 and 6 need scipy, importing it takes seconds on a Pi
+                    ndimage.zoom(self._raw_image, factor, output=zoomed)  # interpolate with scipy
+            t_zoomed = profiler.now()  # A colormap change alone reuses the zoomed image
+            if not dirty.isdisjoint(('raw','colormap','interpolation')):
+                if zoomed.shape==image.shape[:2]:  # Spline already produced the output size, resize once means not at all
+                    self._colormap_cache.colorize(zoomed, self._colormap_index, dst=image)
+                    t = profiler.lap('colorize', t_zoomed)
+                    profiler.record('interpolate', t_zoomed - t)
+                else:
+                    colored = self._buffers.get('colored', zoomed.shape+(3,), np.uint8)
+                    self._colormap_cache.colorize(zoomed, self._colormap_index, dst=colored)
+                    t_colored = profiler.lap('colorize', t_zoomed)
+                    cv2.resize(colored, size, dst=image, interpolation=cv2.INTER_CUBIC)
+                    t_resized = profiler.now()
+                    profiler.record('interpolate', (t_zoomed - t) + (t_resized - t_colored))
+                    t = t_resized
+        elif not dirty.isdisjoint(('raw','colormap','interpolation')):
+            colored = self._buffers.get('colored', (24,32,3), np.uint8)
+            self._colormap_cache.colorize(self._raw_image, self._colormap_index, dst=colored)
+            t = profiler.lap('colorize', t)
+            cv2.resize(colored, size, dst=image, interpolation=self._interpolation_list[self._interpolation_index])
+            t = profiler.lap('interpolate', t)
         #self._image = cv2.flip(self._image, 1)
-        if self.filter_image:
-            self._image=cv2.bilateralFilter(self._image,15,80,80)
-    
-    """Set image text content"""
+        if self.filter_image and self.filter_mode == FILTER_SCREEN_BILATERAL:
+            filtered = self._buffers.get('filtered', image.shape, np.uint8)
+            if not dirty.isdisjoint(('raw','colormap','interpolation','filter')):
+                cv2.bilateralFilter(image, 15, 80, 80, dst=filtered)
+                profiler.lap('filter', t)
+            image = filtered
+        self._base_image = image
+        self._image = image
+
+    """Size of the displayed image, output_size if given, otherwise the screen"""
+    def _display_size(self):
+        if self.output_size is None:
+            self.output_size = get_screen_size()
+        return self.output_size
+
+    """Size of the rendered image. Below RENDER_SCALE 1 the fullscreen window stretches it to the display size"""
+    def _output_size(self):
+        size = self._display_size()
+        return (max(32, int(size[0]*Settings.RENDER_SCALE)), max(24, int(size[1]*Settings.RENDER_SCALE)))
+
+    """Return the separable bicubic zoom engine for a factor, building its weight matrices on first use"""
+    def _get_zoom_engine(self, factor):
+        engine = self._zoom_engines.get(factor)
+        if engine is None:
+            engine = self._zoom_engines[factor] = SeparableZoom(factor)
+        return engine
+
+    """Set image text content and markers. Only the pixels under them are touched, and saved so they can be restored"""
     def _add_image_text(self):
+        hud = self._hud
+        hud.begin(self._base_image)
+        self._image = self._base_image
+        if not (Settings.DISPLAY_INFO_BY_DEFAULT or Settings.SHOW_TEMP_MARKERS):
+            return
+        t = self._profiler.now()
+        scale = Settings.RENDER_SCALE  # Keep the text the same size on screen whatever the render size
         if Settings.DISPLAY_INFO_BY_DEFAULT:
-            text = f'Tmin={self._temp_min:+.1f}C - Tmax={self._temp_max:+.1f}C - FPS={1/(time.time() - self._t0):.1f} - Interpolation: {self._interpolation_list_name[self._interpolation_index]} - Colormap: {self._colormap_list[self._colormap_index]} - Filtered: {self.filter_image}'
-            cv2.putText(self._image, text, (50, 50), cv2.FONT_HERSHEY_SIMPLEX, .8, (255, 255, 255), 2)
-            self._t0 = time.time()  # Update time to this pull
-    
-    """Resize image window and display it""" 
+            # Numbers refresh every HUD_REFRESH_INTERVAL, the names only change on key presses, both come from the tile cache
+            segments = [hud.field('temps', lambda: f'Tmin={self._temp_min:+.1f}C - Tmax={self._temp_max:+.1f}C'),
+                        hud.field('fps', lambda: f' - FPS={self._profiler.fps:.1f}'),
+                        f' - Interpolation: {self._interpolation_list_name[self._interpolation_index]}',
+                        f' - Colormap: {self._colormap_list[self._colormap_index]}',
+                        f' - Filtered: {self.filter_mode if self.filter_image else False}']
+            if self._capture_thread is not None:
+                segments.append(hud.field('sensor', lambda: f' - Sensor FPS={self._capture_thread.fps:.1f} - Dropped: {self._frame_ring.frames_dropped}'))
+            hud.text(segments, (int(50*scale), int(50*scale)), .8*scale, max(1, round(2*scale)))
+            # Per stage latencies under the main line
+            for i, line in enumerate(hud.field('profile', self._profiler.summary_lines)):
+                hud.text((line,), (int(50*scale), int((90+30*i)*scale)), .6*scale, max(1, round(scale)))
+        if Settings.SHOW_TEMP_MARKERS and self._normalizer.max_pos is not None:
+            size = max(4, int(20*scale))
+            hot = self._sensor_to_image(self._normalizer.max_pos)
+            cold = self._sensor_to_image(self._normalizer.min_pos)
+            hud.crosshair(hot, size, thickness=max(1, round(2*scale)))
+            hud.marker(cold, size//2, thickness=max(1, round(scale)))
+            self._add_marker_label(hot, size, hud.field('hot', lambda: f'{self._temp_max:.1f}C'), scale)
+            self._add_marker_label(cold, size, hud.field('cold', lambda: f'{self._temp_min:.1f}C'), scale)
+        self._profiler.lap('text', t)
+
+    """Label a marker above and to the right of it, or to the left near the right edge of the image"""
+    def _add_marker_label(self, pos, size, text, scale):
+        font_scale, thickness = .6*scale, max(1, round(scale))
+        x = pos[0] + size
+        if pos[0] > self._base_image.shape[1]*3//4:
+            x = pos[0] - size - self._hud.tile(text, font_scale, thickness).advance
+        self._hud.text((text,), (x, max(pos[1] - size, int(20*scale))), font_scale, thickness)
+
+    """Image pixel (x, y) at the center of a sensor (row, col) pixel"""
+    def _sensor_to_image(self, pos):
+        height, width = self._base_image.shape[:2]
+        return int((pos[1] + .5)*width/32), int((pos[0] + .5)*height/24)
+
+    """Create the fullscreen image window, once"""
+    def _setup_window(self):
+        if self._window_created:
+            return
+        cv2.namedWindow(self.window_name, cv2.WINDOW_NORMAL)
+        cv2.setWindowProperty (self.window_name, cv2.WND_PROP_FULLSCREEN, cv2.WINDOW_FULLSCREEN);
+        self._window_created = True
+
+    """Display the processed image""" 
     def _show_processed_image(self):             
-        cv2.namedWindow('Thermal Image', cv2.WINDOW_NORMAL)
-        cv2.setWindowProperty ("Thermal Image", cv2.WND_PROP_FULLSCREEN, cv2.WINDOW_FULLSCREEN);
-        cv2.imshow('Thermal Image', self._image)
+        self._setup_window()
+        t = self._profiler.now()
+        cv2.imshow(self.window_name, self._image)
+        self._profiler.lap('imshow', t)
         
     """Add keyboard actions to image"""
-    def _set_click_keyboard_events(self):
-        # Set keyboard events
-        key = cv2.waitKey(1) & 0xFF
+    def _set_click_keyboard_events(self, delay:int = 1):
+        # Set keyboard events, waiting up to delay ms for a key press
+        self.handle_key(cv2.waitKey(delay) & 0xFF)
 
+    """Act on a key press. With several cameras, the options shared through Settings are only toggled by the first one"""
+    def handle_key(self, key:int, toggle_settings:bool = True):
+        if key in (ord(Settings.CONTROL_DISPLAY_INFO), ord(Settings.CONTROL_TEMP_MARKERS)) and not toggle_settings:
+            return
         if key == ord(Settings.CONTROL_COLORMAP_NEXT):
             self.change_colormap()
         elif key == ord(Settings.CONTROL_COLORMAP_PREV):
@@ -123,8 +480,20 @@ class pithermalcam:
             Settings.DISPLAY_INFO_BY_DEFAULT = not Settings.DISPLAY_INFO_BY_DEFAULT
         elif key == ord(Settings.CONTROL_FILTER_ENABLE_DISABLE):
             self.filter_image = not self.filter_image
+        elif key == ord(Settings.CONTROL_FILTER_MODE):
+            self.change_filter_mode()
+        elif key == ord(Settings.CONTROL_TEMP_MARKERS):
+            Settings.SHOW_TEMP_MARKERS = not Settings.SHOW_TEMP_MARKERS
+        elif key == ord(Settings.CONTROL_TEMP_RANGE_LOCK):
+            self.toggle_temp_range_lock()
+        elif key == ord(Settings.CONTROL_RECORD):
+            if self._recorder is None:
+                self.start_recording()
+            else:
+                self.stop_recording()
         elif key==27:
             cv2.destroyAllWindows()
+            self._window_created = False
             self._displaying_onscreen = False
             self._exit_requested=True
     
@@ -137,7 +506,11 @@ class pithermalcam:
         print(Settings.CONTROL_INTERPOLATION_NEXT + " - Interpolation Next")
         print(Settings.CONTROL_INTERPOLATION_PREV + " - Interpolation Previous")
         print(Settings.CONTROL_FILTER_ENABLE_DISABLE + " - Toggle Filtering On/Off")
+        print(Settings.CONTROL_FILTER_MODE + " - Filter Mode Next")
         print(Settings.CONTROL_DISPLAY_INFO + " - Display Info")
+        print(Settings.CONTROL_TEMP_MARKERS + " - Show/Hide Hottest and Coldest Pixel Markers")
+        print(Settings.CONTROL_TEMP_RANGE_LOCK + " - Lock/Unlock Color Temperature Range")
+        print(Settings.CONTROL_RECORD + " - Start/Stop Recording Raw Temperatures")
     
     """Display the camera live to the display"""
     def display_next_frame_onscreen(self):    
@@ -145,9 +518,46 @@ class pithermalcam:
         if not self._displaying_onscreen:
             self._print_shortcuts_keys()
             self._displaying_onscreen = True
-        self.update_image_frame()
-        self._show_processed_image()
-        self._set_click_keyboard_events()
+        # Only redisplay when a new sensor frame or a key press changed something, then sleep in waitKey until
+        # the next sensor frame is due. A key press ends the wait at once.
+        if self._capture_thread is not None:
+            self._pull_raw_image(Settings.FRAME_WAIT_TIMEOUT)
+        else:
+            self._pull_raw_image()
+        if self._render_dirty_stages():
+            self._show_processed_image()
+            if self.time_to_first_frame is None:
+                self.time_to_first_frame = time.monotonic() - _started
+                print(f'First frame on screen after {self.time_to_first_frame:.2f}s')
+                self._start_background_warmup()
+        self._set_click_keyboard_events(self._ms_until_next_frame())
+
+    """Build the remaining colormap LUTs and zoom matrices on a background thread, so switching modes later doesn't stall"""
+    def _start_background_warmup(self):
+        def warm_up():
+            t = time.monotonic()
+            for factor in (25, 10):
+                self._get_zoom_engine(factor)
+            if Settings.COLORMAP_CACHE_FILE is not None and not self._colormap_cache.complete:
+                self._colormap_cache.save()  # Build every LUT once so later starts load them from disk
+            else:
+                self._colormap_cache.warm()
+            for task in self.after_first_frame:
+                task()
+            print(f'Background warm up done in {time.monotonic() - t:.2f}s')
+        threading.Thread(target=warm_up, name='warm-up', daemon=True).start()
+
+    """Milliseconds until the capture thread should have the next sensor frame, at least 1"""
+    def _ms_until_next_frame(self):
+        if self._capture_thread is None or self._dirty:
+            return 1  # Reading the sensor directly already blocks until its next frame
+        if self._renderer is not None and self._renderer.pending:
+            return 5  # Check for frames finished by the render processes
+        fps = self._capture_thread.fps
+        period = 1/fps if fps > 0 else 2/refresh_hz(getattr(self.mlx, 'refresh_rate', Settings.CAM_REFRESH_RATE))
+        last = self._frame_ring.latest_timestamp
+        remaining = period if last is None else last + period - time.monotonic()
+        return max(1, min(int(remaining*1000), int(period*1000)))
     
     """Cycle colormap. Forward by default, backwards if param set to false."""
     def change_colormap(self, forward:bool = True):      
@@ -159,6 +569,10 @@ class pithermalcam:
             self._colormap_index-=1
             if self._colormap_index<0:
                 self._colormap_index=len(self._colormap_list)-1
+    """Cycle filter mode (temporal IIR, temporal median, sensor bilateral, screen bilateral) and turn filtering on"""
+    def change_filter_mode(self):
+        self.filter_mode = FILTER_MODES[(FILTER_MODES.index(self.filter_mode) + 1) % len(FILTER_MODES)]
+        self.filter_image = True
     """Cycle interpolation. Forward by default, backwards if param set to false."""
     def change_interpolation(self, forward:bool = True):
         if forward:
@@ -173,11 +587,151 @@ class pithermalcam:
     """Pull raw temperature data, process it to an image, and update image text"""
     def update_image_frame(self):
         self._pull_raw_image()
-        self._process_raw_image()
+        self._render_dirty_stages()
+        return self._image
+
+    """Re-run the render stages whose inputs changed since the last render. Returns False if nothing changed"""
+    def _render_dirty_stages(self):
+        # Settings can also be changed by assigning the attributes directly, so compare against the last render
+        size = self._output_size()
+        settings = {'colormap': self._colormap_index, 'interpolation': (self._interpolation_index, size),
+                    'filter': (self.filter_image, self.filter_mode), 'overlay': (Settings.DISPLAY_INFO_BY_DEFAULT, Settings.SHOW_TEMP_MARKERS)}
+        for stage, value in settings.items():
+            if self._rendered_settings.get(stage) != value:
+                self._dirty.add(stage)
+        if not self._dirty and (self._renderer is None or not self._renderer.pending):
+            return False
+        if 'filter' in self._dirty and 'raw' not in self._dirty and self._raw_frame_valid and \
+                self._sensor_filter_in_use(self._rendered_settings.get('filter')) != self._sensor_filter_in_use(settings['filter']):
+            # Sensor resolution filters work on the raw temperatures, rescale the current frame again
+            self._normalize_raw_image()
+            self._dirty.add('raw')
+        if self._renderer is not None:
+            if not self._render_in_processes(settings):
+                return False
+        elif self._dirty != {'overlay'}:
+            self._process_raw_image(self._dirty)
         self._add_image_text()
+        self._dirty.clear()
+        self._rendered_settings = settings
         self._current_frame_processed=True
-        return self._image
+        self._frames_rendered+=1
+        self._profiler.end_frame()
+        self._profiler.maybe_dump(Settings.PROFILE_DUMP_FILE, Settings.PROFILE_DUMP_INTERVAL)
+        return True
     
+    """Take the newest image the render processes finished and hand them the changed frame.
+    Returns False if no new image is ready and the overlay didn't change either"""
+    def _render_in_processes(self, settings):
+        size = settings['interpolation'][1]
+        renderer = self._renderer
+        if renderer.shape[:2] != (size[1], size[0]):
+            self.stop_render_processes()  # The shared image slots have the old size
+            self.start_render_processes(renderer.processes)
+            renderer = self._renderer
+        ready = renderer.poll()
+        if ready:
+            self._hud.restore()  # The finished image replaces the one under the overlay
+            image = self._buffers.get('image', (size[1],size[0],3), np.uint8)
+            renderer.collect(image)  # Frees a slot for the submit below
+            self._base_image = image
+        if self._dirty - {'overlay'}:
+            params = (self._interpolation_index, self._colormap_index, self.filter_image, self.filter_mode)
+            if not renderer.submit(self._raw_image, params):
+                return False  # Every worker is busy, submit again on the next call
+            self._dirty &= {'overlay'}
+            # The workers have these settings now, only the overlay is still drawn here
+            self._rendered_settings = dict(settings, overlay=self._rendered_settings.get('overlay'))
+        return ready or ('overlay' in self._dirty and self._base_image is not None)
+
+    """Sensor resolution filter mode applied for a (filter_image, filter_mode) setting, None if none is"""
+    @staticmethod
+    def _sensor_filter_in_use(setting):
+        if setting is None or not setting[0] or setting[1] not in SENSOR_FILTER_MODES:
+            return None
+        return setting[1]
+    
+    """Yield (frame, info) for every new frame, without a window. frame is the processed BGR image at output_size, or
+    the (24,32) temperatures in C with raw=True. Both arrays are overwritten by the next frame, copy them to keep them.
+    Stops after count frames or when a finite source (a replay without loop) runs out, runs forever by default.
+    Without a capture thread the next frame is only read once the last one was yielded, so none is skipped"""
+    def frames(self, count:int = None, raw:bool = False, output_size:tuple = None):
+        if output_size is not None:
+            self.output_size = output_size
+        index = 0
+        if self._raw_frame_valid and self._raw_timestamp != self._yielded_timestamp:
+            self._dirty.add('raw')  # The frame read in the constructor (or since the last call) wasn't yielded yet
+        exhausted = False
+        while count is None or index < count:
+            capture = self._capture_thread
+            if capture is not None and capture.exhausted and not self._frame_ring.depth:
+                exhausted = True
+            if raw:
+                done = self._raw_timestamp == self._yielded_timestamp
+            else:
+                done = 'raw' not in self._dirty and (self._renderer is None or not self._renderer.pending)
+            if exhausted and done:
+                return
+            # The capture thread's ring drops stale images anyway, a direct read waits until the last frame is out
+            if not exhausted and (done or capture is not None and not raw):
+                try:
+                    self._pull_raw_image(Settings.FRAME_WAIT_TIMEOUT if capture is not None else 0.0)
+                except EOFError:
+                    exhausted = True
+                    continue
+                # Catch a common I2C Error. If you get this too often consider checking/adjusting your I2C Baudrate
+                except RuntimeError as e:
+                    if str(e) != 'Too many retries':
+                        raise
+                    print("Too many retries error caught, potential I2C baudrate issue: continuing...")
+                    self._profiler.error_frames += 1
+                    self._report_read_error(e)
+                    continue
+            if raw:
+                if self._raw_timestamp == self._yielded_timestamp:
+                    continue  # No new good sensor frame yet
+                frame = self._buffers.get('temps', (24*32,), np.float64).reshape(24,32)
+            elif self._render_dirty_stages():
+                frame = self._image
+            else:
+                if self._renderer is not None:
+                    self._renderer.poll(Settings.FRAME_WAIT_TIMEOUT)  # Wait for the render processes instead of spinning
+                continue
+            self._yielded_timestamp = self._raw_timestamp
+            yield frame, self._frame_info(index)
+            index += 1
+
+    """Metadata of the newest frame: its index, sensor capture time (time.monotonic()), temperature range and render settings"""
+    def _frame_info(self, index:int):
+        return {'index': index, 'timestamp': self._raw_timestamp, 'temp_min': self._temp_min, 'temp_max': self._temp_max,
+                'interpolation': self._interpolation_list_name[self._interpolation_index],
+                'colormap': self._colormap_list[self._colormap_index], 'filter': self.filter_mode if self.filter_image else None}
+
+    """Send every new frame to the sinks, functions taking (frame, info) like the ones in frame_sinks, until count frames.
+    Sinks with a close() method are closed at the end"""
+    def stream_frames(self, *sinks, count:int = None, raw:bool = False):
+        if Settings.THREADED_CAPTURE:
+            self.start_capture()
+        try:
+            for frame, info in self.frames(count, raw):
+                for sink in sinks:
+                    sink(frame, info)
+        finally:
+            self._shutdown()
+            for sink in sinks:
+                if hasattr(sink, 'close'):
+                    sink.close()
+
+    """Stop the capture thread, recording, history and render processes and handle the pending alarm events,
+    at the end of display_camera_onscreen and stream_frames"""
+    def _shutdown(self):
+        self.stop_capture()
+        self.stop_recording()
+        self.stop_history()
+        self.stop_render_processes()
+        if self._alarms is not None:
+            self._alarms.flush()  # Handle the pending alarm events and snapshots before the process exits
+
     """Update only raw data without any further image processing or text updating"""
     def update_raw_image_only(self):
         self._pull_raw_image
@@ -189,38 +743,87 @@ class pithermalcam:
     
     """Get the processed image"""
     def get_current_image_frame(self):
-        # If the current raw image hasn't been procssed, process and return it
-        if not self._current_frame_processed:
-            self._process_raw_image()
-            self._add_image_text()
-            self._current_frame_processed=True
+        # If the current raw image or a setting changed since the last render, process the changed stages and return it
+        self._render_dirty_stages()
         return self._image
     
-    """Function to convert temperatures to pixels on image"""
-    def _temps_to_rescaled_uints(self,f,Tmin,Tmax):
-        f=np.nan_to_num(f)
-        norm = np.uint8((f - Tmin)*255/(Tmax-Tmin))
-        norm.shape = (24,32)
-        return norm
+    """Function to convert temperatures to pixels on image, using the configured (auto, smoothed or locked) color range"""
+    def _temps_to_rescaled_uints(self,f):
+        return self._normalizer.normalize(f, out=self._buffers.get('norm', (24,32), np.uint8))
+
+    """Lock the color range to the current temperatures, or unlock it"""
+    def toggle_temp_range_lock(self):
+        self._normalizer.toggle_lock()
 
     def display_camera_onscreen(self):
+        if Settings.THREADED_CAPTURE:
+            self.start_capture()
         # Loop to display frames unless/until user requests exit
-        while not self._exit_requested:
-            try:
-                self.display_next_frame_onscreen()
-            # Catch a common I2C Error. If you get this too often consider checking/adjusting your I2C Baudrate
-            except RuntimeError as e:
-                if e.message == 'Too many retries':
-                    print("Too many retries error caught, potential I2C baudrate issue: continuing...")
-                    continue
-                raise
+        try:
+            while not self._exit_requested:
+                try:
+                    self.display_next_frame_onscreen()
+                # Catch a common I2C Error. If you get this too often consider checking/adjusting your I2C Baudrate
+                except RuntimeError as e:
+                    if str(e) == 'Too many retries':
+                        print("Too many retries error caught, potential I2C baudrate issue: continuing...")
+                        self._profiler.error_frames += 1
+                        self._report_read_error(e)
+                        continue
+                    raise
+        finally:
+            self._shutdown()
 
 if __name__ == "__main__":
     # If class is run as main, read ini and set up a live feed displayed to screen
-    monitor1 = get_monitors()[Settings.MONITOR_INDEX]
-    screensize = monitor1.width, monitor1.height
-    print(screensize[0])
-    print(screensize[1])
-    pyautogui.moveTo(screensize[0]-1, screensize[1]-1)
-    thermcam = pithermalcam()  # Instantiate class
-    thermcam.display_camera_onscreen()
+    # python3 denfilm_pi_thermal_cam.py --replay recordings/rec_....mlxr [--fast] plays a recording instead of the sensor
+    # python3 denfilm_pi_thermal_cam.py --headless --ffmpeg out.mp4 records the rendered video without a display
+    import argparse, shlex, sys
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--replay', help="recording file to play instead of reading the sensor")
+    parser.add_argument('--fast', action='store_true', help="replay as fast as possible instead of at the original cadence")
+    parser.add_argument('--headless', action='store_true', help="no window, send the frames to --ffmpeg, --stdout and/or --frames-dir")
+    parser.add_argument('--size', type=lambda text: tuple(int(v) for v in text.lower().split('x')),
+                        help="WxH image size, the screen size by default, 1280x960 headless")
+    parser.add_argument('--ffmpeg', help="ffmpeg output arguments, e.g. 'out.mp4' or '-f v4l2 /dev/video10'")
+    parser.add_argument('--stdout', action='store_true', help="write raw bgr24 video (float64 temperatures with --raw) to stdout")
+    parser.add_argument('--frames-dir', help="save numbered PNG images (.npy temperatures with --raw) here")
+    parser.add_argument('--raw', action='store_true', help="headless output of the raw 24x32 temperatures instead of images")
+    parser.add_argument('--count', type=int, help="stop after this many headless frames")
+    args = parser.parse_args()
+    frame_source = None
+    if args.replay:
+        from thermal_recording import RecordingSource
+        # Headless renders every recorded frame once: no loop, and read in step with the render instead of
+        # on a capture thread, whose newest-wins ring would drop frames
+        frame_source = RecordingSource(args.replay, loop=not args.headless, realtime=not args.fast)
+        if args.headless:
+            Settings.THREADED_CAPTURE = False
+    if args.headless:
+        from frame_sinks import PipeSink, FileSink, ffmpeg_command
+        size = args.size or (1280, 960)
+        sinks = []
+        if args.stdout:
+            sys.stdout.flush()
+            sinks.append(PipeSink(stream=os.fdopen(os.dup(1), 'wb')))
+            os.dup2(2, 1)  # Status messages, also those of child processes, go to stderr and stay out of the video
+        thermcam = pithermalcam(frame_source=frame_source, output_size=size)
+        if args.ffmpeg:
+            fps = refresh_hz(getattr(thermcam.mlx, 'refresh_rate', Settings.CAM_REFRESH_RATE))/2
+            sinks.append(PipeSink(ffmpeg_command(size, fps, shlex.split(args.ffmpeg))))
+        if args.frames_dir:
+            sinks.append(FileSink(args.frames_dir))
+        try:
+            thermcam.stream_frames(*sinks, count=args.count, raw=args.raw)
+        except KeyboardInterrupt:
+            pass
+    else:
+        screensize = args.size or get_screen_size()
+        print(screensize[0])
+        print(screensize[1])
+        thermcam = pithermalcam(frame_source=frame_source, output_size=screensize)  # Instantiate class
+        def hide_cursor():
+            import pyautogui  # Slow to import and only needed once, so it waits until the first frame is shown
+            pyautogui.moveTo(screensize[0]-1, screensize[1]-1)
+        thermcam.after_first_frame.append(hide_cursor)
+        thermcam.display_camera_onscreen()
@@ -0,0 +1,32 @@
+"""Preallocated frame buffers for the raw -> uint8 -> color -> resize chain.
+
+Every processing stage writes into a named buffer through out=/dst= parameters. A buffer is
+only reallocated when the shape it is requested with changes, which happens when the
+interpolation mode or the output size changes, so the steady state frame loop allocates nothing.
+"""
+import numpy as np
+
+
+class FrameBufferPool:
+    """Named, reusable numpy buffers keyed by stage name."""
+
+    def __init__(self):
+        self._buffers = {}
+        self.allocations = 0  # Number of times a buffer had to be (re)allocated, handy to spot churn
+
+    def get(self, name:str, shape:tuple, dtype=np.uint8):
+        """Return the buffer registered under name, reallocating it only if shape or dtype differ."""
+        buf = self._buffers.get(name)
+        if buf is None or buf.shape != shape or buf.dtype != dtype:
+            buf = np.zeros(shape, dtype=dtype)
+            self._buffers[name] = buf
+            self.allocations += 1
+        return buf
+
+    def clear(self):
+        """Drop all buffers, they are reallocated on next use."""
+        self._buffers.clear()
+
+    @property
+    def nbytes(self):
+        return sum(buf.nbytes for buf in self._buffers.values())
@@ -0,0 +1,187 @@
+"""Capture/render pipeline for the MLX90640 thermal camera.
+
+A capture thread reads raw 24x32 frames from the sensor into a bounded ring buffer while
+the render loop always takes the newest frame and drops the stale ones, so the slow I2C
+transfer overlaps with image processing instead of adding to it.
+"""
+import logging
+import threading
+import time
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+FRAME_SIZE = 24*32
+
+
+class FrameRing:
+    """Bounded ring buffer of raw sensor frames. Newest frame wins, unread older frames are counted as dropped."""
+
+    def __init__(self, size:int = 4, frame_size:int = FRAME_SIZE):
+        if size < 2:
+            raise ValueError("FrameRing needs at least 2 slots")
+        self._slots = np.zeros((size, frame_size))
+        self._stamps = np.zeros(size)
+        self._cond = threading.Condition()
+        self._size = size
+        self._latest = -1  # Slot holding the newest complete frame
+        self._seq = 0  # Sequence number of the newest complete frame
+        self._read_seq = 0  # Sequence number of the last frame handed to the reader
+        self.read_timestamp = None  # Capture time of the last frame handed to the reader
+        self.frames_written = 0
+        self.frames_read = 0
+        self.frames_dropped = 0
+
+    def writable_slot(self):
+        """Return the slot the producer should fill next. It is never the slot holding the newest frame."""
+        return self._slots[(self._latest + 1) % self._size]
+
+    def commit(self, timestamp:float = None):
+        """Publish the slot returned by writable_slot() as the newest frame."""
+        with self._cond:
+            self._latest = (self._latest + 1) % self._size
+            self._stamps[self._latest] = time.monotonic() if timestamp is None else timestamp
+            self._seq += 1
+            self.frames_written += 1
+            self._cond.notify_all()
+
+    @property
+    def depth(self):
+        """Number of committed frames the reader has not consumed yet."""
+        return min(self._seq - self._read_seq, self._size)
+
+    @property
+    def latest_timestamp(self):
+        return self._stamps[self._latest] if self._latest >= 0 else None
+
+    def read_latest(self, out, timeout:float = 0.0):
+        """Copy the newest frame into out if one arrived since the last read, waiting up to timeout seconds.
+
+        Returns True if a new frame was copied. Frames committed since the last read other than the
+        newest one are counted as dropped.
+        """
+        with self._cond:
+            if self._seq == self._read_seq and timeout > 0:
+                self._cond.wait_for(lambda: self._seq != self._read_seq, timeout)
+            if self._seq == self._read_seq:
+                return False
+            np.copyto(out, self._slots[self._latest])
+            self.read_timestamp = self._stamps[self._latest]
+            self.frames_dropped += self._seq - self._read_seq - 1
+            self.frames_read += 1
+            self._read_seq = self._seq
+            return True
+
+    def copy_latest(self, out):
+        """Copy the newest frame into out without marking it as read. Returns False if no frame was captured yet."""
+        with self._cond:
+            if self._latest < 0:
+                return False
+            np.copyto(out, self._slots[self._latest])
+            return True
+
+
+class CaptureThread(threading.Thread):
+    """Producer thread that keeps pulling frames from the sensor into a FrameRing."""
+
+    def __init__(self, mlx, ring:FrameRing):
+        super().__init__(name='mlx90640-capture', daemon=True)
+        self.mlx = mlx
+        self.ring = ring
+        self.frames_captured = 0
+        self.value_errors = 0
+        self.io_errors = 0
+        self.retry_errors = 0
+        self.recorder = None  # Optional RecordingWriter, gets every raw frame before it is published
+        self.controller = None  # Optional RefreshRateController, told about every read
+        self.history = None  # Optional ThermalHistory, gets every raw frame like the recorder
+        self.exhausted = False  # Set once a finite frame source (a replay) ran out, every frame is committed by then
+        self.error = None  # Unexpected exception that stopped the thread, re-raised to the reader by raise_if_failed()
+        self._stop_event = threading.Event()
+        self._t_start = None
+
+    def run(self):
+        self._t_start = time.monotonic()
+        try:
+            self._capture()
+        except Exception as e:
+            # Dying quietly here would freeze the display on the last frame, the reader raises it instead
+            logger.error("Capture thread stopped by %r", e)
+            self.error = e
+
+    def _capture(self):
+        while not self._stop_event.is_set():
+            slot = self.ring.writable_slot()
+            try:
+                self.mlx.getFrame(slot)  # read mlx90640
+            except ValueError as e:
+                self.value_errors += 1
+                logger.info("Math error in capture thread; continuing...")
+                self._report_error(e)
+                continue
+            except OSError as e:
+                self.io_errors += 1
+                logger.info("IO Error in capture thread; continuing...")
+                self._report_error(e)
+                continue
+            except RuntimeError as e:
+                # Catch a common I2C Error. If you get this too often consider checking/adjusting your I2C Baudrate
+                if str(e) != 'Too many retries':
+                    raise
+                self.retry_errors += 1
+                logger.info("Too many retries error caught in capture thread; continuing...")
+                self._report_error(e)
+                continue
+            except EOFError:
+                logger.info("Frame source exhausted, capture thread stopping")
+                self.exhausted = True
+                break
+            controller = self.controller
+            if controller is not None:
+                controller.frame_ok()
+            recorder = self.recorder
+            if recorder is not None:
+                recorder.write(slot)
+            history = self.history
+            if history is not None:
+                history.write(slot)
+            self.ring.commit()
+            self.frames_captured += 1
+
+    def raise_if_failed(self):
+        """Raise the exception that stopped the thread, once it stopped. Does nothing while it runs or after stop()."""
+        if self.error is not None and not self.is_alive():
+            raise self.error
+
+    def _report_error(self, error:Exception):
+        """Tell the refresh rate controller about a failed read and wait as long as it asks to."""
+        controller = self.controller
+        if controller is not None:
+            delay = controller.frame_failed(error)
+            if delay > 0:
+                self._stop_event.wait(delay)
+
+    def stop(self, timeout:float = 2.0):
+        self._stop_event.set()
+        if self.is_alive():
+            self.join(timeout)
+
+    @property
+    def fps(self):
+        """Average sensor frame rate since the thread started."""
+        if self._t_start is None:
+            return 0.0
+        elapsed = time.monotonic() - self._t_start
+        return self.frames_captured/elapsed if elapsed > 0 else 0.0
+
+    def get_stats(self):
+        """Capture stage counters, merged with the ring buffer queue depth and drop counters."""
+        return {
+            'capture_fps': self.fps,
+            'frames_captured': self.frames_captured,
+            'value_errors': self.value_errors,
+            'io_errors': self.io_errors,
+            'retry_errors': self.retry_errors,
+            'queue_depth': self.ring.depth,
+            'frames_dropped': self.ring.frames_dropped,
+        }
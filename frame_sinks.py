@@ -0,0 +1,66 @@
+"""Destinations for headless frames, called as sink(frame, info) for every frame of pithermalcam.frames().
+
+    PipeSink(ffmpeg_command((1280,960), 4, ['out.mp4']))  # encode with ffmpeg
+    PipeSink(ffmpeg_command((1280,960), 4, ['-f', 'v4l2', '/dev/video10']))  # v4l2loopback webcam
+    PipeSink(stream=sys.stdout.buffer)  # raw video on stdout
+    FileSink('frames')  # frames/frame_000000.png, frames/frame_000001.png, ...
+
+Any function taking (frame, info) works as a sink too. Sinks write synchronously, so a slow
+consumer slows the camera down instead of frames piling up in memory.
+"""
+import os
+import subprocess
+import numpy as np
+import cv2
+
+
+def ffmpeg_command(size:tuple, fps:float, output_args, pixel_format:str = 'bgr24'):
+    """ffmpeg arguments reading raw (width, height) frames from stdin and writing them with output_args."""
+    return ['ffmpeg', '-loglevel', 'error', '-f', 'rawvideo', '-pix_fmt', pixel_format,
+            '-video_size', f'{size[0]}x{size[1]}', '-framerate', f'{fps:g}', '-i', '-'] + list(output_args)
+
+
+class PipeSink:
+    """Writes the frame bytes (bgr24 images, or float64 temperatures for raw frames) to a command's stdin or a binary stream."""
+
+    def __init__(self, command=None, stream=None):
+        if (command is None) == (stream is None):
+            raise ValueError("Give either a command or a stream")
+        self._process = None
+        if command is not None:
+            self._process = subprocess.Popen(command, stdin=subprocess.PIPE)
+            stream = self._process.stdin
+        self._stream = stream
+        self.frames_written = 0
+
+    def __call__(self, frame, info:dict):
+        self._stream.write(np.ascontiguousarray(frame).data)
+        self.frames_written += 1
+
+    def close(self):
+        if self._process is None:
+            self._stream.flush()
+            return
+        try:
+            self._process.stdin.close()
+        except BrokenPipeError:
+            pass  # The command already exited
+        self._process.wait()
+
+
+class FileSink:
+    """Numbered image files in any cv2.imwrite format, or .npy temperature grids for raw frames."""
+
+    def __init__(self, folder:str, pattern:str = 'frame_{index:06d}.png'):
+        os.makedirs(folder, exist_ok=True)
+        self.folder = folder
+        self.pattern = pattern
+        self.frames_written = 0
+
+    def __call__(self, frame, info:dict):
+        path = os.path.join(self.folder, self.pattern.format(index=self.frames_written))
+        if frame.ndim == 2:
+            np.save(os.path.splitext(path)[0] + '.npy', frame)
+        elif not cv2.imwrite(path, frame):
+            raise OSError(f"Could not write {path}")
+        self.frames_written += 1
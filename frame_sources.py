@@ -0,0 +1,177 @@
+"""Frame sources with the adafruit MLX90640 getFrame(buf) contract.
+
+The hardware source imports board/busio/adafruit_mlx90640 only when it is constructed, so the
+processing path can be imported, profiled and benchmarked on a machine without the camera.
+"""
+import time
+import numpy as np
+
+FRAME_SIZE = 24*32
+
+
+def refresh_hz(refresh_rate:int):
+    """Subpage rate in Hz of an adafruit_mlx90640.RefreshRate value (0 = 0.5 Hz ... 7 = 64 Hz)."""
+    return 2.0**(refresh_rate - 1)
+
+
+class MLX90640Source:
+    """The real sensor on an I2C bus.
+
+    Pass i2c to put several sensors (at different addresses, or behind a mux) on one bus,
+    otherwise a bus is opened on scl/sda, the default I2C pins if not given.
+    """
+
+    def __init__(self, frequency:int = 400000, refresh_rate:int = 4, scl=None, sda=None, address:int = 0x33, i2c=None):
+        import adafruit_mlx90640
+        if i2c is None:
+            import board, busio
+            i2c = busio.I2C(scl or board.SCL, sda or board.SDA, frequency=frequency)  # setup I2C
+        self.i2c = i2c
+        self.address = address
+        self.mlx = adafruit_mlx90640.MLX90640(self.i2c, address=address)  # begin MLX90640 with I2C comm
+        self.mlx.refresh_rate = refresh_rate  # set refresh rate
+        time.sleep(0.1)
+
+    @property
+    def refresh_rate(self):
+        return self.mlx.refresh_rate
+
+    @refresh_rate.setter
+    def refresh_rate(self, value:int):
+        self.mlx.refresh_rate = value
+
+    def getFrame(self, framebuf):
+        self.mlx.getFrame(framebuf)
+
+
+class SyntheticSource:
+    """Deterministic fake sensor: a warm blob drifting over a room temperature background.
+
+    NaN pixels and ValueError/OSError/RuntimeError('Too many retries') failures can be injected
+    at fixed rates to exercise the error paths, and like a marginal I2C setup the sensor can be made
+    to fail with 'Too many retries' at unstable_error_rate above the refresh rate unstable_above.
+    With realtime=True getFrame() blocks for as long as the real sensor would at the current
+    refresh rate. clock() is the simulated sensor time, it advances by one frame period per read.
+    """
+
+    def __init__(self, seed:int = 0, refresh_rate:int = 4, realtime:bool = False, ambient:float = 22.0,
+                 hotspot:float = 36.0, noise:float = 0.3, nan_rate:float = 0.0, value_error_rate:float = 0.0,
+                 os_error_rate:float = 0.0, retry_error_rate:float = 0.0, unstable_above:int = None,
+                 unstable_error_rate:float = 0.5):
+        self.refresh_rate = refresh_rate
+        self.realtime = realtime
+        self.ambient = ambient
+        self.hotspot = hotspot
+        self.noise = noise
+        self.nan_rate = nan_rate
+        self.value_error_rate = value_error_rate
+        self.os_error_rate = os_error_rate
+        self.retry_error_rate = retry_error_rate
+        self.unstable_above = unstable_above
+        self.unstable_error_rate = unstable_error_rate
+        self.sim_time = 0.0
+        self.frames = 0
+        self.errors = 0
+        self._rng = np.random.default_rng(seed)
+        rows, cols = np.mgrid[0:24, 0:32]
+        self._rows = rows.ravel().astype(np.float64)
+        self._cols = cols.ravel().astype(np.float64)
+        self._frame = np.zeros(FRAME_SIZE)
+        self._scratch = np.zeros(FRAME_SIZE)
+        self._noise = np.zeros(FRAME_SIZE)
+        self._nan_mask = np.zeros(FRAME_SIZE, dtype=bool)
+        self._next_due = None
+
+    def _wait_for_frame(self):
+        period = 2/refresh_hz(self.refresh_rate)  # getFrame() reads both subpages
+        now = time.monotonic()
+        if self._next_due is None or self._next_due < now:
+            self._next_due = now
+        time.sleep(self._next_due - now)
+        self._next_due += period
+
+    def clock(self):
+        return self.sim_time
+
+    def _inject_fault(self):
+        if self.unstable_above is not None and self.refresh_rate > self.unstable_above:
+            if self._rng.random() < self.unstable_error_rate:
+                self.errors += 1
+                raise RuntimeError("Too many retries")
+        draw = self._rng.random()
+        for rate, error in ((self.value_error_rate, ValueError("Math error")),
+                            (self.os_error_rate, OSError(5, "Input/output error")),
+                            (self.retry_error_rate, RuntimeError("Too many retries"))):
+            if draw < rate:
+                self.errors += 1
+                raise error
+            draw -= rate
+
+    def getFrame(self, framebuf):
+        if self.realtime:
+            self._wait_for_frame()
+        self.sim_time += 2/refresh_hz(self.refresh_rate)
+        self._inject_fault()
+        # Blob position follows a Lissajous path so consecutive frames differ but stay reproducible
+        t = self.frames*0.05
+        center_row = 11.5 + 8*np.sin(t)
+        center_col = 15.5 + 12*np.sin(0.7*t + 1)
+        frame, scratch = self._frame, self._scratch
+        np.subtract(self._rows, center_row, out=frame)
+        np.square(frame, out=frame)
+        np.subtract(self._cols, center_col, out=scratch)
+        np.square(scratch, out=scratch)
+        np.add(frame, scratch, out=frame)
+        np.multiply(frame, -1/18.0, out=frame)
+        np.exp(frame, out=frame)
+        np.multiply(frame, self.hotspot - self.ambient, out=frame)
+        np.add(frame, self.ambient, out=frame)
+        self._rng.standard_normal(out=self._noise)
+        np.multiply(self._noise, self.noise, out=self._noise)
+        np.add(frame, self._noise, out=frame)
+        if self.nan_rate > 0:
+            self._rng.random(out=scratch)
+            np.less(scratch, self.nan_rate, out=self._nan_mask)
+            np.copyto(frame, np.nan, where=self._nan_mask)
+        framebuf[:] = frame
+        self.frames += 1
+
+
+class ReplaySource:
+    """Plays back previously captured (N, 768) frames, optionally at their original cadence."""
+
+    def __init__(self, frames, timestamps=None, loop:bool = True, realtime:bool = False, refresh_rate:int = 4):
+        self.frames = frames
+        self.timestamps = timestamps
+        self.loop = loop
+        self.realtime = realtime
+        self.refresh_rate = refresh_rate
+        self.position = 0
+        self._t_start = None
+
+    def __len__(self):
+        return len(self.frames)
+
+    def getFrame(self, framebuf):
+        if self.position >= len(self.frames):
+            if not self.loop:
+                raise EOFError("End of replayed frames")
+            self.position = 0
+            self._t_start = None
+        if self.realtime:
+            if self._t_start is None:
+                self._t_start = time.monotonic() - self._offset(self.position)
+            delay = self._t_start + self._offset(self.position) - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        self._copy_frame(self.position, framebuf)
+        self.position += 1
+
+    def _copy_frame(self, index:int, framebuf):
+        framebuf[:] = self.frames[index]
+
+    def _offset(self, index:int):
+        """Seconds from the first frame to frame index in the original stream."""
+        if self.timestamps is not None:
+            return self.timestamps[index] - self.timestamps[0]
+        return index*2/refresh_hz(self.refresh_rate)
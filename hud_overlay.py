@@ -0,0 +1,131 @@
+"""Cached on-screen text and temperature markers.
+
+Every distinct string is rasterized once into a small BGRA tile, kept in an LRU
+cache keyed by its content, and blended into the frame over the tile's own rectangle only.
+Static segments (interpolation, colormap, filter state) therefore cost a cache lookup and a
+small blend per frame, and numeric fields are refreshed at a throttled rate so they don't
+produce a new tile every frame either. The pixels under everything drawn are saved first, so
+the overlay can be taken off the frame again without reprocessing it.
+"""
+import time
+from collections import OrderedDict
+import numpy as np
+import cv2
+
+FONT = cv2.FONT_HERSHEY_SIMPLEX
+WHITE = (255, 255, 255)
+
+
+class TextTile:
+    """One rasterized string as a BGRA tile. The alpha channel is the text coverage and serves as the copy mask."""
+
+    def __init__(self, text:str, font_scale:float, thickness:int, color:tuple = WHITE):
+        (w, h), baseline = cv2.getTextSize(text, FONT, font_scale, thickness)
+        pad = thickness  # Room for the stroke around the nominal text box
+        alpha = np.zeros((h + baseline + 2*pad, w + 2*pad), np.uint8)
+        # Same hard edged rasterization as cv2.putText on the frame, so the mask copy is exact
+        cv2.putText(alpha, text, (pad, h + pad), FONT, font_scale, 255, thickness)
+        self.bgra = cv2.merge((np.full_like(alpha, color[0]), np.full_like(alpha, color[1]), np.full_like(alpha, color[2]), alpha))
+        self._bgr = np.ascontiguousarray(self.bgra[..., :3])
+        self._alpha = alpha
+        self.height, self.width = alpha.shape
+        self.origin = (pad, h + pad)  # Position of the text origin (x, baseline y) in the tile
+        self.advance = w  # Where the next segment starts, as in one cv2.putText call
+
+    def blend(self, roi, rows:slice, cols:slice):
+        """Blend the (rows, cols) part of the tile into roi, a BGR uint8 view of the same size."""
+        cv2.copyTo(self._bgr[rows, cols], self._alpha[rows, cols], roi)
+
+
+class HudOverlay:
+    """Draws text lines and markers onto a frame, touching only the small regions they cover."""
+
+    def __init__(self, refresh_interval:float = 0.5, cache_size:int = 128):
+        self.refresh_interval = refresh_interval
+        self.cache_size = cache_size
+        self.tiles_rendered = 0  # Cache misses, each one is a cv2.putText on a small tile
+        self._tiles = OrderedDict()
+        self._fields = {}
+        self._image = None
+        self._saved = []  # (y0, y1, x0, x1) of every drawn region, in draw order
+        self._backups = []  # Pixels under those regions, reused from frame to frame
+
+    def field(self, name:str, format_func):
+        """Text of a numeric field, from format_func() at most once every refresh_interval seconds."""
+        now = time.monotonic()
+        entry = self._fields.get(name)
+        if entry is None or now - entry[0] >= self.refresh_interval:
+            entry = self._fields[name] = (now, format_func())
+        return entry[1]
+
+    def tile(self, text:str, font_scale:float, thickness:int, color:tuple = WHITE):
+        key = (text, font_scale, thickness, color)
+        tile = self._tiles.get(key)
+        if tile is None:
+            tile = self._tiles[key] = TextTile(text, font_scale, thickness, color)
+            self.tiles_rendered += 1
+            if len(self._tiles) > self.cache_size:
+                self._tiles.popitem(last=False)
+        else:
+            self._tiles.move_to_end(key)
+        return tile
+
+    def begin(self, image):
+        """Start a new overlay on image, taking the previous overlay off the image it was drawn on first."""
+        self.restore()
+        self._image = image
+
+    def restore(self):
+        """Put back the pixels under the current overlay. Call before anything else reads or rewrites the image."""
+        for (y0, y1, x0, x1), backup in zip(reversed(self._saved), reversed(self._backups[:len(self._saved)])):
+            np.copyto(self._image[y0:y1, x0:x1], backup[:y1-y0, :x1-x0])
+        self._saved.clear()
+
+    def _save(self, x0:int, y0:int, x1:int, y1:int):
+        """Clip a region to the image and save the pixels under it. Returns the clipped region, or None if empty."""
+        height, width = self._image.shape[:2]
+        x0, y0, x1, y1 = max(x0, 0), max(y0, 0), min(x1, width), min(y1, height)
+        if x0 >= x1 or y0 >= y1:
+            return None
+        i = len(self._saved)
+        if i == len(self._backups):
+            self._backups.append(np.empty((0, 0) + self._image.shape[2:], np.uint8))
+        backup = self._backups[i]
+        if backup.shape[0] < y1 - y0 or backup.shape[1] < x1 - x0:
+            backup = self._backups[i] = np.empty((max(backup.shape[0], y1 - y0), max(backup.shape[1], x1 - x0))
+                                                 + self._image.shape[2:], np.uint8)
+        np.copyto(backup[:y1-y0, :x1-x0], self._image[y0:y1, x0:x1])
+        self._saved.append((y0, y1, x0, x1))
+        return x0, y0, x1, y1
+
+    def text(self, segments, origin:tuple, font_scale:float, thickness:int, color:tuple = WHITE):
+        """Draw the segments left to right as one line starting at origin (x, baseline y), like cv2.putText.
+
+        Each segment is its own cached tile, so a line mixing static and changing parts only
+        rasterizes the parts that changed. Returns the x coordinate after the last segment.
+        """
+        x, y = origin
+        for segment in segments:
+            if not segment:
+                continue
+            tile = self.tile(segment, font_scale, thickness, color)
+            left, top = x - tile.origin[0], y - tile.origin[1]
+            region = self._save(left, top, left + tile.width, top + tile.height)
+            if region is not None:
+                x0, y0, x1, y1 = region
+                tile.blend(self._image[y0:y1, x0:x1], slice(y0 - top, y1 - top), slice(x0 - left, x1 - left))
+            x += tile.advance
+        return x
+
+    def crosshair(self, center:tuple, size:int, color:tuple = WHITE, thickness:int = 1):
+        x, y = center
+        margin = size + thickness
+        if self._save(x - margin, y - margin, x + margin + 1, y + margin + 1) is not None:
+            cv2.line(self._image, (x - size, y), (x + size, y), color, thickness)
+            cv2.line(self._image, (x, y - size), (x, y + size), color, thickness)
+
+    def marker(self, center:tuple, radius:int, color:tuple = WHITE, thickness:int = 1):
+        x, y = center
+        margin = radius + thickness
+        if self._save(x - margin, y - margin, x + margin + 1, y + margin + 1) is not None:
+            cv2.circle(self._image, (x, y), radius, color, thickness)
@@ -0,0 +1,161 @@
+"""MJPEG over HTTP for the processed thermal image.
+
+Each processed frame is JPEG encoded once, and only while somebody is watching; every
+connected client is then sent the same bytes. Clients always get the newest frame, so a
+slow client skips frames instead of queueing them.
+
+    python3 mjpeg_server.py --simulated   # serve a simulated sensor on http://localhost:8000/
+"""
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import cv2
+
+logger = logging.getLogger(__name__)
+
+BOUNDARY = 'thermalframe'
+INDEX_PAGE = b"""<html><head><title>Thermal Camera</title></head>
+<body style="margin:0;background:#000"><img src="/stream.mjpg" style="width:100%"></body></html>"""
+
+
+class MJPEGBroadcaster:
+    """Holds the newest encoded frame and wakes up the client threads when it changes."""
+
+    def __init__(self, quality:int = 80):
+        self.quality = quality
+        self.clients = 0
+        self.frames_encoded = 0
+        self.frames_sent = 0
+        self._cond = threading.Condition()
+        self._jpeg = None
+        self._seq = 0
+        self._closed = False
+
+    def publish(self, image):
+        """Encode image once for all clients. Does nothing when no client is connected."""
+        if self.clients == 0:
+            return False
+        ok, jpeg = cv2.imencode('.jpg', image, (cv2.IMWRITE_JPEG_QUALITY, self.quality))
+        if not ok:
+            return False
+        with self._cond:
+            self._jpeg = jpeg
+            self._seq += 1
+            self.frames_encoded += 1
+            self._cond.notify_all()
+        return True
+
+    def wait_frame(self, last_seq:int, timeout:float = 5.0):
+        """Return (seq, jpeg) of the newest frame once it is newer than last_seq, or (last_seq, None) on timeout."""
+        with self._cond:
+            self._cond.wait_for(lambda: self._seq != last_seq or self._closed, timeout)
+            if self._seq == last_seq or self._closed:
+                return last_seq, None
+            self.frames_sent += 1
+            return self._seq, self._jpeg
+
+    def _add_client(self, delta:int):
+        with self._cond:
+            self.clients += delta
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def get_stats(self):
+        return {'stream_clients': self.clients, 'stream_frames_encoded': self.frames_encoded,
+                'stream_frames_sent': self.frames_sent}
+
+
+class _StreamHandler(BaseHTTPRequestHandler):
+    broadcaster = None  # Set on the per-server subclass
+
+    def log_message(self, format, *args):
+        logger.debug("%s - %s", self.address_string(), format % args)
+
+    def do_GET(self):
+        if self.path in ('/', '/index.html'):
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html')
+            self.send_header('Content-Length', str(len(INDEX_PAGE)))
+            self.end_headers()
+            self.wfile.write(INDEX_PAGE)
+        elif self.path == '/stream.mjpg':
+            self._stream()
+        else:
+            self.send_error(404)
+
+    def _stream(self):
+        broadcaster = self.broadcaster
+        self.send_response(200)
+        self.send_header('Cache-Control', 'no-cache, private')
+        self.send_header('Pragma', 'no-cache')
+        self.send_header('Content-Type', f'multipart/x-mixed-replace; boundary={BOUNDARY}')
+        self.end_headers()
+        broadcaster._add_client(1)
+        seq = 0
+        try:
+            while not broadcaster._closed:
+                seq, jpeg = broadcaster.wait_frame(seq)
+                if jpeg is None:
+                    continue
+                self.wfile.write(f'--{BOUNDARY}\r\nContent-Type: image/jpeg\r\nContent-Length: {jpeg.size}\r\n\r\n'.encode())
+                self.wfile.write(jpeg.data)
+                self.wfile.write(b'\r\n')
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # Client went away
+        finally:
+            broadcaster._add_client(-1)
+
+
+class MJPEGServer:
+    """Threaded HTTP server serving / (viewer page) and /stream.mjpg from a broadcaster."""
+
+    def __init__(self, broadcaster:MJPEGBroadcaster, host:str = '0.0.0.0', port:int = 8000):
+        self.broadcaster = broadcaster
+        handler = type('StreamHandler', (_StreamHandler,), {'broadcaster': broadcaster})
+        self._httpd = ThreadingHTTPServer((host, port), handler)
+        self._httpd.daemon_threads = True
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name='mjpeg-server', daemon=True)
+
+    @property
+    def port(self):
+        return self._httpd.server_address[1]
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.broadcaster.close()
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Serve the thermal camera as MJPEG over HTTP")
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--simulated', action='store_true', help="use a simulated sensor instead of the MLX90640")
+    args = parser.parse_args()
+
+    from pi_therm_cam import pithermalcam
+    frame_source = None
+    if args.simulated:
+        from frame_sources import SyntheticSource
+        frame_source = SyntheticSource(realtime=True)
+    thermcam = pithermalcam(frame_source=frame_source)
+    server = thermcam.start_server(port=args.port)
+    print(f"Serving on http://localhost:{server.port}/ - Ctrl+C to stop")
+    thermcam.start_capture()
+    try:
+        while True:
+            thermcam.update_image_frame()
+            time.sleep(0.01)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        thermcam.stop_capture()
+        thermcam.stop_server()
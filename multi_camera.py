@@ -0,0 +1,198 @@
+"""Several MLX90640 sensors in one process.
+
+Every sensor gets its own pithermalcam (frame source, capture thread, frame ring, buffers and
+color range), and a shared thread pool renders the cameras in parallel. The heavy stages
+(cv2 resize/colormap/bilateral and the numpy matrix products of the fast spline modes) release
+the GIL, so rendering spreads over the cores instead of running one camera after the other.
+The result is shown as one tiled window or one window per sensor, and can be streamed as MJPEG.
+
+    python3 multi_camera.py --addresses 0x33 0x32   # two sensors on the default I2C bus
+    python3 multi_camera.py --simulated 4 --port 8000
+"""
+import logging
+import math
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import cv2
+import Settings
+from denfilm_pi_thermal_cam import pithermalcam, get_screen_size
+from mjpeg_server import MJPEGBroadcaster, MJPEGServer
+
+logger = logging.getLogger(__name__)
+
+WINDOW_NAME = 'Thermal Cameras'
+
+
+class MultiCamera:
+    """Renders several cameras on a shared worker pool into a tiled composite or separate windows."""
+
+    def __init__(self, cameras, workers:int = None, tiled:bool = True, columns:int = None):
+        self.cameras = list(cameras)
+        self.tiled = tiled
+        self.columns = columns or math.ceil(math.sqrt(len(self.cameras)))
+        self.rows = math.ceil(len(self.cameras)/self.columns)
+        self.workers = workers or min(len(self.cameras), os.cpu_count() or 1)
+        self._pool = ThreadPoolExecutor(self.workers, thread_name_prefix='render')
+        self._composite = None
+        self._streams = []  # (server, camera index or None for the composite)
+        self._window_created = False
+        self._exit_requested = False
+        self.frames_composited = 0
+
+    @classmethod
+    def from_sources(cls, frame_sources, tile_size:tuple = (640,480), workers:int = None, tiled:bool = True, **camera_kwargs):
+        """One camera per frame source, each rendering at tile_size."""
+        cameras = [pithermalcam(frame_source=source, output_size=tile_size, name=str(i), **camera_kwargs)
+                   for i, source in enumerate(frame_sources)]
+        return cls(cameras, workers, tiled)
+
+    def start_capture(self):
+        for camera in self.cameras:
+            camera.start_capture()
+
+    def stop_capture(self):
+        for camera in self.cameras:
+            camera._shutdown()
+
+    @staticmethod
+    def _render(camera):
+        """Pull and render one camera on a pool thread. Returns True if its image changed."""
+        camera._pull_raw_image(Settings.FRAME_WAIT_TIMEOUT if camera._capture_thread is not None else 0.0)
+        return camera._render_dirty_stages()
+
+    def update(self):
+        """Render every camera in parallel and refresh the composite. Returns the indexes of the cameras that changed."""
+        changed = [i for i, updated in enumerate(self._pool.map(self._render, self.cameras)) if updated]
+        if changed and (self.tiled or any(index is None for _, index in self._streams)):
+            self._compose(changed)
+        for server, index in self._streams:
+            if index is None:
+                if changed:
+                    server.broadcaster.publish(self._composite)
+            elif index in changed:
+                server.broadcaster.publish(self.cameras[index]._image)
+        return changed
+
+    def _compose(self, changed):
+        height, width = self.cameras[0]._image.shape[:2]
+        shape = (height*self.rows, width*self.columns, 3)
+        if self._composite is None or self._composite.shape != shape:
+            self._composite = np.zeros(shape, dtype=np.uint8)
+            changed = range(len(self.cameras))
+        for i in changed:
+            row, column = divmod(i, self.columns)
+            image = self.cameras[i]._image
+            tile = self._composite[row*height:(row+1)*height, column*width:(column+1)*width]
+            if image.shape == tile.shape:
+                np.copyto(tile, image)
+            else:
+                cv2.resize(image, (width, height), dst=tile)
+        self.frames_composited += 1
+
+    @property
+    def composite(self):
+        return self._composite
+
+    def start_server(self, port:int = 8000, camera:int = None, host:str = '0.0.0.0', quality:int = 80):
+        """Stream the tiled composite, or a single camera's image, as MJPEG on http://host:port/"""
+        server = MJPEGServer(MJPEGBroadcaster(quality), host, port).start()
+        self._streams.append((server, camera))
+        logger.info("MJPEG server for %s listening on port %d", 'the composite' if camera is None else f'camera {camera}', server.port)
+        return server
+
+    def stop_servers(self):
+        for server, _ in self._streams:
+            server.stop()
+        self._streams = []
+
+    def _show(self, changed):
+        if self.tiled:
+            if not self._window_created:
+                cv2.namedWindow(WINDOW_NAME, cv2.WINDOW_NORMAL)
+                cv2.setWindowProperty(WINDOW_NAME, cv2.WND_PROP_FULLSCREEN, cv2.WINDOW_FULLSCREEN)
+                self._window_created = True
+            cv2.imshow(WINDOW_NAME, self._composite)
+        else:
+            for i in changed:
+                self.cameras[i]._show_processed_image()
+
+    def display_onscreen(self):
+        """Show all cameras until Esc. Keys act on every camera."""
+        self.start_capture()
+        self.cameras[0]._print_shortcuts_keys()
+        try:
+            while not self._exit_requested:
+                changed = self.update()
+                if changed:
+                    self._show(changed)
+                delay = min(camera._ms_until_next_frame() for camera in self.cameras)
+                key = cv2.waitKey(delay) & 0xFF
+                if key != 0xFF:
+                    for i, camera in enumerate(self.cameras):
+                        camera.handle_key(key, toggle_settings=(i == 0))
+                    self._exit_requested = key == 27
+        finally:
+            self.stop_capture()
+            self.stop_servers()
+
+    def serve_forever(self):
+        """Render for the MJPEG streams only, without any window, until interrupted."""
+        self.start_capture()
+        try:
+            while True:
+                if not self.update():
+                    time.sleep(min(camera._ms_until_next_frame() for camera in self.cameras)/1000)
+        finally:
+            self.stop_capture()
+            self.stop_servers()
+
+    def close(self):
+        self.stop_capture()
+        self.stop_servers()
+        self._pool.shutdown()
+
+    def get_stats(self):
+        return {'workers': self.workers, 'frames_composited': self.frames_composited,
+                'cameras': [camera.get_pipeline_stats() for camera in self.cameras]}
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Show several thermal cameras at once")
+    parser.add_argument('--addresses', type=lambda text: int(text, 0), nargs='+', default=[0x33],
+                        help="I2C addresses of the sensors on the default bus")
+    parser.add_argument('--simulated', type=int, metavar='N', help="use N simulated sensors instead")
+    parser.add_argument('--separate', action='store_true', help="one window per sensor instead of a tiled window")
+    parser.add_argument('--workers', type=int, help="render threads (default one per sensor, up to the core count)")
+    parser.add_argument('--port', type=int, help="also stream the tiled image as MJPEG on this port")
+    parser.add_argument('--headless', action='store_true', help="no window, only the MJPEG stream")
+    args = parser.parse_args()
+
+    if args.simulated:
+        from frame_sources import SyntheticSource
+        sources = [SyntheticSource(seed=i, realtime=True, refresh_rate=Settings.CAM_REFRESH_RATE) for i in range(args.simulated)]
+    else:
+        import board, busio
+        from frame_sources import MLX90640Source
+        i2c = busio.I2C(board.SCL, board.SDA, frequency=Settings.I2C_FREQUENCY)  # One bus shared by all sensors
+        sources = [MLX90640Source(refresh_rate=Settings.CAM_REFRESH_RATE, address=address, i2c=i2c) for address in args.addresses]
+    columns = math.ceil(math.sqrt(len(sources)))
+    rows = math.ceil(len(sources)/columns)
+    if args.headless:
+        screen = (1280, 960)
+    else:
+        screen = get_screen_size()
+    tile_size = screen if args.separate else (screen[0]//columns, screen[1]//rows)
+    cameras = MultiCamera.from_sources(sources, tile_size, args.workers, tiled=not args.separate)
+    if args.port is not None:
+        print(f"Serving on http://localhost:{cameras.start_server(args.port).port}/")
+    if args.headless:
+        try:
+            cameras.serve_forever()
+        except KeyboardInterrupt:
+            pass
+    else:
+        cameras.display_onscreen()
+    cameras.close()
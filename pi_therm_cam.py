@@ -3,14 +3,19 @@
 ##################################
 # MLX90640 Thermal Camera w Raspberry Pi
 ##################################
-import time,board,busio, traceback
+import time, traceback
 import numpy as np
-import adafruit_mlx90640
 import datetime as dt
 import cv2
 import logging
-import cmapy
-from scipy import ndimage
+from frame_pipeline import FrameRing, CaptureThread
+from colormap_cache import ColormapCache
+from frame_buffers import FrameBufferPool
+from fast_zoom import SeparableZoom
+from frame_sources import MLX90640Source
+from temperature_range import TemperatureNormalizer
+from snapshot_writer import SnapshotWriter
+from mjpeg_server import MJPEGBroadcaster, MJPEGServer
 
 # Set up logging
 logging.basicConfig(filename='pithermcam.log',filemode='a',
@@ -22,8 +27,8 @@ logger = logging.getLogger(__name__)
 class pithermalcam:
     # See https://gitlab.com/cvejarano-oss/cmapy/-/blob/master/docs/colorize_all_examples.md to for options that can be put in this list
     _colormap_list=['jet','bwr','seismic','coolwarm','PiYG_r','tab10','tab20','gnuplot2','brg']
-    _interpolation_list =[cv2.INTER_NEAREST,cv2.INTER_LINEAR,cv2.INTER_AREA,cv2.INTER_CUBIC,cv2.INTER_LANCZOS4,5,6]
-    _interpolation_list_name = ['Nearest','Inter Linear','Inter Area','Inter Cubic','Inter Lanczos4','Pure Scipy', 'Scipy/CV2 Mixed']
+    _interpolation_list =[cv2.INTER_NEAREST,cv2.INTER_LINEAR,cv2.INTER_AREA,cv2.INTER_CUBIC,cv2.INTER_LANCZOS4,5,6,7,8]
+    _interpolation_list_name = ['Nearest','Inter Linear','Inter Area','Inter Cubic','Inter Lanczos4','Pure Scipy', 'Scipy/CV2 Mixed', 'Fast Scipy', 'Fast Scipy/CV2 Mixed']
     _current_frame_processed=False  # Tracks if the current processed image matches the current raw image
     i2c=None
     mlx=None
@@ -32,19 +37,50 @@ class pithermalcam:
     _raw_image=None
     _image=None
     _file_saved_notification_start=None
+    _file_saved_notification='Snapshot Saved!'
+    _snapshot_writer=None
+    _raw_frames_pulled=0
+    _temps_valid=False  # The 'temps' buffer holds the newest good frame in C
+    _burst_remaining=0
+    _burst_stem=None
+    _burst_index=0
+    _burst_last_frame=None
+    _stream_server=None
+    _streamed_frame=None
     _displaying_onscreen=False
     _exit_requested=False
+    _frame_ring=None
+    _capture_thread=None
+    _colormap_cache=None
+    _buffers=None
+    _zoom_engines=None
+    _normalizer=None
+    _frames_rendered=0
 
     def __init__(self,use_f:bool = True, filter_image:bool = False, image_width:int=1200, 
-                image_height:int=900, output_folder:str = '/home/pi/pithermalcam/saved_snapshots/'):
+                image_height:int=900, output_folder:str = '/home/pi/pithermalcam/saved_snapshots/',
+                threaded_capture:bool = True, frame_ring_size:int = 4, colormap_cache_file:str = None,
+                frame_source=None, snapshot_formats:tuple = ('jpg',), save_raw_snapshots:bool = False,
+                burst_length:int = 10):
         self.use_f=use_f
+        self.frame_source=frame_source
         self.filter_image=filter_image
         self.image_width=image_width
         self.image_height=image_height
         self.output_folder=output_folder
+        self.threaded_capture=threaded_capture
+        self.frame_ring_size=frame_ring_size
+        self.burst_length=burst_length
+        self._snapshot_writer = SnapshotWriter(formats=snapshot_formats, save_raw=save_raw_snapshots)
 
         self._colormap_index = 0
         self._interpolation_index = 3
+        self._buffers = FrameBufferPool()
+        self._zoom_engines = {}
+        self._normalizer = TemperatureNormalizer()
+        self._colormap_cache = ColormapCache(self._colormap_list, colormap_cache_file)
+        if colormap_cache_file is not None and not self._colormap_cache.complete:
+            self._colormap_cache.save()  # Build every LUT once so later starts load them from disk
         self._setup_therm_cam()
         self._t0 = time.time()
         self.update_image_frame()
@@ -53,69 +89,133 @@ class pithermalcam:
         logger.debug("ThermalCam Object deleted.")
 
     def _setup_therm_cam(self):
-        """Initialize the thermal camera"""
+        """Initialize the thermal camera, or use the given frame source (simulated or replayed sensor)"""
         # Setup camera
-        self.i2c = busio.I2C(board.SCL, board.SDA, frequency=800000)  # setup I2C
-        self.mlx = adafruit_mlx90640.MLX90640(self.i2c)  # begin MLX90640 with I2C comm
-        self.mlx.refresh_rate = adafruit_mlx90640.RefreshRate.REFRESH_8_HZ  # set refresh rate
-        time.sleep(0.1)
+        if self.frame_source is None:
+            self.frame_source = MLX90640Source(frequency=800000, refresh_rate=4)  # 4 = RefreshRate.REFRESH_8_HZ
+        self.i2c = getattr(self.frame_source, 'i2c', None)
+        self.mlx = self.frame_source
 
     def _c_to_f(self,temp:float):
         """ Convert temperature from C to F """
         return ((9.0/5.0)*temp+32.0)
 
-    def get_mean_temp(self):
+    def start_capture(self):
+        """Start reading the sensor on a background thread into a ring buffer of raw frames"""
+        if self._capture_thread is not None:
+            return
+        self._frame_ring = FrameRing(self.frame_ring_size)
+        self._capture_thread = CaptureThread(self.mlx, self._frame_ring)
+        self._capture_thread.start()
+
+    def stop_capture(self):
+        """Stop the background capture thread, the sensor is read on demand again afterwards"""
+        if self._capture_thread is None:
+            return
+        self._capture_thread.stop()
+        self._capture_thread = None
+        self._frame_ring = None
+
+    def get_pipeline_stats(self):
+        """Return capture/render stage counters: sensor fps, queue depth, dropped frames and errors"""
+        stats = {'threaded': self._capture_thread is not None, 'frames_rendered': self._frames_rendered}
+        stats.update(self._snapshot_writer.get_stats())
+        if self._stream_server is not None:
+            stats.update(self._stream_server.broadcaster.get_stats())
+        if self._capture_thread is not None:
+            stats.update(self._capture_thread.get_stats())
+        return stats
+
+    def get_mean_temp(self, timeout:float = 0.5):
         """
         Get mean temp of entire field of view. Return both temp C and temp F.
+        Uses the newest frame already read. Only before the first good frame it pulls one, waiting up to timeout
+        seconds for the capture thread, which owns the sensor while it runs. NaN if there still is none.
         """
-        frame = np.zeros((24*32,))  # setup array for storing all 768 temperatures
-        while True:
-            try:
-                self.mlx.getFrame(frame)  # read MLX temperatures into frame var
+        for _ in range(3):
+            if self._temps_valid:
                 break
-            except ValueError:
-                continue  # if error, just read again
-
-        temp_c = np.mean(frame)
+            self._pull_raw_image(timeout)
+        else:
+            return float('nan'), float('nan')
+        temp_c = float(np.nanmean(self._buffers.get('temps', (24*32,), np.float64)))
         temp_f=self._c_to_f(temp_c)
         return temp_c, temp_f
 
-    def _pull_raw_image(self):
+    def _pull_raw_image(self, timeout:float = 0.0):
         """Get one pull of the raw image data, converting temp units if necessary"""
         # Get image
-        self._raw_image = np.zeros((24*32,))
+        frame = self._buffers.get('raw', (24*32,), np.float64)
         try:
-            self.mlx.getFrame(self._raw_image)  # read mlx90640
-            self._temp_min = np.min(self._raw_image)
-            self._temp_max = np.max(self._raw_image)
-            self._raw_image=self._temps_to_rescaled_uints(self._raw_image,self._temp_min,self._temp_max)
+            if self._capture_thread is not None:
+                if not self._frame_ring.read_latest(frame, timeout):
+                    return  # No new sensor frame since the last pull, keep rendering the current one
+            else:
+                self.mlx.getFrame(frame)  # read mlx90640
+            np.copyto(self._buffers.get('temps', (24*32,), np.float64), frame)  # Normalizing replaces NaN pixels in frame
+            self._temps_valid = True
+            self._raw_image=self._temps_to_rescaled_uints(frame)
+            self._temp_min = self._normalizer.frame_min
+            self._temp_max = self._normalizer.frame_max
+            self._raw_frames_pulled+=1
             self._current_frame_processed=False  # Note that the newly updated raw frame has not been processed
         except ValueError:
             print("Math error; continuing...")
-            self._raw_image = np.zeros((24*32,))  # If something went wrong, make sure the raw image has numbers
+            self._raw_image = self._blank_raw_image()  # If something went wrong, make sure the raw image has numbers
             logger.info(traceback.format_exc())
         except OSError:
             print("IO Error; continuing...")
-            self._raw_image = np.zeros((24*32,))  # If something went wrong, make sure the raw image has numbers
+            self._raw_image = self._blank_raw_image()  # If something went wrong, make sure the raw image has numbers
             logger.info(traceback.format_exc())
 
+    def _blank_raw_image(self):
+        """Reset the rescaled raw image buffer to zeros"""
+        norm = self._buffers.get('norm', (24,32), np.uint8)
+        norm.fill(0)
+        return norm
+
     def _process_raw_image(self):
         """Process the raw temp data to a colored image. Filter if necessary"""
-        # Image processing
+        # Image processing, every stage writes into a preallocated buffer
         # Can't apply colormap before ndimage, so reversed in first two options, even though it seems slower
-        if self._interpolation_index==5:  # Scale via scipy only - slowest but seems higher quality
-            self._image = ndimage.zoom(self._raw_image,25)  # interpolate with scipy
-            self._image = cv2.applyColorMap(self._image, cmapy.cmap(self._colormap_list[self._colormap_index]))
-        elif self._interpolation_index==6:  # Scale partially via scipy and partially via cv2 - mix of speed and quality
-            self._image = ndimage.zoom(self._raw_image,10)  # interpolate with scipy
-            self._image = cv2.applyColorMap(self._image, cmapy.cmap(self._colormap_list[self._colormap_index]))
-            self._image = cv2.resize(self._image, (800,600), interpolation=cv2.INTER_CUBIC)
+        if self._interpolation_index in (5,7):  # Scale via scipy only - slowest but seems higher quality
+            zoomed = self._buffers.get('zoom', (24*25,32*25), np.uint8)
+            if self._interpolation_index==7:  # Same spline as scipy, as two precomputed matrix products
+                self._get_zoom_engine(25).zoom(self._raw_image, output=zoomed)
+            else:
+                from scipy import ndimage  # Only modes 5 and 6 need scipy
+                ndimage.zoom(self._raw_image, 25, output=zoomed)  # interpolate with scipy
+            image = self._buffers.get('colored', zoomed.shape+(3,), np.uint8)
+            self._colormap_cache.colorize(zoomed, self._colormap_index, dst=image)
+        elif self._interpolation_index in (6,8):  # Scale partially via scipy and partially via cv2 - mix of speed and quality
+            zoomed = self._buffers.get('zoom', (24*10,32*10), np.uint8)
+            if self._interpolation_index==8:  # Same spline as scipy, as two precomputed matrix products
+                self._get_zoom_engine(10).zoom(self._raw_image, output=zoomed)
+            else:
+                from scipy import ndimage
+                ndimage.zoom(self._raw_image, 10, output=zoomed)  # interpolate with scipy
+            colored = self._buffers.get('colored', zoomed.shape+(3,), np.uint8)
+            self._colormap_cache.colorize(zoomed, self._colormap_index, dst=colored)
+            image = self._buffers.get('image', (600,800,3), np.uint8)
+            cv2.resize(colored, (800,600), dst=image, interpolation=cv2.INTER_CUBIC)
         else:
-            self._image = cv2.applyColorMap(self._raw_image, cmapy.cmap(self._colormap_list[self._colormap_index]))
-            self._image = cv2.resize(self._image, (800,600), interpolation=self._interpolation_list[self._interpolation_index])
-        self._image = cv2.flip(self._image, 1)
+            colored = self._buffers.get('colored', (24,32,3), np.uint8)
+            self._colormap_cache.colorize(self._raw_image, self._colormap_index, dst=colored)
+            image = self._buffers.get('image', (600,800,3), np.uint8)
+            cv2.resize(colored, (800,600), dst=image, interpolation=self._interpolation_list[self._interpolation_index])
+        flipped = self._buffers.get('flipped', image.shape, np.uint8)
+        image = cv2.flip(image, 1, dst=flipped)
         if self.filter_image:
-            self._image=cv2.bilateralFilter(self._image,15,80,80)
+            filtered = self._buffers.get('filtered', image.shape, np.uint8)
+            image = cv2.bilateralFilter(image, 15, 80, 80, dst=filtered)
+        self._image = image
+
+    def _get_zoom_engine(self, factor):
+        """Return the separable bicubic zoom engine for a factor, building its weight matrices on first use"""
+        engine = self._zoom_engines.get(factor)
+        if engine is None:
+            engine = self._zoom_engines[factor] = SeparableZoom(factor)
+        return engine
 
     def _add_image_text(self):
         """Set image text content"""
@@ -125,12 +225,14 @@ class pithermalcam:
             text = f'Tmin={temp_min:+.1f}F - Tmax={temp_max:+.1f}F - FPS={1/(time.time() - self._t0):.1f} - Interpolation: {self._interpolation_list_name[self._interpolation_index]} - Colormap: {self._colormap_list[self._colormap_index]} - Filtered: {self.filter_image}'
         else:
             text = f'Tmin={self._temp_min:+.1f}C - Tmax={self._temp_max:+.1f}C - FPS={1/(time.time() - self._t0):.1f} - Interpolation: {self._interpolation_list_name[self._interpolation_index]} - Colormap: {self._colormap_list[self._colormap_index]} - Filtered: {self.filter_image}'
+        if self._capture_thread is not None:
+            text += f' - Sensor FPS={self._capture_thread.fps:.1f} - Dropped: {self._frame_ring.frames_dropped}'
         cv2.putText(self._image, text, (30, 18), cv2.FONT_HERSHEY_SIMPLEX, .4, (255, 255, 255), 1)
         self._t0 = time.time()  # Update time to this pull
 
         # For a brief period after saving, display saved notification
         if self._file_saved_notification_start is not None and (time.monotonic()-self._file_saved_notification_start)<1:
-            cv2.putText(self._image, 'Snapshot Saved!', (300,300),cv2.FONT_HERSHEY_SIMPLEX, .8, (255, 255, 255), 2)
+            cv2.putText(self._image, self._file_saved_notification, (300,300),cv2.FONT_HERSHEY_SIMPLEX, .8, (255, 255, 255), 2)
 
     def add_customized_text(self,text):
         """Add custom text to the center of the image, used mostly to notify user that server is off."""
@@ -153,6 +255,8 @@ class pithermalcam:
         key = cv2.waitKey(1) & 0xFF
         if key == ord("s"):  # If s is chosen, save an image to filec
             self.save_image()
+        elif key == ord("b"):  # If b is chosen, save the next burst_length frames
+            self.start_burst()
         elif key == ord("c"):  # If c is chosen cycle the colormap used
             self.change_colormap()
         elif key == ord("x"):  # If c is chosen cycle the colormap used
@@ -182,6 +286,7 @@ class pithermalcam:
         print("The following keys are shortcuts for controlling the video during a run:")
         print("Esc - Exit and Close.")
         print("S - Save a Snapshot of the Current Frame")
+        print(f"B - Save a Burst of the Next {self.burst_length} Frames")
         print("X - Cycle the Colormap Backwards")
         print("C - Cycle the Colormap forward")
         print("F - Toggle Filtering On/Off")
@@ -228,6 +333,13 @@ class pithermalcam:
         self._process_raw_image()
         self._add_image_text()
         self._current_frame_processed=True
+        self._frames_rendered+=1
+        if self._burst_remaining and self._burst_last_frame!=self._raw_frames_pulled:
+            self._save_burst_frame()
+        if self._stream_server is not None and self._streamed_frame!=self._raw_frames_pulled:
+            # Encoded once per new sensor frame for all clients, and only while somebody is connected
+            if self._stream_server.broadcaster.publish(self._image):
+                self._streamed_frame = self._raw_frames_pulled
         return self._image
 
     def update_raw_image_only(self):
@@ -248,31 +360,70 @@ class pithermalcam:
             self._current_frame_processed=True
         return self._image
 
+    def start_server(self, port:int = 8000, host:str = '0.0.0.0', quality:int = 80):
+        """Serve the processed image as MJPEG on http://host:port/ (stream at /stream.mjpg)"""
+        if self._stream_server is None:
+            self._stream_server = MJPEGServer(MJPEGBroadcaster(quality), host, port).start()
+            logger.info("MJPEG server listening on port %d", self._stream_server.port)
+        return self._stream_server
+
+    def stop_server(self):
+        """Stop the MJPEG server and disconnect its clients"""
+        if self._stream_server is not None:
+            self._stream_server.stop()
+            self._stream_server = None
+            self.add_customized_text('Server Stopped')
+
     def save_image(self):
-        """Save the current frame as a snapshot to the output folder."""
-        fname = self.output_folder + 'pic_' + dt.datetime.now().strftime('%Y-%m-%d_%H-%M-%S') + '.jpg'
-        cv2.imwrite(fname, self._image)
+        """Queue the current frame as a snapshot to the output folder, written in the background."""
+        fname = self.output_folder + 'pic_' + dt.datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
+        self._submit_snapshot(fname)
+
+    def start_burst(self, frames:int = None):
+        """Save each of the next frames (burst_length by default) as a numbered snapshot."""
+        self._burst_remaining = self.burst_length if frames is None else frames
+        self._burst_stem = self.output_folder + 'burst_' + dt.datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
+        self._burst_index = 0
+        self._burst_last_frame = None
+
+    def _save_burst_frame(self):
+        """Save the current frame as the next one of the running burst"""
+        self._submit_snapshot(f'{self._burst_stem}_{self._burst_index:03d}')
+        self._burst_index += 1
+        self._burst_remaining -= 1
+        self._burst_last_frame = self._raw_frames_pulled
+
+    def _submit_snapshot(self, path_stem:str):
+        """Hand the current image and raw temperatures to the snapshot writer without waiting for the disk"""
+        raw = self._buffers.get('raw', (24*32,), np.float64)
+        if self._snapshot_writer.submit(path_stem, self._image, raw):
+            self._file_saved_notification = 'Snapshot Saved!'
+        else:
+            self._file_saved_notification = 'Snapshot Dropped, Writer Busy!'
+            logger.warning("Snapshot writer queue full, dropped %s", path_stem)
         self._file_saved_notification_start = time.monotonic()
-        print('Thermal Image ', fname)
 
-    def _temps_to_rescaled_uints(self,f,Tmin,Tmax):
-        """Function to convert temperatures to pixels on image"""
-        f=np.nan_to_num(f)
-        norm = np.uint8((f - Tmin)*255/(Tmax-Tmin))
-        norm.shape = (24,32)
-        return norm
+    def _temps_to_rescaled_uints(self,f):
+        """Function to convert temperatures to pixels on image, uniform and NaN frames included"""
+        return self._normalizer.normalize(f, out=self._buffers.get('norm', (24,32), np.uint8))
 
     def display_camera_onscreen(self):
+        if self.threaded_capture:
+            self.start_capture()
         # Loop to display frames unless/until user requests exit
-        while not self._exit_requested:
-            try:
-                self.display_next_frame_onscreen()
-            # Catch a common I2C Error. If you get this too often consider checking/adjusting your I2C Baudrate
-            except RuntimeError as e:
-                if e.message == 'Too many retries':
-                    print("Too many retries error caught, potential I2C baudrate issue: continuing...")
-                    continue
-                raise
+        try:
+            while not self._exit_requested:
+                try:
+                    self.display_next_frame_onscreen()
+                # Catch a common I2C Error. If you get this too often consider checking/adjusting your I2C Baudrate
+                except RuntimeError as e:
+                    if str(e) == 'Too many retries':
+                        print("Too many retries error caught, potential I2C baudrate issue: continuing...")
+                        continue
+                    raise
+        finally:
+            self.stop_capture()
+            self._snapshot_writer.flush()
 
 if __name__ == "__main__":
     # If class is run as main, read ini and set up a live feed displayed to screen
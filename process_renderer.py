@@ -0,0 +1,147 @@
+"""Render frames on a pool of worker processes.
+
+The display process keeps the cheap, stateful stages (sensor read, filters, color range) and
+ships each normalized 24x32 frame, 768 bytes, to the next free worker. The worker runs the
+heavy, stateless ones (spline zoom, colormap, resize, screen resolution filter) outside the
+GIL of the display process and writes the image straight into a shared memory slot. Results
+carry the frame sequence number, so a frame that finishes after a newer one is dropped rather
+than shown out of order.
+"""
+import logging
+import multiprocessing
+import queue
+from multiprocessing import shared_memory
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def _worker(shm_name:str, slots:int, shape:tuple, jobs, results):
+    import Settings
+    Settings.RENDER_PROCESSES = 0  # The worker's own camera renders in place
+    Settings.RENDER_SCALE = 1.0  # shape already is the final render size
+    # The worker's camera only renders, it must not write files the display process owns
+    Settings.HISTORY_FOLDER = None
+    Settings.PROFILE_DUMP_FILE = None
+    Settings.ALARM_SNAPSHOT_FOLDER = None
+    Settings.ADAPTIVE_REFRESH_RATE = False
+    Settings.THREADED_CAPTURE = False
+    from denfilm_pi_thermal_cam import pithermalcam
+    from frame_sources import ReplaySource
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        images = np.ndarray((slots,) + shape, dtype=np.uint8, buffer=shm.buf)
+        # Frames come in through the job queue, the source only feeds the first render in the constructor
+        camera = pithermalcam(frame_source=ReplaySource(np.zeros((1, 24*32))), output_size=(shape[1], shape[0]))
+        while True:
+            job = jobs.get()
+            if job is None:
+                break
+            seq, slot, raw_image, (interpolation, colormap, filter_image, filter_mode) = job
+            camera._interpolation_index, camera._colormap_index = interpolation, colormap
+            camera.filter_image, camera.filter_mode = filter_image, filter_mode
+            camera._raw_image = raw_image
+            camera._process_raw_image()
+            np.copyto(images[slot], camera._base_image)
+            results.put((seq, slot))
+        del images
+    finally:
+        shm.close()
+
+
+class ProcessRenderer:
+    """Pool of render processes sharing a block of output image slots with the display process."""
+
+    def __init__(self, processes:int, shape:tuple, slots:int = None):
+        self.processes = processes
+        self.shape = tuple(shape)  # (height, width, 3) of the rendered image
+        self.slots = slots or 2*processes
+        self.submitted = 0
+        self.completed = 0
+        self.busy = 0  # Submits refused because every slot was in use
+        self.late = 0  # Finished after a newer frame and discarded
+        context = multiprocessing.get_context('spawn')  # Forking a process with capture threads running is unsafe
+        self._shm = shared_memory.SharedMemory(create=True, size=self.slots*int(np.prod(self.shape)))
+        self._images = np.ndarray((self.slots,) + self.shape, dtype=np.uint8, buffer=self._shm.buf)
+        self._jobs = context.Queue()
+        self._results = context.Queue()
+        self._free = list(range(self.slots))
+        self._seq = 0
+        self._ready = None  # (seq, slot) of the newest finished frame not collected yet
+        self._shown_seq = 0
+        self._workers = [context.Process(target=_worker, args=(self._shm.name, self.slots, self.shape, self._jobs, self._results),
+                                         name=f'render-{i}', daemon=True) for i in range(processes)]
+        for worker in self._workers:
+            worker.start()
+
+    @property
+    def pending(self):
+        """Frames submitted and not collected yet."""
+        return self.slots - len(self._free)
+
+    def submit(self, raw_image, params:tuple):
+        """Queue a normalized (24,32) uint8 frame with (interpolation, colormap, filter_image, filter_mode).
+
+        Returns False if every slot is still in use, try again after the next collect().
+        """
+        if not self._free:
+            self.busy += 1
+            return False
+        self._seq += 1
+        self._jobs.put((self._seq, self._free.pop(), np.array(raw_image), params))
+        self.submitted += 1
+        return True
+
+    def poll(self, timeout:float = 0.0):
+        """Take the finished frames off the result queue. Returns True if one newer than the last collected is ready."""
+        while True:
+            try:
+                if self._ready is None and timeout > 0:
+                    seq, slot = self._results.get(timeout=timeout)
+                else:
+                    seq, slot = self._results.get_nowait()
+            except queue.Empty:
+                if self._ready is None:
+                    self._check_workers()
+                return self._ready is not None
+            self.completed += 1
+            if seq < self._shown_seq or (self._ready is not None and seq < self._ready[0]):
+                self.late += 1  # A worker was slower than the one that rendered a newer frame
+                self._free.append(slot)
+                continue
+            if self._ready is not None:
+                self.late += 1
+                self._free.append(self._ready[1])
+            self._ready = (seq, slot)
+
+    def _check_workers(self):
+        """Raise rather than wait forever for frames a crashed worker will never render."""
+        for worker in self._workers:
+            if worker.exitcode is not None:
+                raise RuntimeError(f"Render process {worker.name} exited with code {worker.exitcode}")
+
+    def collect(self, out):
+        """Copy the newest finished frame into out and free its slot. Returns its sequence number, None if none is ready."""
+        if self._ready is None and not self.poll():
+            return None
+        seq, slot = self._ready
+        np.copyto(out, self._images[slot])
+        self._free.append(slot)
+        self._ready = None
+        self._shown_seq = seq
+        return seq
+
+    def get_stats(self):
+        return {'render_processes': self.processes, 'render_submitted': self.submitted, 'render_completed': self.completed,
+                'render_busy': self.busy, 'render_late': self.late, 'render_pending': self.pending}
+
+    def close(self):
+        for _ in self._workers:
+            self._jobs.put(None)
+        for worker in self._workers:
+            worker.join(5)
+            if worker.is_alive():
+                worker.terminate()
+        del self._images
+        self._shm.close()
+        self._shm.unlink()
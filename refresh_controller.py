@@ -0,0 +1,147 @@
+"""Adaptive MLX90640 refresh rate.
+
+Which refresh rate a Pi/sensor/cable combination can sustain without 'Too many retries' and
+I2C errors differs from setup to setup. The controller watches the outcome of every read over
+a sliding window. It steps the refresh rate up while reads are clean and the frame rate really
+improves, and back down when errors pile up. A rate that failed is not probed again for a
+while, and that pause doubles on every new failure. Bursts of OSError/RuntimeError also make
+the reader back off exponentially before the next read, instead of hammering the bus.
+"""
+import logging
+import time
+from collections import deque
+from frame_sources import refresh_hz
+
+logger = logging.getLogger(__name__)
+
+
+class RefreshRateController:
+    """Chooses source.refresh_rate from the read results reported by the thread that reads the sensor.
+
+    Only call frame_ok()/frame_failed() from that thread: changing the refresh rate is an I2C
+    write and must not interleave with a read.
+    """
+
+    def __init__(self, source, min_rate:int = 1, max_rate:int = 5, window:int = 32, step_down_error_rate:float = 0.2,
+                 step_up_error_rate:float = 0.02, min_gain:float = 1.1, probe_interval:float = 30.0,
+                 backoff_initial:float = 0.05, backoff_max:float = 2.0, clock=time.monotonic):
+        self.source = source
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.window = window
+        self.step_down_error_rate = step_down_error_rate
+        self.step_up_error_rate = step_up_error_rate
+        self.min_gain = min_gain  # A faster rate has to raise the frame rate by this factor to be kept
+        self.probe_interval = probe_interval
+        self.backoff_initial = backoff_initial
+        self.backoff_max = backoff_max
+        self._clock = clock
+        self._results = deque(maxlen=window)  # (time, ok) of the reads at the current rate
+        self._throughput = {}  # Frame rate measured at each rate over a full window
+        self._strikes = {}  # Failures per rate, doubles the time before it is probed again
+        self._blocked_until = {}
+        self._consecutive_errors = 0
+        self.steps_up = 0
+        self.steps_down = 0
+        self.backoffs = 0
+        self.backoff_time = 0.0
+        self.frames_ok = 0
+        self.errors = {'value': 0, 'io': 0, 'retry': 0}
+
+    @property
+    def refresh_rate(self):
+        return self.source.refresh_rate
+
+    @property
+    def error_rate(self):
+        if not self._results:
+            return 0.0
+        return sum(not ok for _, ok in self._results)/len(self._results)
+
+    @property
+    def throughput(self):
+        """Good frames per second over the window."""
+        good = [t for t, ok in self._results if ok]
+        if len(good) < 2:
+            return 0.0
+        return (len(good) - 1)/(good[-1] - good[0]) if good[-1] > good[0] else 0.0
+
+    @property
+    def latency(self):
+        """Average time between good frames over the window, in seconds."""
+        throughput = self.throughput
+        return 1/throughput if throughput > 0 else None
+
+    def frame_ok(self):
+        """Report a good read."""
+        self.frames_ok += 1
+        self._consecutive_errors = 0
+        self._results.append((self._clock(), True))
+        self._evaluate()
+
+    def frame_failed(self, error:Exception):
+        """Report a failed read. Returns how many seconds the reader should wait before the next one."""
+        if isinstance(error, ValueError):
+            self.errors['value'] += 1  # Bad data, the bus itself is fine, read again right away
+            delay = 0.0
+        else:
+            self.errors['retry' if isinstance(error, RuntimeError) else 'io'] += 1
+            self._consecutive_errors += 1
+            delay = 0.0
+            if self._consecutive_errors > 1:
+                delay = min(self.backoff_initial*2**(self._consecutive_errors - 2), self.backoff_max)
+                self.backoffs += 1
+                self.backoff_time += delay
+        self._results.append((self._clock(), False))
+        self._evaluate()
+        return delay
+
+    def _evaluate(self):
+        if len(self._results) < self.window:
+            return
+        rate = self.refresh_rate
+        error_rate = self.error_rate
+        if error_rate > self.step_down_error_rate and rate > self.min_rate:
+            self._fail(rate, f"error rate {error_rate:.0%}")
+        elif error_rate <= self.step_up_error_rate:
+            throughput = self.throughput
+            slower = self._throughput.get(rate - 1)
+            if slower is not None and rate > self.min_rate and throughput < slower*self.min_gain:
+                # Clean, but the bus or the reader can't keep up, so the faster rate buys nothing
+                self._fail(rate, f"{throughput:.1f} fps is no faster than {slower:.1f} fps")
+                return
+            self._throughput[rate] = throughput
+            if rate < self.max_rate and self._clock() >= self._blocked_until.get(rate + 1, 0.0):
+                self._set_rate(rate + 1)
+                self.steps_up += 1
+
+    def _fail(self, rate:int, reason:str):
+        strikes = self._strikes[rate] = self._strikes.get(rate, 0) + 1
+        self._blocked_until[rate] = self._clock() + self.probe_interval*2**(strikes - 1)
+        self._throughput.pop(rate, None)
+        logger.info("Refresh rate %s Hz unstable (%s), stepping down", refresh_hz(rate), reason)
+        self._set_rate(rate - 1)
+        self.steps_down += 1
+
+    def _set_rate(self, rate:int):
+        self.source.refresh_rate = rate
+        self._results.clear()
+        logger.info("Sensor refresh rate set to %s Hz", refresh_hz(rate))
+
+    def get_stats(self):
+        latency = self.latency
+        return {
+            'refresh_rate': self.refresh_rate,
+            'refresh_hz': refresh_hz(self.refresh_rate),
+            'error_rate': self.error_rate,
+            'throughput_fps': self.throughput,
+            'latency_ms': latency*1000 if latency is not None else None,
+            'steps_up': self.steps_up,
+            'steps_down': self.steps_down,
+            'backoffs': self.backoffs,
+            'backoff_time': self.backoff_time,
+            'frames_ok': self.frames_ok,
+            'value_errors': self.errors['value'],
+            'io_errors': self.errors['io'],
+            'retry_errors': self.errors['retry'],
+        }
@@ -0,0 +1,117 @@
+"""Temperature statistics for regions of interest, computed on the raw 24x32 grid.
+
+Regions are given in display coordinates (pixels of the image on screen) and turned into a
+boolean mask over the sensor pixels once, when they are added. All regions are then evaluated
+together on a raw frame: one argsort of the 768 temperatures gives min, max and percentiles of
+every region from cumulative member counts in sorted order, and one matrix product gives the
+means. Percentiles use the nearest-rank definition, so every value is a real sensor reading.
+"""
+import numpy as np
+import cv2
+
+ROWS, COLS = 24, 32
+
+
+class RoiAnalyzer:
+    """Named spot, rectangle, polygon and mask regions, evaluated in one pass per frame."""
+
+    def __init__(self, display_size:tuple, percentiles:tuple = (50, 90), shape:tuple = (ROWS, COLS)):
+        self.display_size = display_size  # (width, height) of the image the coordinates refer to
+        self.percentiles = tuple(percentiles)
+        self.shape = shape
+        self._masks = {}
+        self._names = []
+        self._stack = np.zeros((0, shape[0]*shape[1]), dtype=bool)
+
+    @property
+    def names(self):
+        return list(self._names)
+
+    def _to_grid(self, x:float, y:float):
+        """Display coordinates to (continuous) sensor grid coordinates, pixel (r, c) spanning [c, c+1) x [r, r+1)."""
+        return x*self.shape[1]/self.display_size[0], y*self.shape[0]/self.display_size[1]
+
+    def _add(self, name:str, mask):
+        if name not in self._masks:
+            self._names.append(name)
+        self._masks[name] = mask
+        self._stack = np.stack([self._masks[n].reshape(-1) for n in self._names])
+
+    def add_spot(self, name:str, x:float, y:float):
+        """Single sensor pixel under the display point (x, y)."""
+        gx, gy = self._to_grid(x, y)
+        mask = np.zeros(self.shape, dtype=bool)
+        mask[min(max(int(gy), 0), self.shape[0]-1), min(max(int(gx), 0), self.shape[1]-1)] = True
+        self._add(name, mask)
+
+    def add_rect(self, name:str, x0:float, y0:float, x1:float, y1:float):
+        """Every sensor pixel the display rectangle (x0, y0)-(x1, y1) touches, at least one."""
+        gx0, gy0 = self._to_grid(min(x0, x1), min(y0, y1))
+        gx1, gy1 = self._to_grid(max(x0, x1), max(y0, y1))
+        r0 = min(max(int(np.floor(gy0)), 0), self.shape[0]-1)
+        c0 = min(max(int(np.floor(gx0)), 0), self.shape[1]-1)
+        r1 = min(max(int(np.ceil(gy1)), r0+1), self.shape[0])
+        c1 = min(max(int(np.ceil(gx1)), c0+1), self.shape[1])
+        mask = np.zeros(self.shape, dtype=bool)
+        mask[r0:r1, c0:c1] = True
+        self._add(name, mask)
+
+    def add_polygon(self, name:str, points):
+        """Sensor pixels whose centers lie inside the polygon given as display (x, y) points."""
+        shift = 4  # cv2.fillPoly takes fixed point coordinates, 1/16 sensor pixel is plenty
+        grid = np.array([self._to_grid(x, y) for x, y in points]) - 0.5  # cv2 puts pixel centers on integers
+        mask = np.zeros(self.shape, dtype=np.uint8)
+        cv2.fillPoly(mask, [np.round(grid*(1 << shift)).astype(np.int32)], 1, cv2.LINE_8, shift)
+        self._add(name, mask.astype(bool))
+
+    def add_mask(self, name:str, mask):
+        """Boolean mask at display resolution, or already at sensor resolution. Pixels at least half covered count."""
+        mask = np.asarray(mask)
+        if mask.shape != self.shape:
+            mask = cv2.resize(mask.astype(np.float32), (self.shape[1], self.shape[0]), interpolation=cv2.INTER_AREA) >= 0.5
+        self._add(name, mask.astype(bool))
+
+    def remove(self, name:str):
+        if name in self._masks:
+            self._names.remove(name)
+            del self._masks[name]
+            self._stack = (np.stack([self._masks[n].reshape(-1) for n in self._names]) if self._names
+                           else np.zeros((0, self.shape[0]*self.shape[1]), dtype=bool))
+
+    def mask(self, name:str):
+        """The (24,32) sensor mask of a region."""
+        return self._masks[name]
+
+    def analyze(self, frame, timestamp:float = None):
+        """Statistics of every region on frame (768 temperatures in C, NaN pixels are ignored).
+
+        Returns {'timestamp': timestamp, 'rois': {name: {'pixels', 'min', 'max', 'mean', 'p50', ...}}}.
+        Values are NaN for a region without valid pixels.
+        """
+        results = {'timestamp': timestamp, 'rois': {}}
+        if not self._names:
+            return results
+        frame = np.asarray(frame).reshape(-1)
+        valid = ~np.isnan(frame)
+        members = self._stack & valid  # (regions, 768)
+        counts = members.sum(axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means = members @ np.where(valid, frame, 0)/counts
+        order = np.argsort(frame)  # NaNs sort last and are never members
+        ranked = np.cumsum(members[:, order], axis=1)  # Running member count per region in sorted order
+        values = frame[order]
+        columns = {'min': np.ones_like(counts), 'max': counts}
+        for p in self.percentiles:
+            columns[f'p{p:g}'] = np.maximum(np.ceil(counts*p/100).astype(counts.dtype), 1)
+        stats = {}
+        for key, rank in columns.items():
+            # Position of the rank-th member in sorted order is the first index where the running count reaches it
+            stats[key] = np.where(counts > 0, values[np.argmax(ranked >= rank[:, None], axis=1)], np.nan)
+        for i, name in enumerate(self._names):
+            roi = {'pixels': int(counts[i]), 'min': float(stats['min'][i]), 'max': float(stats['max'][i]),
+                   'mean': float(means[i])}
+            for key in columns:
+                if key not in roi:
+                    roi[key] = float(stats[key][i])
+            results['rois'][name] = roi
+        return results
@@ -0,0 +1,95 @@
+"""Noise filters on the raw 24x32 temperature grid.
+
+Filtering before upscaling and colorizing touches 768 temperatures per frame instead of the
+millions of screen pixels cv2.bilateralFilter had to process on the finished image, and it
+filters real temperatures rather than colormap colors. Every raw frame goes into a short
+history, so the filter mode can be switched at runtime without a warm-up.
+"""
+import numpy as np
+import cv2
+
+FILTER_TEMPORAL_IIR = 'temporal_iir'  # Exponential moving average over frames, lowest noise, trails moving objects
+FILTER_TEMPORAL_MEDIAN = 'temporal_median'  # Median of the last frames, removes single frame spikes
+FILTER_BILATERAL = 'bilateral'  # Edge preserving spatial filter on the float grid, no motion lag
+FILTER_SCREEN_BILATERAL = 'screen_bilateral'  # The old bilateral filter on the upscaled image, very slow
+FILTER_MODES = (FILTER_TEMPORAL_IIR, FILTER_TEMPORAL_MEDIAN, FILTER_BILATERAL, FILTER_SCREEN_BILATERAL)
+SENSOR_FILTER_MODES = FILTER_MODES[:3]
+
+
+class SensorFilter:
+    """Keeps the recent raw frames and filters the newest one with the selected sensor resolution filter."""
+
+    def __init__(self, mode:str = FILTER_BILATERAL, history:int = 5, iir_alpha:float = 0.3,
+                 bilateral_sigma:float = 1.0, bilateral_diameter:int = 5, shape:tuple = (24,32),
+                 bilateral_sigma_space:float = 5.0):
+        if mode not in SENSOR_FILTER_MODES:
+            raise ValueError(f"Unknown sensor filter mode {mode!r}, expected one of {SENSOR_FILTER_MODES}")
+        self.mode = mode
+        self.iir_alpha = iir_alpha  # Weight of the newest frame
+        self.bilateral_sigma = bilateral_sigma  # Temperature difference in C that still gets averaged
+        self.bilateral_diameter = bilateral_diameter  # Neighbourhood in sensor pixels
+        self.bilateral_sigma_space = bilateral_sigma_space  # Distance in sensor pixels the weights fall off over
+        self.shape = shape
+        size = shape[0]*shape[1]
+        self._history = np.zeros((history, size))
+        self._state = np.zeros(size)
+        self._state_stale = True  # The running average only follows the frames while mode is the IIR filter
+        self._scratch = np.zeros(size)
+        self._nan_mask = np.zeros(size, dtype=bool)
+        self._grid = np.zeros(shape, np.float32)
+        self._grid_out = np.zeros(shape, np.float32)
+        self._count = 0
+        self._latest = -1
+
+    def reset(self):
+        self._count = 0
+        self._latest = -1
+        self._state_stale = True
+
+    def push(self, frame):
+        """Add a raw frame (768 temperatures in C) to the history. frame itself is not modified.
+
+        Runs on every frame even while filtering is off, so it allocates nothing and only updates the
+        running average in the IIR mode. The history ring also holds the newest frame for the other modes.
+        """
+        index = (self._latest + 1) % len(self._history)
+        slot = self._history[index]
+        np.copyto(slot, frame)
+        # A NaN pixel would stay in the history (and the IIR state) for good, repeat the last good value instead
+        np.isnan(slot, out=self._nan_mask)
+        if self._nan_mask.any():
+            if self._count:
+                np.copyto(slot, self._history[self._latest], where=self._nan_mask)
+            elif not self._nan_mask.all():
+                np.copyto(slot, np.nanmean(frame), where=self._nan_mask)
+            else:
+                return  # Nothing usable yet
+        self._latest = index
+        self._count = min(self._count + 1, len(self._history))
+        if self.mode != FILTER_TEMPORAL_IIR:
+            self._state_stale = True
+        elif self._state_stale:
+            np.copyto(self._state, slot)  # Start averaging from the newest frame
+            self._state_stale = False
+        else:
+            np.subtract(slot, self._state, out=self._scratch)
+            self._scratch *= self.iir_alpha
+            self._state += self._scratch
+
+    def apply(self, out):
+        """Write the filtered newest frame into out (flat float array). Returns False if no frame was pushed yet."""
+        if not self._count:
+            return False
+        if self.mode == FILTER_TEMPORAL_IIR:
+            if self._state_stale:  # Just switched to the IIR filter
+                np.copyto(self._state, self._history[self._latest])
+                self._state_stale = False
+            np.copyto(out, self._state)
+        elif self.mode == FILTER_TEMPORAL_MEDIAN:
+            np.median(self._history[:self._count], axis=0, out=out)
+        else:
+            np.copyto(self._grid, self._history[self._latest].reshape(self.shape))
+            cv2.bilateralFilter(self._grid, self.bilateral_diameter, self.bilateral_sigma, self.bilateral_sigma_space,
+                                dst=self._grid_out)
+            np.copyto(out, self._grid_out.reshape(-1))
+        return True
@@ -0,0 +1,96 @@
+"""Non-blocking snapshot saving.
+
+cv2.imwrite to an SD card can take tens to hundreds of milliseconds. Snapshots are copied
+into one of a few preallocated slots (the frame buffers are reused by the next frame, so a
+plain reference would be overwritten) and encoded/written by a background thread. When all
+slots are busy the snapshot is dropped and counted instead of stalling the caller.
+"""
+import logging
+import queue
+import threading
+import numpy as np
+import cv2
+
+logger = logging.getLogger(__name__)
+
+IMAGE_FORMATS = ('jpg', 'png')
+
+
+class SnapshotWriter:
+    """Background writer for snapshots as JPEG/PNG, optionally with the raw temperatures as .npy."""
+
+    def __init__(self, slots:int = 8, formats:tuple = ('jpg',), save_raw:bool = False):
+        for fmt in formats:
+            if fmt not in IMAGE_FORMATS:
+                raise ValueError(f"Unsupported snapshot format {fmt!r}, expected one of {IMAGE_FORMATS}")
+        self.formats = tuple(formats)
+        self.save_raw = save_raw
+        self.saved = 0
+        self.dropped = 0
+        self.failed = 0
+        self._free = queue.Queue()
+        self._pending = queue.Queue()
+        for _ in range(slots):
+            self._free.put({'image': None, 'raw': None})
+        self._thread = threading.Thread(target=self._run, name='snapshot-writer', daemon=True)
+        self._thread.start()
+
+    @property
+    def pending(self):
+        """Snapshots queued but not written yet."""
+        return self._pending.qsize()
+
+    @staticmethod
+    def _copy_into(slot:dict, key:str, array):
+        buf = slot[key]
+        if buf is None or buf.shape != array.shape or buf.dtype != array.dtype:
+            buf = slot[key] = np.empty_like(array)
+        np.copyto(buf, array)
+
+    def submit(self, path_stem:str, image, raw=None):
+        """Queue a snapshot saved as path_stem + '.<format>'. Returns False (and counts a drop) if the writer is full."""
+        try:
+            slot = self._free.get_nowait()
+        except queue.Empty:
+            self.dropped += 1
+            return False
+        self._copy_into(slot, 'image', image)
+        has_raw = self.save_raw and raw is not None
+        if has_raw:
+            self._copy_into(slot, 'raw', raw)
+        self._pending.put((path_stem, slot, has_raw))
+        return True
+
+    def _run(self):
+        while True:
+            item = self._pending.get()
+            if item is None:
+                self._pending.task_done()
+                break
+            path_stem, slot, has_raw = item
+            try:
+                for fmt in self.formats:
+                    if not cv2.imwrite(path_stem + '.' + fmt, slot['image']):
+                        raise OSError(f"cv2.imwrite could not write {path_stem}.{fmt}")
+                if has_raw:
+                    np.save(path_stem + '.npy', slot['raw'].reshape(24,32))
+                self.saved += 1
+                print('Thermal Image ', path_stem + '.' + self.formats[0])
+            except Exception:  # Also cv2 encode errors, the thread must outlive a bad snapshot or flush() never returns
+                self.failed += 1
+                logger.warning("Saving snapshot %s failed", path_stem, exc_info=True)
+            self._free.put(slot)
+            self._pending.task_done()
+
+    def get_stats(self):
+        return {'snapshots_saved': self.saved, 'snapshots_pending': self.pending,
+                'snapshots_dropped': self.dropped, 'snapshots_failed': self.failed}
+
+    def flush(self):
+        """Block until every queued snapshot is written."""
+        self._pending.join()
+
+    def close(self):
+        """Finish writing the queued snapshots and stop the thread."""
+        self._pending.put(None)
+        self._thread.join()
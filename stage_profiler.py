@@ -0,0 +1,109 @@
+"""Lightweight per-stage frame profiler.
+
+Each stage keeps its last N perf_counter_ns timings in a fixed-size ring, so recording a
+sample is an array store and percentiles are only computed when somebody asks for them.
+"""
+import json
+import logging
+import time
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+STAGES = ('i2c_read','alarms','normalize','interpolate','colorize','filter','text','imshow','frame')
+
+
+class StageProfiler:
+    """Rolling per-stage latency histograms plus dropped/errored frame counters."""
+
+    def __init__(self, stages:tuple = STAGES, window:int = 256):
+        self.stages = tuple(stages)
+        self.window = window
+        self._samples = {stage: np.zeros(window, dtype=np.int64) for stage in self.stages}
+        self._counts = {stage: 0 for stage in self.stages}
+        self._last_frame_end = None
+        self.error_frames = 0
+        self.dropped_frames = 0
+        self._last_dump = time.monotonic()
+
+    @staticmethod
+    def now():
+        return time.perf_counter_ns()
+
+    def record(self, stage:str, duration_ns:int):
+        """Store one timing sample for a stage."""
+        count = self._counts[stage]
+        self._samples[stage][count % self.window] = duration_ns
+        self._counts[stage] = count + 1
+
+    def lap(self, stage:str, t_start:int):
+        """Record the time since t_start for a stage and return the current time, to chain stages."""
+        t_now = time.perf_counter_ns()
+        self.record(stage, t_now - t_start)
+        return t_now
+
+    def end_frame(self):
+        """Record the interval since the previous frame ended, the basis of the reported FPS."""
+        t_now = time.perf_counter_ns()
+        if self._last_frame_end is not None:
+            self.record('frame', t_now - self._last_frame_end)
+        self._last_frame_end = t_now
+
+    def _window(self, stage:str):
+        return self._samples[stage][:min(self._counts[stage], self.window)]
+
+    @property
+    def fps(self):
+        """Frame rate from the median frame interval, far less noisy than a single sample."""
+        samples = self._window('frame')
+        if samples.size == 0:
+            return 0.0
+        return 1e9/max(float(np.median(samples)), 1.0)
+
+    def get_stats(self):
+        """Return {stage: {count, p50_ms, p95_ms, p99_ms}} plus the dropped/errored frame counters."""
+        stats = {}
+        for stage in self.stages:
+            samples = self._window(stage)
+            if samples.size == 0:
+                continue
+            p50, p95, p99 = (float(p) for p in np.percentile(samples, (50, 95, 99))/1e6)
+            stats[stage] = {'count': self._counts[stage], 'p50_ms': p50, 'p95_ms': p95, 'p99_ms': p99}
+        stats['fps'] = self.fps
+        stats['error_frames'] = self.error_frames
+        stats['dropped_frames'] = self.dropped_frames
+        return stats
+
+    def summary_lines(self):
+        """One short line per stage, for the on-screen overlay."""
+        stats = self.get_stats()
+        lines = [f"{stage}: p50 {s['p50_ms']:.1f} / p95 {s['p95_ms']:.1f} / p99 {s['p99_ms']:.1f} ms"
+                 for stage, s in stats.items() if isinstance(s, dict)]
+        lines.append(f"errors: {self.error_frames} - dropped: {self.dropped_frames}")
+        return lines
+
+    def dump(self, path:str):
+        """Write the current stats to path, as CSV if it ends in .csv and as JSON otherwise."""
+        stats = self.get_stats()
+        stats['timestamp'] = time.time()
+        try:
+            with open(path, 'w') as f:
+                if path.endswith('.csv'):
+                    f.write("stage,count,p50_ms,p95_ms,p99_ms\n")
+                    for stage, s in stats.items():
+                        if isinstance(s, dict):
+                            f.write(f"{stage},{s['count']},{s['p50_ms']:.3f},{s['p95_ms']:.3f},{s['p99_ms']:.3f}\n")
+                    f.write(f"fps,{stats['fps']:.2f},,,\n")
+                    f.write(f"error_frames,{self.error_frames},,,\n")
+                    f.write(f"dropped_frames,{self.dropped_frames},,,\n")
+                else:
+                    json.dump(stats, f, indent=1)
+        except OSError:
+            logger.warning("Could not write profile dump %s", path)
+
+    def maybe_dump(self, path:str, interval:float):
+        """Dump to path if at least interval seconds passed since the last dump."""
+        if path is None or time.monotonic() - self._last_dump < interval:
+            return
+        self._last_dump = time.monotonic()
+        self.dump(path)
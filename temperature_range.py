@@ -0,0 +1,97 @@
+"""Temperature to 8 bit normalization with a stable color range.
+
+Min/max (and their pixel positions) come from a single cv2.minMaxLoc pass, and the
+subtract/scale/saturate/cast to uint8 is one fused cv2.addWeighted call into a preallocated
+buffer. The color range can follow every frame, follow it with exponential smoothing and a
+dead band so the palette stops flickering, or stay locked. Uniform scenes and all-NaN frames
+are handled without raising.
+"""
+import numpy as np
+import cv2
+
+RANGE_AUTO = 'auto'
+RANGE_SMOOTH = 'smooth'
+RANGE_LOCKED = 'locked'
+RANGE_MODES = (RANGE_AUTO, RANGE_SMOOTH, RANGE_LOCKED)
+
+
+class TemperatureNormalizer:
+    """Maps a raw 768 temperature frame to a (24,32) uint8 image."""
+
+    def __init__(self, mode:str = RANGE_AUTO, smoothing:float = 0.2, hysteresis:float = 0.3,
+                 min_span:float = 2.0, locked_range:tuple = None, shape:tuple = (24,32)):
+        if mode not in RANGE_MODES:
+            raise ValueError(f"Unknown temperature range mode {mode!r}, expected one of {RANGE_MODES}")
+        self.mode = mode
+        self.smoothing = smoothing
+        self.hysteresis = hysteresis
+        self.min_span = min_span
+        self.shape = shape
+        self.range_min, self.range_max = locked_range if locked_range is not None else (None, None)
+        self._mode_before_lock = RANGE_AUTO if mode == RANGE_LOCKED else mode
+        # Statistics of the last frame, in C, and the (row, col) of its coldest and hottest pixel
+        self.frame_min = None
+        self.frame_max = None
+        self.min_pos = None
+        self.max_pos = None
+        self._nan_mask = np.zeros(shape[0]*shape[1], dtype=bool)
+        self._out = np.zeros(shape, dtype=np.uint8)
+
+    @property
+    def locked(self):
+        return self.mode == RANGE_LOCKED
+
+    def toggle_lock(self):
+        """Lock the color range to the current one, or return to the mode used before locking."""
+        if self.locked:
+            self.mode = self._mode_before_lock
+        elif self.range_min is not None:
+            self._mode_before_lock = self.mode
+            self.mode = RANGE_LOCKED
+
+    def _frame_stats(self, frame):
+        """Frame min/max ignoring NaNs. NaN pixels are replaced in place by the frame minimum."""
+        np.isnan(frame, out=self._nan_mask)
+        if self._nan_mask.any():
+            if self._nan_mask.all():
+                self.frame_min = self.frame_max = float('nan')
+                return False
+            fill = np.nanmin(frame)
+            np.copyto(frame, fill, where=self._nan_mask)
+        lo, hi, lo_loc, hi_loc = cv2.minMaxLoc(frame.reshape(self.shape))
+        self.frame_min, self.frame_max = lo, hi
+        self.min_pos, self.max_pos = (lo_loc[1], lo_loc[0]), (hi_loc[1], hi_loc[0])
+        return True
+
+    def _update_range(self):
+        lo, hi = self.frame_min, self.frame_max
+        if self.mode == RANGE_LOCKED and self.range_min is not None:
+            return
+        if self.mode == RANGE_SMOOTH and self.range_min is not None:
+            # Only follow changes bigger than the dead band, then move part of the way there
+            if abs(lo - self.range_min) > self.hysteresis:
+                lo = self.range_min + self.smoothing*(lo - self.range_min)
+            else:
+                lo = self.range_min
+            if abs(hi - self.range_max) > self.hysteresis:
+                hi = self.range_max + self.smoothing*(hi - self.range_max)
+            else:
+                hi = self.range_max
+        if hi - lo < self.min_span:  # Uniform scene, widen the range around its center instead of dividing by ~0
+            center = (hi + lo)/2
+            lo, hi = center - self.min_span/2, center + self.min_span/2
+        self.range_min, self.range_max = lo, hi
+
+    def normalize(self, frame, out=None):
+        """Normalize frame (flat float array, modified in place where NaN) into out, a (24,32) uint8 array."""
+        if out is None:
+            out = self._out
+        if not self._frame_stats(frame):
+            out.fill(0)  # Nothing valid in this frame, keep the previous range and show it blank
+            return out
+        self._update_range()
+        scale = 255/(self.range_max - self.range_min)
+        # dst = saturate_cast<uint8>(frame*scale - range_min*scale) in one pass
+        cv2.addWeighted(frame.reshape(self.shape), scale, frame.reshape(self.shape), 0, -self.range_min*scale,
+                        dst=out, dtype=cv2.CV_8U)
+        return out
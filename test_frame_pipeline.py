@@ -0,0 +1,72 @@
+"""Capture thread error handling, run with python -m pytest."""
+import threading
+import numpy as np
+import pytest
+from frame_pipeline import FrameRing, CaptureThread
+from frame_sources import SyntheticSource
+
+
+class FailingSource(SyntheticSource):
+    """Synthetic sensor that raises error after `frames` good frames, like an unplugged camera."""
+
+    def __init__(self, error:Exception, frames:int = 5):
+        super().__init__()
+        self.error = error
+        self.good_frames = frames
+
+    def getFrame(self, framebuf):
+        if self.frames >= self.good_frames:
+            raise self.error
+        super().getFrame(framebuf)
+
+
+def _run_until_stopped(source):
+    thread = CaptureThread(source, FrameRing())
+    thread.start()
+    thread.join(5)
+    return thread
+
+
+def test_unexpected_error_is_raised_to_the_reader():
+    thread = _run_until_stopped(FailingSource(RuntimeError("No I2C device at address: 0x33")))
+    assert not thread.is_alive()
+    assert thread.frames_captured == 5
+    with pytest.raises(RuntimeError, match="No I2C device"):
+        thread.raise_if_failed()
+
+
+def test_exhausted_source_is_not_an_error():
+    thread = _run_until_stopped(FailingSource(EOFError("End of replayed frames")))
+    assert thread.exhausted
+    thread.raise_if_failed()
+
+
+def test_running_and_stopped_threads_do_not_raise():
+    thread = CaptureThread(SyntheticSource(), FrameRing())
+    thread.start()
+    thread.raise_if_failed()
+    thread.stop()
+    thread.raise_if_failed()
+
+
+def test_frames_raises_instead_of_waiting_forever():
+    denfilm = pytest.importorskip('denfilm_pi_thermal_cam')
+    camera = denfilm.pithermalcam(frame_source=FailingSource(RuntimeError("No I2C device at address: 0x33")),
+                                  output_size=(64, 48))
+    camera.start_capture()
+    frames = []
+    failed = threading.Event()
+
+    def consume():
+        try:
+            for frame, info in camera.frames(count=20, raw=True):
+                frames.append(np.array(frame))
+        except RuntimeError:
+            failed.set()
+
+    consumer = threading.Thread(target=consume, daemon=True)
+    consumer.start()
+    consumer.join(5)
+    camera.stop_capture()
+    assert failed.is_set()
+    assert len(frames) <= 5
@@ -0,0 +1,426 @@
+"""Rolling on-disk temperature history: recent full frames plus per-second and per-minute aggregates.
+
+Three tiers share one folder:
+    frames    every raw frame, kept for a short window
+    seconds   per-second min, max and mean grids, kept for hours
+    minutes   the same per minute, kept for months
+Temperatures are stored as int16 hundredths of a degree C like the recordings. The aggregate
+chunks also get min, max and mean columns for every region of interest.
+
+write() runs on the capture thread. It only folds the frame into the running aggregates and
+fills the next row of a preallocated in-memory chunk. A background writer thread compresses
+each full chunk into one .npz file with one array per column. It then evicts the chunks older
+than their tier's retention, and the oldest chunks (finest tier first) while the store is
+over max_bytes. Chunk file names carry the time span they cover, so a time range query only
+opens the chunks it overlaps and only loads the columns it asks for.
+"""
+import logging
+import math
+import os
+import queue
+import threading
+import time
+import warnings
+import numpy as np
+from thermal_recording import SCALE, NAN_VALUE, ROWS, COLS
+
+logger = logging.getLogger(__name__)
+
+PIXELS = ROWS*COLS
+TIERS = ('frames', 'seconds', 'minutes')  # Finest first
+GRID_COLUMNS = ('pixels', 'min', 'max', 'mean')
+FRAME_COLUMNS = {'timestamp': ((), np.float64), 'pixels': ((PIXELS,), np.int16)}
+AGGREGATE_COLUMNS = {'timestamp': ((), np.float64), 'frames': ((), np.int32), 'min': ((PIXELS,), np.int16),
+                     'max': ((PIXELS,), np.int16), 'mean': ((PIXELS,), np.int16)}
+
+
+def _to_centidegrees(temps, out, scratch):
+    """Temperatures in C to int16 hundredths of a degree in out, NaN stored as NAN_VALUE."""
+    np.multiply(temps, 1/SCALE, out=scratch)
+    nan_mask = np.isnan(scratch)
+    np.clip(scratch, NAN_VALUE + 1, 32767, out=scratch)
+    np.rint(scratch, out=scratch)
+    scratch[nan_mask] = NAN_VALUE
+    np.copyto(out, scratch, casting='unsafe')
+
+
+def _to_degrees(stored):
+    temps = stored*SCALE
+    temps[stored == NAN_VALUE] = np.nan
+    return temps
+
+
+class _Accumulator:
+    """Running per pixel min, max, sum and valid frame count over one second or minute."""
+
+    def __init__(self):
+        self.min = np.zeros(PIXELS)
+        self.max = np.zeros(PIXELS)
+        self.sum = np.zeros(PIXELS)
+        self.valid = np.zeros(PIXELS, dtype=np.int64)
+        self.frames = 0
+        self.start = None  # Unix time the interval starts at, None between intervals
+
+    def reset(self, start:float):
+        self.min.fill(np.inf)
+        self.max.fill(-np.inf)
+        self.sum.fill(0)
+        self.valid.fill(0)
+        self.frames = 0
+        self.start = start
+
+    def add(self, frame, valid):
+        np.fmin(self.min, frame, out=self.min)  # fmin/fmax skip NaN pixels
+        np.fmax(self.max, frame, out=self.max)
+        np.add(self.sum, frame, out=self.sum, where=valid)
+        self.valid += valid
+        self.frames += 1
+
+    def merge(self, other):
+        np.fmin(self.min, other.min, out=self.min)
+        np.fmax(self.max, other.max, out=self.max)
+        self.sum += other.sum
+        self.valid += other.valid
+        self.frames += other.frames
+
+    def write_row(self, buffer:dict, row:int, scratch):
+        """Store the interval as row of an aggregate chunk. Pixels without a valid frame are stored as NaN."""
+        empty = self.valid == 0
+        buffer['timestamp'][row] = self.start
+        buffer['frames'][row] = self.frames
+        for column, values in (('min', self.min), ('max', self.max)):
+            temps = np.where(empty, np.nan, values)
+            _to_centidegrees(temps, buffer[column][row], scratch)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            _to_centidegrees(self.sum/self.valid, buffer['mean'][row], scratch)  # 0/0 is NaN for the empty pixels
+        self.start = None
+
+
+class _Tier:
+    """Rows of one tier, filled in memory and written as one columnar chunk file per chunk_rows rows."""
+
+    def __init__(self, name:str, folder:str, columns:dict, chunk_rows:int, retention:float, interval:float,
+                 buffers:int = 3):
+        self.name = name
+        self.folder = os.path.join(folder, name)
+        self.columns = columns
+        self.chunk_rows = chunk_rows
+        self.retention = retention  # Seconds a chunk is kept after its last row
+        self.interval = interval  # Seconds one row covers, 0 for single frames
+        self.rows_dropped = 0
+        os.makedirs(self.folder, exist_ok=True)
+        self.chunks = self._scan()  # [start, end, path, bytes] of the chunk files, oldest first
+        self.pending = []  # (buffer, rows) handed to the writer thread and not on disk yet
+        self._free = queue.Queue()
+        for _ in range(buffers):
+            self._free.put({column: np.zeros((chunk_rows,) + shape, dtype) for column, (shape, dtype) in columns.items()})
+        self.buffer = self._free.get()
+        self.count = 0
+
+    def _scan(self):
+        chunks = []
+        for name in os.listdir(self.folder):
+            if not name.endswith('.npz'):
+                continue
+            try:
+                start, end = (float(value) for value in name[:-4].split('_'))
+            except ValueError:
+                continue
+            path = os.path.join(self.folder, name)
+            chunks.append([start, end, path, os.path.getsize(path)])
+        return sorted(chunks)
+
+    def next_row(self):
+        """Index of the buffer row to fill next, or None (the row is dropped) if every buffer waits for the writer."""
+        if self.buffer is None:
+            try:
+                self.buffer = self._free.get_nowait()
+            except queue.Empty:
+                self.rows_dropped += 1
+                return None
+        return self.count
+
+    def commit_row(self):
+        """Count the filled row. Returns (buffer, rows) for the writer thread once the chunk is full."""
+        self.count += 1
+        return self.take() if self.count == self.chunk_rows else None
+
+    def take(self):
+        """Hand over the rows filled so far, None if there are none."""
+        if self.buffer is None or not self.count:
+            return None
+        full = (self.buffer, self.count)
+        self.buffer = None
+        self.count = 0
+        return full
+
+    def release(self, buffer:dict):
+        self._free.put(buffer)
+
+    @property
+    def disk_bytes(self):
+        return sum(chunk[3] for chunk in self.chunks)
+
+
+class ThermalHistory:
+    """Three tier temperature history in folder, fed with every raw frame and queried by unix time range."""
+
+    def __init__(self, folder:str, rois=None, frames_retention:float = 600.0, seconds_retention:float = 6*3600.0,
+                 minutes_retention:float = 90*86400.0, max_bytes:int = 512*2**20, chunk_rows:tuple = (256, 600, 60)):
+        self.folder = folder
+        self.rois = rois  # Optional RoiAnalyzer, its regions get min/max/mean columns in the aggregate chunks
+        self.max_bytes = max_bytes
+        self._tiers = {'frames': _Tier('frames', folder, FRAME_COLUMNS, chunk_rows[0], frames_retention, 0.0),
+                       'seconds': _Tier('seconds', folder, AGGREGATE_COLUMNS, chunk_rows[1], seconds_retention, 1.0),
+                       'minutes': _Tier('minutes', folder, AGGREGATE_COLUMNS, chunk_rows[2], minutes_retention, 60.0)}
+        self._accumulators = {'seconds': _Accumulator(), 'minutes': _Accumulator()}
+        self._valid = np.zeros(PIXELS, dtype=bool)
+        self._scratch = np.zeros(PIXELS)
+        self._lock = threading.Lock()  # write() runs on the capture thread, queries and close() usually do not
+        self._pending = queue.Queue()
+        self._closed = False
+        self.frames_written = 0
+        self.chunks_written = 0
+        self.chunks_evicted = 0
+        self.write_errors = 0
+        self._thread = threading.Thread(target=self._run, name='history-writer', daemon=True)
+        self._thread.start()
+
+    def write(self, frame, timestamp:float = None):
+        """Add one raw frame (768 temperatures in C) taken at unix time timestamp, now by default. Never blocks on the disk."""
+        timestamp = time.time() if timestamp is None else timestamp
+        with self._lock:
+            if self._closed:
+                return False
+            second = float(math.floor(timestamp))
+            seconds = self._accumulators['seconds']
+            if seconds.start is not None and second != seconds.start:
+                self._close_interval('seconds')
+                minutes = self._accumulators['minutes']
+                if minutes.start is not None and second - second % 60 != minutes.start:
+                    self._close_interval('minutes')
+            if seconds.start is None:
+                seconds.reset(second)
+            tier = self._tiers['frames']
+            row = tier.next_row()
+            if row is not None:
+                tier.buffer['timestamp'][row] = timestamp
+                _to_centidegrees(frame, tier.buffer['pixels'][row], self._scratch)
+                self._hand_over(tier, tier.commit_row())
+            np.isnan(frame, out=self._valid)
+            np.logical_not(self._valid, out=self._valid)
+            seconds.add(frame, self._valid)
+            self.frames_written += 1
+            return True
+
+    def _close_interval(self, name:str):
+        accumulator = self._accumulators[name]
+        if name == 'seconds':
+            minutes = self._accumulators['minutes']
+            if minutes.start is None:
+                minutes.reset(accumulator.start - accumulator.start % 60)
+            minutes.merge(accumulator)
+        tier = self._tiers[name]
+        row = tier.next_row()
+        if row is None:
+            accumulator.start = None
+            return
+        accumulator.write_row(tier.buffer, row, self._scratch)
+        self._hand_over(tier, tier.commit_row())
+
+    def _hand_over(self, tier:_Tier, full):
+        if full is not None:
+            tier.pending.append(full)
+            self._pending.put((tier, full))
+
+    def _run(self):
+        while True:
+            item = self._pending.get()
+            if item is None:
+                self._pending.task_done()
+                break
+            tier, full = item
+            try:
+                self._write_chunk(tier, full)
+            except OSError:
+                self.write_errors += 1
+                logger.warning("Writing %s history chunk to %s failed", tier.name, tier.folder, exc_info=True)
+                with self._lock:
+                    tier.pending = [item for item in tier.pending if item is not full]
+            tier.release(full[0])
+            self._evict()
+            self._pending.task_done()
+
+    def _write_chunk(self, tier:_Tier, full:tuple):
+        buffer, rows = full
+        columns = {column: values[:rows] for column, values in buffer.items()}
+        if tier.name != 'frames':
+            columns.update(self._roi_columns(columns))
+        start = float(columns['timestamp'][0])
+        end = float(columns['timestamp'][-1]) + tier.interval
+        path = os.path.join(tier.folder, f'{start:.3f}_{end:.3f}.npz')
+        with open(path + '.tmp', 'wb') as f:
+            np.savez_compressed(f, **columns)
+        os.replace(path + '.tmp', path)  # A crash never leaves a half written chunk under a valid name
+        with self._lock:  # Both at once, a query in between would see the rows on disk and in memory
+            tier.chunks.append([start, end, path, os.path.getsize(path)])
+            tier.pending = [item for item in tier.pending if item is not full]
+        self.chunks_written += 1
+
+    def _roi_columns(self, columns:dict):
+        """Per region min/max/mean over the aggregate grids in columns, roi_<stat> arrays of shape (rows, regions)."""
+        if self.rois is None:
+            return {}
+        names, masks = [], []
+        for name in self.rois.names:
+            try:
+                masks.append(self.rois.mask(name).reshape(-1))
+                names.append(name)
+            except KeyError:
+                continue  # Removed meanwhile
+        if not names:
+            return {}
+        result = {'roi_names': np.array(names)}
+        reducers = {'min': np.nanmin, 'max': np.nanmax, 'mean': np.nanmean}  # The mean of the per pixel means
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)  # All NaN regions give NaN
+            for stat, reduce in reducers.items():
+                if stat in columns:
+                    grids = _to_degrees(columns[stat])
+                    result[f'roi_{stat}'] = np.stack([reduce(grids[:, mask], axis=1) for mask in masks], axis=1).astype(np.float32)
+        return result
+
+    def _evict(self):
+        now = time.time()
+        doomed = []
+        with self._lock:
+            for tier in self._tiers.values():
+                while tier.chunks and tier.chunks[0][1] < now - tier.retention:
+                    doomed.append(tier.chunks.pop(0))
+            total = sum(tier.disk_bytes for tier in self._tiers.values())
+            for name in TIERS:  # Over budget, give up the finest data first, but keep every tier's newest chunk
+                tier = self._tiers[name]
+                while total > self.max_bytes and len(tier.chunks) > 1:
+                    chunk = tier.chunks.pop(0)
+                    total -= chunk[3]
+                    doomed.append(chunk)
+        for chunk in doomed:
+            try:
+                os.remove(chunk[2])
+                self.chunks_evicted += 1
+            except OSError:
+                logger.warning("Could not delete history chunk %s", chunk[2])
+
+    def query(self, start:float, end:float = None, tier:str = None, columns:tuple = None):
+        """Rows overlapping [start, end] (unix time, end defaults to now): frames taken in it, and the seconds and
+        minutes that end after start and begin no later than end.
+
+        tier defaults to the finest one whose retention still reaches back to start. Returns {'timestamp': (n,), ...}
+        with the temperature columns in C as (n, 24, 32) grids ('pixels' for frames, 'min'/'max'/'mean' and the
+        'frames' count for aggregates) and for aggregates 'rois': {name: {'min', 'max', 'mean'}} arrays of (n,).
+        columns limits what is loaded, e.g. ('max',).
+        """
+        end = time.time() if end is None else end
+        if tier is None:
+            tier = next((name for name in TIERS if time.time() - start <= self._tiers[name].retention), TIERS[-1])
+        source = self._tiers[tier]
+        wanted = [column for column in source.columns if column != 'timestamp' and (columns is None or column in columns)]
+        with self._lock:
+            # A chunk ends when its last row does, so for aggregates it overlaps up to timestamp + interval
+            chunks = [list(chunk) for chunk in source.chunks if chunk[1] >= start and chunk[0] <= end]
+            in_memory = [(buffer, rows) for buffer, rows in source.pending]
+            if source.buffer is not None and source.count:
+                in_memory.append((source.buffer, source.count))
+            # Copy what is still in memory, the capture thread keeps filling those buffers
+            in_memory = [self._cut({column: buffer[column][:rows] for column in ['timestamp'] + wanted}, start, end, source.interval, copy=True)
+                         for buffer, rows in in_memory]
+        parts = []
+        for chunk in chunks:
+            try:
+                with np.load(chunk[2]) as data:
+                    names = [name for name in data.files if name in wanted or name == 'timestamp' or
+                             (name.startswith('roi_') and (name == 'roi_names' or name[4:] in wanted))]
+                    part = {name: data[name] for name in names}
+            except (OSError, ValueError):
+                continue  # Evicted since the chunk list was copied
+            roi_names = part.pop('roi_names', None)
+            part = self._cut(part, start, end, source.interval)
+            if roi_names is not None:
+                part['roi_names'] = roi_names
+            parts.append(part)
+        for part in in_memory:
+            if tier != 'frames':
+                part.update(self._roi_columns(part))
+            parts.append(part)
+        return self._assemble(parts, wanted, tier != 'frames')
+
+    @staticmethod
+    def _cut(part:dict, start:float, end:float, interval:float = 0.0, copy:bool = False):
+        """Rows overlapping [start, end]. An aggregate row covers interval seconds from its timestamp."""
+        timestamps = part['timestamp']
+        if interval > 0:
+            lo = np.searchsorted(timestamps, start - interval, side='right')  # timestamp + interval > start
+        else:
+            lo = np.searchsorted(timestamps, start, side='left')
+        hi = np.searchsorted(timestamps, end, side='right')
+        return {column: values[lo:hi].copy() if copy else values[lo:hi] for column, values in part.items()}
+
+    @staticmethod
+    def _assemble(parts:list, wanted:list, aggregate:bool):
+        parts = [part for part in parts if len(part['timestamp'])]
+        result = {'timestamp': np.concatenate([part['timestamp'] for part in parts]) if parts else np.zeros(0)}
+        for column in wanted:
+            if column in GRID_COLUMNS:
+                values = [part[column] for part in parts]
+                stored = np.concatenate(values) if values else np.zeros((0, PIXELS), np.int16)
+                result[column] = _to_degrees(stored).reshape(-1, ROWS, COLS)
+            else:
+                result[column] = np.concatenate([part[column] for part in parts]) if parts else np.zeros(0, np.int32)
+        if aggregate:
+            names = []
+            for part in parts:
+                names += [str(name) for name in part.get('roi_names', ()) if str(name) not in names]
+            rois = result['rois'] = {}
+            for name in names:
+                rois[name] = {}
+                for stat in ('min', 'max', 'mean'):
+                    if stat not in wanted:
+                        continue
+                    values = []
+                    for part in parts:
+                        part_names = [str(n) for n in part.get('roi_names', ())]
+                        if name in part_names and f'roi_{stat}' in part:
+                            values.append(part[f'roi_{stat}'][:, part_names.index(name)])
+                        else:
+                            values.append(np.full(len(part['timestamp']), np.nan, np.float32))
+                    rois[name][stat] = np.concatenate(values)
+        return result
+
+    def get_stats(self):
+        stats = {'history_frames_written': self.frames_written, 'history_chunks_written': self.chunks_written,
+                 'history_chunks_evicted': self.chunks_evicted, 'history_write_errors': self.write_errors,
+                 'history_rows_dropped': sum(tier.rows_dropped for tier in self._tiers.values())}
+        with self._lock:
+            for name, tier in self._tiers.items():
+                stats[f'history_{name}_chunks'] = len(tier.chunks)
+                stats[f'history_{name}_bytes'] = tier.disk_bytes
+        return stats
+
+    def flush(self):
+        """Block until every full chunk handed to the writer thread is on disk."""
+        self._pending.join()
+
+    def close(self):
+        """Store the partial second and minute, write every partial chunk and stop the writer thread."""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            if self._accumulators['seconds'].start is not None:
+                self._close_interval('seconds')
+            if self._accumulators['minutes'].start is not None:
+                self._close_interval('minutes')
+            for tier in self._tiers.values():
+                self._hand_over(tier, tier.take())
+        self._pending.put(None)
+        self._thread.join()
@@ -0,0 +1,169 @@
+"""Record and replay raw MLX90640 temperature streams.
+
+File layout: a fixed 64 byte header followed by fixed size records, each a float64 monotonic
+timestamp and the 768 pixels as int16 hundredths of a degree C (NaN stored as -32768). The
+fixed record size makes the file memory-mappable, so a long session can be scrubbed and
+replayed without loading or copying it.
+"""
+import logging
+import os
+import queue
+import struct
+import threading
+import time
+import numpy as np
+from frame_sources import ReplaySource
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'MLXREC\x00\x01'
+HEADER_SIZE = 64
+HEADER_FORMAT = '<8sHHHfBd'  # magic, version, rows, cols, scale, refresh_rate, created (unix time)
+VERSION = 1
+SCALE = 0.01  # Degrees C per stored unit
+NAN_VALUE = -32768
+ROWS, COLS = 24, 32
+RECORD_DTYPE = np.dtype([('timestamp', '<f8'), ('pixels', '<i2', (ROWS*COLS,))])
+
+
+def _pack_header(refresh_rate:int):
+    header = struct.pack(HEADER_FORMAT, MAGIC, VERSION, ROWS, COLS, SCALE, refresh_rate, time.time())
+    return header.ljust(HEADER_SIZE, b'\x00')
+
+
+class RecordingWriter:
+    """Appends raw frames to a recording file from a background thread.
+
+    write() only converts the frame into a preallocated batch; full batches are written with a
+    single write() call by the writer thread. If the disk falls behind and no batch is free the
+    frame is dropped and counted instead of blocking the caller.
+    """
+
+    def __init__(self, path:str, refresh_rate:int, batch_size:int = 32, batches:int = 4):
+        self.path = path
+        self.frames_written = 0
+        self.frames_dropped = 0
+        self._file = open(path, 'wb')
+        self._file.write(_pack_header(refresh_rate))
+        self._free = queue.Queue()
+        self._full = queue.Queue()
+        for _ in range(batches):
+            self._free.put(np.zeros(batch_size, dtype=RECORD_DTYPE))
+        self._batch = self._free.get()
+        self._count = 0
+        self._scaled = np.zeros(ROWS*COLS)
+        self._nan_mask = np.zeros(ROWS*COLS, dtype=bool)
+        self._lock = threading.Lock()  # write() runs on the capture thread, close() usually does not
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name='recording-writer', daemon=True)
+        self._thread.start()
+
+    def write(self, frame, timestamp:float = None):
+        """Queue one raw float frame (768 temperatures in C). Never blocks on the disk."""
+        with self._lock:
+            if self._closed:
+                return False
+            return self._write(frame, timestamp)
+
+    def _write(self, frame, timestamp:float):
+        if self._batch is None:
+            try:
+                self._batch = self._free.get_nowait()
+            except queue.Empty:
+                self.frames_dropped += 1
+                return False
+        self._batch['timestamp'][self._count] = time.monotonic() if timestamp is None else timestamp
+        np.multiply(frame, 1/SCALE, out=self._scaled)
+        np.isnan(self._scaled, out=self._nan_mask)
+        np.clip(self._scaled, NAN_VALUE + 1, 32767, out=self._scaled)
+        np.rint(self._scaled, out=self._scaled)
+        np.copyto(self._scaled, NAN_VALUE, where=self._nan_mask)
+        np.copyto(self._batch['pixels'][self._count], self._scaled, casting='unsafe')
+        self._count += 1
+        if self._count == len(self._batch):
+            self._full.put((self._batch, self._count))
+            self._batch = None
+            self._count = 0
+        return True
+
+    def _run(self):
+        while True:
+            item = self._full.get()
+            if item is None:
+                break
+            batch, count = item
+            try:
+                self._file.write(batch[:count].data)
+                self.frames_written += count
+            except (OSError, ValueError):
+                self.frames_dropped += count
+                logger.warning("Writing recording %s failed", self.path)
+            self._free.put(batch)
+
+    def close(self):
+        """Write out the partial batch and close the file."""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            if self._batch is not None and self._count:
+                self._full.put((self._batch, self._count))
+                self._batch = None
+        self._full.put(None)
+        self._thread.join()
+        self._file.close()
+
+
+class RecordingReader:
+    """Memory-maps a recording. records['timestamp'] and records['pixels'] are zero-copy views."""
+
+    def __init__(self, path:str):
+        self.path = path
+        with open(path, 'rb') as f:
+            header = f.read(HEADER_SIZE)
+        magic, version, rows, cols, scale, refresh_rate, created = struct.unpack_from(HEADER_FORMAT, header)
+        if magic != MAGIC or version != VERSION or (rows, cols) != (ROWS, COLS):
+            raise ValueError(f"{path} is not a supported thermal recording")
+        self.scale = scale
+        self.refresh_rate = refresh_rate
+        self.created = created
+        # A recording cut short mid-record ignores the incomplete tail
+        count = (os.path.getsize(path) - HEADER_SIZE)//RECORD_DTYPE.itemsize
+        self.records = np.memmap(path, dtype=RECORD_DTYPE, mode='r', offset=HEADER_SIZE, shape=(count,))
+
+    def __len__(self):
+        return len(self.records)
+
+    @property
+    def timestamps(self):
+        return self.records['timestamp']
+
+    @property
+    def duration(self):
+        return float(self.timestamps[-1] - self.timestamps[0]) if len(self) > 1 else 0.0
+
+    def frame(self, index:int, out=None):
+        """Return frame index as float temperatures in C, written into out if given."""
+        pixels = self.records['pixels'][index]
+        if out is None:
+            out = np.zeros(ROWS*COLS)
+        np.multiply(pixels, self.scale, out=out)
+        out[pixels == NAN_VALUE] = np.nan
+        return out
+
+    def index_at(self, seconds:float):
+        """Index of the first frame at or after seconds from the start of the recording, for scrubbing."""
+        return int(np.searchsorted(self.timestamps, self.timestamps[0] + seconds))
+
+
+class RecordingSource(ReplaySource):
+    """Feeds a recording to the camera like a sensor, at the original cadence or as fast as possible."""
+
+    def __init__(self, path:str, loop:bool = False, realtime:bool = True, start:float = 0.0):
+        self.reader = RecordingReader(path)
+        super().__init__(self.reader.records, timestamps=self.reader.timestamps, loop=loop, realtime=realtime,
+                         refresh_rate=self.reader.refresh_rate)
+        self.position = self.reader.index_at(start) if start else 0
+
+    def _copy_frame(self, index:int, framebuf):
+        self.reader.frame(index, out=framebuf)